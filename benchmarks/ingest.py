@@ -0,0 +1,188 @@
+"""
+Benchmark of event ingestion throughput against the number of processes, receivers and writers
+
+Declares the event queue and publishes the events of a number of tasks to it before timing, so the publisher,
+which runs in one thread, doesn't limit the measure. Monitors without the web app then consume the queue, and
+the time from the first stored event until all of them are stored gives the events per second of each
+configuration.
+
+With the default in-memory broker, all receivers share one process. Against a real broker, --processes runs
+several monitor processes sharing the queue through their node id, storing to the same SQLite database:
+
+    python -m benchmarks.ingest --tasks 5000 --receivers 1 2 4 --writers 1 4
+    python -m benchmarks.ingest --broker redis://localhost:6379/0 --processes 1 2 4 --receivers 1 2
+"""
+import argparse
+import itertools
+import multiprocessing
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from multiprocessing.synchronize import Event
+from pathlib import Path
+
+from celery import Celery
+from celery.events import EventDispatcher, EventReceiver
+from veggie.monitor import CeleryMonitor
+from veggie.state import timestamp_field
+from veggie.storage import MemoryStorage, SQLiteStorage, Storage
+
+# Event types of a successful task, in order
+LIFECYCLE = ("task-sent", "task-received", "task-started", "task-succeeded")
+POLL_SECONDS = 0.05
+
+
+def declare_queue(celery_app: Celery, node_id: str) -> None:
+    """Declares the durable event queue of the monitors, so that it receives the events published before they start"""
+    with celery_app.connection_for_write() as connection:
+        receiver = EventReceiver(connection, node_id=node_id, app=celery_app, queue_durable=True)
+        receiver.queue(connection.default_channel).declare()
+
+
+def delete_queue(celery_app: Celery, node_id: str) -> None:
+    """Deletes the event queue of the monitors"""
+    with celery_app.connection_for_write() as connection:
+        receiver = EventReceiver(connection, node_id=node_id, app=celery_app, queue_durable=True)
+        receiver.queue(connection.default_channel).delete()
+
+
+def publish_tasks(celery_app: Celery, tasks: int) -> None:
+    """Publishes the lifecycle events of `tasks` tasks"""
+    with celery_app.connection_for_write() as connection:
+        dispatcher = EventDispatcher(connection, hostname="worker@benchmark", app=celery_app)
+        for _ in range(tasks):
+            task_id = str(uuid.uuid4())
+            for event_type in LIFECYCLE:
+                dispatcher.send(event_type, uuid=task_id, name="benchmark.task")
+
+
+def stored_events(storage: Storage, path: str | None) -> int:
+    """
+    Counts the stored events, from the lifecycle timestamps of the stored tasks
+
+    The SQLite database at `path` is counted in SQL, which releases the GIL, so that polling disturbs the monitor
+    as little as possible.
+    """
+    fields = [timestamp_field(event_type) for event_type in LIFECYCLE]
+    if path is None:
+        return sum(sum(task.get(field) is not None for field in fields) for task in storage.get_events())
+    counts = " + ".join(f"count(json_extract(data, '$.{field}'))" for field in fields)
+    with sqlite3.connect(path) as connection:
+        return connection.execute(f"SELECT {counts} FROM events").fetchone()[0]
+
+
+def run_monitor(broker: str, path: str, node_id: str, receivers: int, writers: int, stop: Event) -> None:
+    """Runs a monitor storing to the SQLite database at `path` until `stop` is set, in a separate process"""
+    celery_app = Celery("benchmark", broker=broker)
+    storage = SQLiteStorage(path=path)
+    monitor = CeleryMonitor(
+        celery_app=celery_app,
+        storage=storage,
+        receivers=receivers,
+        writers=writers,
+        node_id=node_id,
+        durable_queue=True,
+    )
+    thread = threading.Thread(target=monitor.start, kwargs={"webapp": False})
+    thread.start()
+    stop.wait()
+    monitor.stop()
+    thread.join()
+    storage.close()
+
+
+def run(
+    celery_app: Celery, storage: Storage, path: str | None, tasks: int, processes: int, receivers: int, writers: int
+) -> float:
+    """
+    Returns the number of events stored per second
+
+    Args:
+        celery_app: Celery app connected to the broker.
+        storage: Storage the events are counted in. Monitors in the same process store to it.
+        path: Path of the SQLite database of `storage`, opened by the monitor processes. Required with several
+            processes.
+        tasks: Number of tasks published, with 4 events each.
+        processes: Number of monitor processes. With 1, the monitor runs in a thread of this process.
+        receivers: Number of receivers per monitor.
+        writers: Number of writers per monitor.
+    """
+    node_id = f"benchmark-{uuid.uuid4().hex}"
+    declare_queue(celery_app, node_id)
+    publish_tasks(celery_app, tasks)
+    total = tasks * len(LIFECYCLE)
+
+    if processes == 1:
+        monitor = CeleryMonitor(
+            celery_app=celery_app,
+            storage=storage,
+            receivers=receivers,
+            writers=writers,
+            node_id=node_id,
+            durable_queue=True,
+        )
+        thread = threading.Thread(target=monitor.start, kwargs={"webapp": False})
+        thread.start()
+    else:
+        context = multiprocessing.get_context("spawn")
+        stop = context.Event()
+        workers = [
+            context.Process(
+                target=run_monitor, args=(celery_app.conf.broker_url, path, node_id, receivers, writers, stop)
+            )
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+
+    # Times the consumption only, from the first stored event, so that starting the monitors isn't measured
+    while (first := stored_events(storage, path)) == 0:
+        time.sleep(POLL_SECONDS)
+    start = time.perf_counter()
+    while stored_events(storage, path) < total:
+        time.sleep(POLL_SECONDS)
+    elapsed = time.perf_counter() - start
+
+    if processes == 1:
+        monitor.stop()
+        thread.join()
+    else:
+        stop.set()
+        for worker in workers:
+            worker.join()
+    delete_queue(celery_app, node_id)
+    return (total - first) / elapsed
+
+
+def main() -> None:
+    """Runs the benchmark for each combination of processes, receivers and writers"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", default="memory://", help="broker URL")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--tasks", type=int, default=5000, help="number of tasks, 4 events each")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1], help="monitor processes sharing the queue")
+    parser.add_argument("--receivers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--writers", type=int, nargs="+", default=[1])
+    args = parser.parse_args()
+    if max(args.processes) > 1 and (args.broker.startswith("memory://") or args.storage != "sqlite"):
+        parser.error("several processes need a real broker and the sqlite storage")
+
+    celery_app = Celery("benchmark", broker=args.broker)
+    print(f"{'processes':>9} {'receivers':>9} {'writers':>7} {'events/s':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for processes, receivers, writers in itertools.product(args.processes, args.receivers, args.writers):
+            path = None
+            if args.storage == "sqlite":
+                path = str(Path(directory) / f"events-{processes}-{receivers}-{writers}.db")
+                storage: Storage = SQLiteStorage(path=path)
+            else:
+                storage = MemoryStorage()
+            events_per_second = run(celery_app, storage, path, args.tasks, processes, receivers, writers)
+            storage.close()
+            print(f"{processes:>9} {receivers:>9} {writers:>7} {events_per_second:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
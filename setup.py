@@ -18,9 +18,11 @@ setup(
         "dash-mantine-components>=0.15.1",
         "dash-iconify",
         "loguru",
-        "celery[redis]",
+        "celery[redis]>=5.3",
         "humanize",
     ],
+    extras_require={"waitress": ["waitress>=3.0"], "gunicorn": ["gunicorn>=22.0"], "export": ["pyarrow>=14.0"]},
+    entry_points={"console_scripts": ["veggie=veggie.cli:main"]},
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",
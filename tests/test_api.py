@@ -0,0 +1,195 @@
+"""Tests for the REST API"""
+import io
+import json
+import tempfile
+from typing import Any
+from unittest.mock import Mock
+
+import pytest
+from celery import Celery
+from flask import Flask
+from flask.testing import FlaskClient
+from veggie.bus import EventBus
+from veggie.storage import SQLiteStorage
+from veggie.webapp.api import create_api_blueprint, event_stream_messages
+from veggie.webapp.service import VeggieService, decode_cursor, encode_cursor
+
+
+@pytest.fixture
+def storage() -> Any:
+    """Returns a SQLiteStorage with a temporary database."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        storage = SQLiteStorage(path=f"{temp_dir}/events.sqlite")
+        yield storage
+        storage.close()
+
+
+@pytest.fixture
+def client(storage: SQLiteStorage) -> FlaskClient:
+    """Returns a test client of a Flask app serving the API."""
+    app = Flask(__name__)
+    app.register_blueprint(
+        create_api_blueprint(service=VeggieService(storage=storage, celery_app=Mock(spec=Celery))), url_prefix="/api"
+    )
+    return app.test_client()
+
+
+def test_cursor_round_trip() -> None:
+    event = {"uuid": "abc", "sent_timestamp": 1670000000.5}
+    assert decode_cursor(encode_cursor(event)) == (1670000000.5, "abc")
+    assert decode_cursor(encode_cursor({"uuid": "abc"})) == (None, "abc")
+
+
+def test_decode_invalid_cursor() -> None:
+    with pytest.raises(ValueError):
+        decode_cursor("not-a-cursor")
+
+
+def test_get_events_pages(client: FlaskClient, storage: SQLiteStorage) -> None:
+    for i in range(5):
+        storage.store_event({"uuid": str(i), "name": "task", "type": "task-sent", "sent_timestamp": 1670000000.0 + i})
+
+    first_page = client.get("/api/v2/events?limit=3").get_json()
+    assert [event["uuid"] for event in first_page["events"]] == ["4", "3", "2"]
+
+    second_page = client.get(f"/api/v2/events?limit=3&cursor={first_page['next_cursor']}").get_json()
+    assert [event["uuid"] for event in second_page["events"]] == ["1", "0"]
+    assert second_page["next_cursor"] is None
+
+
+def test_get_events_legacy_array(client: FlaskClient, storage: SQLiteStorage) -> None:
+    """The first version of the route still returns all events as a bare array."""
+    for i in range(150):
+        storage.store_event({"uuid": str(i), "name": "task", "type": "task-sent", "sent_timestamp": 1670000000.0 + i})
+
+    events = client.get("/api/events").get_json()
+    assert isinstance(events, list)
+    assert len(events) == 150
+    assert events[0]["uuid"] == "149"
+
+
+def test_get_events_filters(client: FlaskClient, storage: SQLiteStorage) -> None:
+    storage.store_event({"uuid": "1", "name": "a", "type": "task-sent", "sent_timestamp": 1670000000.0})
+    storage.store_event({"uuid": "2", "name": "b", "type": "task-sent", "sent_timestamp": 1670000001.0})
+
+    response = client.get("/api/v2/events?name=a&sent_after=1669999999").get_json()
+    assert [event["uuid"] for event in response["events"]] == ["1"]
+
+
+def test_get_events_search(client: FlaskClient, storage: SQLiteStorage) -> None:
+    storage.store_event({"uuid": "1", "name": "a", "type": "task-sent", "kwargs": "{'order_id': 12345}"})
+    storage.store_event({"uuid": "2", "name": "a", "type": "task-sent", "kwargs": "{'order_id': 678}"})
+
+    response = client.get("/api/v2/events?q=12345").get_json()
+    assert [event["uuid"] for event in response["events"]] == ["1"]
+
+
+def test_get_events_bad_request(client: FlaskClient) -> None:
+    assert client.get("/api/v2/events?limit=0").status_code == 400
+    assert client.get("/api/v2/events?cursor=garbage").status_code == 400
+    assert client.get("/api/events?cursor=garbage").status_code == 400
+    assert client.get("/api/v2/events?limit=abc").status_code == 400
+    assert client.get("/api/events?sent_after=yesterday").status_code == 400
+    assert client.get("/api/events?stream=1&sent_before=1e").status_code == 400
+
+
+def test_get_events_ndjson(client: FlaskClient, storage: SQLiteStorage) -> None:
+    """Events are streamed as one JSON line each, with ?stream=1 or the Accept header."""
+    for i in range(5):
+        storage.store_event({"uuid": str(i), "name": "task", "type": "task-sent", "sent_timestamp": 1670000000.0 + i})
+
+    response = client.get("/api/events?stream=1&order=asc")
+    assert response.mimetype == "application/x-ndjson"
+    assert [json.loads(line)["uuid"] for line in response.data.splitlines()] == ["0", "1", "2", "3", "4"]
+
+    response = client.get("/api/events?limit=2", headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line)["uuid"] for line in response.data.splitlines()] == ["4", "3"]
+    assert client.get("/api/events?stream=1&cursor=garbage").status_code == 400
+
+
+def test_get_events_ndjson_search_disabled() -> None:
+    """A search on a database without search is a bad request, also when streamed."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        storage = SQLiteStorage(path=f"{temp_dir}/events.sqlite", use_search=False)
+        app = Flask(__name__)
+        service = VeggieService(storage=storage, celery_app=Mock(spec=Celery))
+        app.register_blueprint(create_api_blueprint(service=service), url_prefix="/api")
+        client = app.test_client()
+
+        assert client.get("/api/events?q=boom").status_code == 400
+        assert client.get("/api/events?stream=1&q=boom").status_code == 400
+        storage.close()
+
+
+def test_event_stream_ends_after_max_seconds() -> None:
+    """The stream tells the client to reconnect and ends after its maximum lifetime."""
+    event_bus = EventBus()
+    messages = list(event_stream_messages(event_bus=event_bus, max_seconds=0.1))
+    assert messages[0].startswith("retry: ")
+    assert event_bus._subscriptions == ()
+
+
+def test_event_streams_are_capped(storage: SQLiteStorage) -> None:
+    """Streams beyond `max_streams` end right away, telling the client to retry later, until an open one is closed."""
+    app = Flask(__name__)
+    service = VeggieService(storage=storage, celery_app=Mock(spec=Celery), event_bus=EventBus())
+    app.register_blueprint(create_api_blueprint(service=service, max_streams=1), url_prefix="/api")
+    client = app.test_client()
+
+    first = client.get("/api/events/stream", buffered=False)
+    assert first.status_code == 200
+    rejected = client.get("/api/events/stream")
+    assert rejected.status_code == 200 and rejected.mimetype == "text/event-stream"
+    assert rejected.get_data(as_text=True).startswith("retry: ")
+    first.close()
+    second = client.get("/api/events/stream", buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+
+def test_live_data_without_ingestion(client: FlaskClient) -> None:
+    """A process serving the web app alone says so for the data only the ingesting process holds."""
+    for path in ("/api/events/stream", "/api/workers"):
+        response = client.get(path)
+        assert response.status_code == 404
+        assert "doesn't ingest events" in response.get_data(as_text=True)
+
+
+def test_get_health_without_ingestion(client: FlaskClient, storage: SQLiteStorage) -> None:
+    """A process serving the web app alone reports an unknown status and the latest stored task."""
+    assert client.get("/api/health").get_json()["status"] == "unknown"
+
+    storage.store_event({"uuid": "a", "name": "task", "type": "task-sent", "sent_timestamp": 1670000000.0})
+    health = client.get("/api/health").get_json()
+    assert health["status"] == "unknown"
+    assert health["last_event_timestamp"] == 1670000000.0
+
+
+def test_get_stats(client: FlaskClient, storage: SQLiteStorage) -> None:
+    storage.store_event({"uuid": "1", "name": "a", "type": "task-failed", "sent_timestamp": 1670000000.0})
+    storage.store_event({"uuid": "2", "name": "a", "type": "task-succeeded", "sent_timestamp": 1670000010.0})
+
+    stats = client.get("/api/stats?start=1669999980&end=1670000040&bucket=60&group_by=name").get_json()
+    assert [(row["bucket"], row["name"], row["count"], row["failure_ratio"]) for row in stats] == [
+        (1669999980, "a", 2, 0.5)
+    ]
+
+
+def test_get_stats_bad_request(client: FlaskClient) -> None:
+    assert client.get("/api/stats?bucket=0").status_code == 400
+    assert client.get("/api/stats?start=10&end=5").status_code == 400
+    assert client.get("/api/stats?start=0&end=1000000&bucket=1").status_code == 400
+    assert client.get("/api/stats?group_by=data").status_code == 400
+    assert client.get("/api/stats?bucket=1m").status_code == 400
+
+
+def test_export_events(client: FlaskClient, storage: SQLiteStorage) -> None:
+    """Tasks are exported as a Parquet attachment, and unknown formats are bad requests."""
+    assert client.get("/api/events/export?format=csv").status_code == 400
+    pq = pytest.importorskip("pyarrow.parquet")
+    storage.store_event({"uuid": "1", "type": "task-sent", "name": "a", "sent_timestamp": 1670000000.0})
+
+    response = client.get("/api/events/export?start=1669999999")
+    assert response.status_code == 200
+    assert "veggie-tasks.parquet" in response.headers["Content-Disposition"]
+    assert pq.read_table(io.BytesIO(response.data))["uuid"].to_pylist() == ["1"]
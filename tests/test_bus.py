@@ -0,0 +1,46 @@
+"""Tests for the event bus"""
+from veggie.bus import EventBus
+
+
+def test_publish_to_all_subscribers() -> None:
+    event_bus = EventBus()
+    first, second = event_bus.subscribe(), event_bus.subscribe()
+    event_bus.publish({"uuid": "1", "type": "task-sent"})
+
+    assert first.get_batch(timeout=1, window=0) == ([{"uuid": "1", "type": "task-sent"}], 0)
+    assert second.get_batch(timeout=1, window=0) == ([{"uuid": "1", "type": "task-sent"}], 0)
+
+
+def test_batch_merges_events_by_task() -> None:
+    event_bus = EventBus()
+    subscription = event_bus.subscribe()
+    event_bus.publish({"uuid": "1", "type": "task-sent", "name": "foo"})
+    event_bus.publish({"uuid": "2", "type": "task-sent", "name": "bar"})
+    event_bus.publish({"uuid": "1", "type": "task-started"})
+
+    events, dropped = subscription.get_batch(timeout=1, window=0.01)
+    assert events == [
+        {"uuid": "1", "type": "task-started", "name": "foo"},
+        {"uuid": "2", "type": "task-sent", "name": "bar"},
+    ]
+    assert dropped == 0
+
+
+def test_slow_subscriber_drops_events() -> None:
+    event_bus = EventBus(max_queue_size=2)
+    subscription = event_bus.subscribe()
+    for i in range(5):
+        event_bus.publish({"uuid": str(i)})
+
+    events, dropped = subscription.get_batch(timeout=1, window=0.01)
+    assert [event["uuid"] for event in events] == ["0", "1"]
+    assert dropped == 3
+
+
+def test_unsubscribe() -> None:
+    event_bus = EventBus()
+    subscription = event_bus.subscribe()
+    event_bus.unsubscribe(subscription)
+    event_bus.publish({"uuid": "1"})
+
+    assert subscription.get_batch(timeout=0.01, window=0) == ([], 0)
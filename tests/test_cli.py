@@ -0,0 +1,95 @@
+"""Tests for the command line interface"""
+import sqlite3
+import sys
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+from celery import Celery
+from veggie.cli import get_parser, load_celery_app, main, open_storage
+from veggie.storage import PartitionedSQLiteStorage, SQLiteStorage
+
+
+@pytest.fixture
+def app_module(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[str]:
+    """Writes a module defining a Celery app in the current directory and returns its name."""
+    (tmp_path / "cli_tasks.py").write_text("from celery import Celery\n\napp = Celery('cli_tasks')\nother = 42\n")
+    monkeypatch.chdir(tmp_path)
+    yield "cli_tasks"
+    sys.modules.pop("cli_tasks", None)
+
+
+def test_load_celery_app(app_module: str) -> None:
+    """The app is imported from the current directory, from the `app` attribute by default."""
+    assert isinstance(load_celery_app(app_module), Celery)
+    assert load_celery_app(f"{app_module}:app") is load_celery_app(app_module)
+    with pytest.raises(ValueError):
+        load_celery_app(f"{app_module}:other")
+
+
+def test_serve_arguments() -> None:
+    """Server options are parsed into their types, with the ServerConfig defaults."""
+    args = get_parser().parse_args(
+        ["serve", "-A", "tasks", "--db", "events.db", "--server", "waitress", "--threads", "4"]
+    )
+    assert args.server == "waitress"
+    assert args.threads == 4
+    assert args.workers == 1
+    with pytest.raises(SystemExit):
+        get_parser().parse_args(["serve", "-A", "tasks", "--db", "events.db", "--server", "tornado"])
+
+
+def test_rebuild_rollups_command(tmp_path: Path) -> None:
+    """The command rebuilds the rollups of an existing database."""
+    path = str(tmp_path / "events.db")
+    storage = SQLiteStorage(path=path)
+    storage.store_event({"uuid": "1", "type": "task-sent", "name": "a", "sent_timestamp": 1670000000.0})
+    storage.close()
+
+    main(["rebuild-rollups", "--db", path])
+
+    storage = SQLiteStorage(path=path)
+    stats = storage.get_stats(start=1669999980.0, end=1670000040.0, bucket_seconds=60)
+    assert sum(row["count"] for row in stats) == 1
+
+
+def test_rebuild_rollups_command_partitioned(tmp_path: Path) -> None:
+    """With --partition, the command rebuilds the rollups of every partition of the directory."""
+    storage = PartitionedSQLiteStorage(directory=str(tmp_path), partition="hour")
+    for i, sent_timestamp in enumerate([1670000000.0, 1670010000.0]):
+        storage.store_event({"uuid": str(i), "type": "task-sent", "name": "a", "sent_timestamp": sent_timestamp})
+    storage.close()
+    paths = sorted(tmp_path.glob("events-*.db"))
+    assert len(paths) == 2
+    for path in paths:
+        with sqlite3.connect(path) as con:
+            con.execute("DELETE FROM rollup_minute")
+
+    main(["rebuild-rollups", "--db", str(tmp_path), "--partition", "hour"])
+
+    for path in paths:
+        with sqlite3.connect(path) as con:
+            assert con.execute("SELECT sum(sent) FROM rollup_minute").fetchone()[0] == 1
+
+
+def test_export_command(tmp_path: Path) -> None:
+    """The command writes the tasks of the time range to a Parquet file."""
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "events.db")
+    storage = SQLiteStorage(path=path)
+    for i in range(3):
+        storage.store_event({"uuid": str(i), "type": "task-sent", "name": "a", "sent_timestamp": 1670000000.0 + i})
+    storage.close()
+
+    output = str(tmp_path / "tasks.parquet")
+    main(["export", "--db", path, "-o", output, "--start", "1670000001"])
+
+    assert pq.read_table(output)["uuid"].to_pylist() == ["1", "2"]
+
+
+def test_open_partitioned_storage(tmp_path: Path) -> None:
+    """With --partition, --db is the directory of the partitions."""
+    args = get_parser().parse_args(["export", "--db", str(tmp_path), "-o", "tasks.parquet", "--partition", "hour"])
+    storage = open_storage(args)
+    assert isinstance(storage, PartitionedSQLiteStorage)
+    assert storage.partition_seconds == 3600
@@ -0,0 +1,64 @@
+"""Tests for the Parquet and Arrow export"""
+import io
+
+import pytest
+from veggie.export import iter_event_pages, iter_export
+from veggie.storage import MemoryStorage
+
+
+@pytest.fixture
+def storage() -> MemoryStorage:
+    """Returns a storage with 25 finished tasks sent one second apart, and one task never sent."""
+    storage = MemoryStorage()
+    for i in range(25):
+        storage.store_event(
+            {
+                "uuid": str(i),
+                "type": "task-succeeded",
+                "name": "tasks.add",
+                "hostname": "worker@host",
+                "sent_timestamp": 1670000000.0 + i,
+                "succeeded_timestamp": 1670000000.5 + i,
+                "runtime": 0.25,
+            }
+        )
+    storage.store_event({"uuid": "unsent", "type": "task-received", "name": "tasks.add"})
+    return storage
+
+
+def test_iter_event_pages(storage: MemoryStorage) -> None:
+    """Pages follow each other without gaps or duplicates, oldest first."""
+    pages = list(iter_event_pages(storage, start=1670000005.0, end=1670000020.0, chunk_size=4))
+    assert [len(page) for page in pages] == [4, 4, 4, 3]
+    assert [event["uuid"] for page in pages for event in page] == [str(i) for i in range(5, 20)]
+
+
+def test_export_parquet(storage: MemoryStorage) -> None:
+    """The Parquet export has typed columns and a row group per chunk."""
+    pq = pytest.importorskip("pyarrow.parquet")
+    data = b"".join(iter_export(storage, format="parquet", chunk_size=10))
+
+    parquet_file = pq.ParquetFile(io.BytesIO(data))
+    assert parquet_file.metadata.num_rows == 26
+    assert parquet_file.num_row_groups == 3
+    table = parquet_file.read()
+    assert str(table.schema.field("sent_timestamp").type) == "timestamp[us, tz=UTC]"
+    row = next(row for row in table.to_pylist() if row["uuid"] == "3")
+    assert row["sent_timestamp"].timestamp() == 1670000003.0
+    assert row["state"] == "task-succeeded"
+    assert row["runtime"] == 0.25
+
+
+def test_export_arrow(storage: MemoryStorage) -> None:
+    """The Arrow IPC stream holds the tasks of the time range."""
+    pa = pytest.importorskip("pyarrow")
+    data = b"".join(iter_export(storage, format="arrow", start=1670000020.0, chunk_size=2))
+
+    table = pa.ipc.open_stream(io.BytesIO(data)).read_all()
+    assert table["uuid"].to_pylist() == ["20", "21", "22", "23", "24"]
+
+
+def test_export_unknown_format(storage: MemoryStorage) -> None:
+    """An unknown format is rejected before anything is read."""
+    with pytest.raises(ValueError):
+        iter_export(storage, format="csv")
@@ -0,0 +1,63 @@
+"""Tests for the task metrics"""
+import pytest
+from veggie.metrics import TaskMetrics
+
+
+def _observe_lifecycle(metrics: TaskMetrics, uuid: str, final_state: str = "succeeded") -> None:
+    metrics.observe({"uuid": uuid, "type": "task-sent", "name": "add", "sent_timestamp": 100.0})
+    metrics.observe({"uuid": uuid, "type": "task-received", "name": "add", "received_timestamp": 100.2})
+    metrics.observe({"uuid": uuid, "type": "task-started", "started_timestamp": 100.3})
+    if final_state == "succeeded":
+        metrics.observe({"uuid": uuid, "type": "task-succeeded", "runtime": 3.0, "succeeded_timestamp": 103.3})
+    else:
+        metrics.observe({"uuid": uuid, "type": "task-failed", "failed_timestamp": 101.0})
+
+
+def test_counts_per_name_and_state() -> None:
+    metrics = TaskMetrics()
+    _observe_lifecycle(metrics, "1")
+    _observe_lifecycle(metrics, "2", final_state="failed")
+
+    assert metrics.counters == {
+        ("add", "sent"): 2,
+        ("add", "received"): 2,
+        ("add", "started"): 2,
+        ("add", "succeeded"): 1,
+        ("add", "failed"): 1,
+    }
+    assert metrics._tasks == {}
+
+
+def test_histograms() -> None:
+    metrics = TaskMetrics()
+    _observe_lifecycle(metrics, "1")
+
+    runtime = metrics.runtimes["add"]
+    assert sum(runtime.counts) == 1
+    assert runtime.sum == 3.0
+    assert metrics.queue_waits["add"].sum == pytest.approx(0.2)
+
+
+def test_tracked_tasks_are_bounded() -> None:
+    metrics = TaskMetrics(max_tracked_tasks=2)
+    for uuid in ["1", "2", "3"]:
+        metrics.observe({"uuid": uuid, "type": "task-sent", "name": "add", "sent_timestamp": 100.0})
+    metrics.observe({"uuid": "1", "type": "task-started"})
+
+    assert list(metrics._tasks) == ["2", "3"]
+    assert metrics.counters[("unknown", "started")] == 1
+
+
+def test_render() -> None:
+    metrics = TaskMetrics()
+    _observe_lifecycle(metrics, "1")
+    metrics.observe({"uuid": "2", "type": "task-sent", "name": 'quote"d', "sent_timestamp": 100.0})
+
+    text = metrics.render()
+    assert 'veggie_tasks_total{name="add",state="succeeded"} 1\n' in text
+    assert 'veggie_tasks_total{name="quote\\"d",state="sent"} 1\n' in text
+    assert 'veggie_task_runtime_seconds_bucket{name="add",le="2.5"} 0\n' in text
+    assert 'veggie_task_runtime_seconds_bucket{name="add",le="5.0"} 1\n' in text
+    assert 'veggie_task_runtime_seconds_bucket{name="add",le="+Inf"} 1\n' in text
+    assert 'veggie_task_runtime_seconds_count{name="add"} 1\n' in text
+    assert "# TYPE veggie_task_queue_wait_seconds histogram\n" in text
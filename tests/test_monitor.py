@@ -1,10 +1,17 @@
 """ Test celery monitor."""
-from unittest.mock import Mock
+import threading
+import time
+from pathlib import Path
+from unittest.mock import Mock, patch
 
 import pytest
 from celery import Celery
+from celery.events import EventDispatcher
 from veggie.monitor import CeleryMonitor
-from veggie.storage import Storage
+from veggie.pipeline import EventPipeline, ThreadedAsyncStorage
+from veggie.server import ServerConfig
+from veggie.spool import EventSpool
+from veggie.storage import BufferedStorage, MemoryStorage, RetentionPolicy, Storage
 
 
 @pytest.fixture
@@ -75,3 +82,197 @@ def test_process_task_failed(celery_monitor: CeleryMonitor, mock_storage: Mock)
     assert "timestamp" not in event
     assert event["failed_timestamp"] == 1670000000.0
     mock_storage.store_event.assert_called_once_with(event)
+
+
+def test_process_task_publishes_event(celery_monitor: CeleryMonitor) -> None:
+    """Test that processed events are published to live subscribers."""
+    subscription = celery_monitor.event_bus.subscribe()
+    event = {"uuid": "123", "timestamp": 1670000000.0, "name": "task_sent", "type": "task-sent"}
+    celery_monitor._process_task_sent(event)
+
+    assert subscription.get_batch(timeout=1, window=0) == ([event], 0)
+
+
+def test_metrics_endpoint(celery_monitor: CeleryMonitor) -> None:
+    """Test that processed events are counted on the metrics endpoint."""
+    celery_monitor._process_task_sent({"uuid": "123", "type": "task-sent", "timestamp": 1670000000.0, "name": "add"})
+
+    response = celery_monitor.flask_app.test_client().get("/metrics")
+    assert response.status_code == 200
+    assert 'veggie_tasks_total{name="add",state="sent"} 1' in response.get_data(as_text=True)
+
+
+@pytest.mark.parametrize("event_type", ["retried", "revoked", "rejected"])
+def test_process_task_other_events(celery_monitor: CeleryMonitor, mock_storage: Mock, event_type: str) -> None:
+    """Test processing of retried, revoked and rejected events."""
+    event = {"uuid": "123", "type": f"task-{event_type}", "timestamp": 1670000000.0}
+    getattr(celery_monitor, f"_process_task_{event_type}")(event)
+
+    assert "timestamp" not in event
+    assert event[f"{event_type}_timestamp"] == 1670000000.0
+    mock_storage.store_event.assert_called_once_with(event)
+
+
+def test_process_worker_event(celery_monitor: CeleryMonitor, mock_storage: Mock) -> None:
+    """Test that worker events update the registry without being stored."""
+    celery_monitor._process_worker_event({"type": "worker-heartbeat", "hostname": "w1", "timestamp": 1.0, "active": 2})
+
+    response = celery_monitor.flask_app.test_client().get("/api/workers")
+    assert [worker["active"] for worker in response.get_json()["workers"]] == [2]
+    mock_storage.store_event.assert_not_called()
+
+
+def test_monitor_rejects_gunicorn(mock_celery_app: Mock, mock_storage: Mock) -> None:
+    """gunicorn can't serve the web app from the monitor process."""
+    with pytest.raises(ValueError):
+        CeleryMonitor(mock_celery_app, mock_storage, server=ServerConfig(server="gunicorn"))
+
+
+def test_monitor_rejects_retention_without_prune(mock_celery_app: Mock) -> None:
+    """A retention policy is rejected up front for a storage that can't prune."""
+
+    class DictStorage(Storage):
+        def store_event(self, event: dict) -> None:
+            pass
+
+        def get_events(self) -> list[dict]:
+            return []
+
+        def get_event_by_id(self, id: str) -> dict | None:
+            return None
+
+    with pytest.raises(ValueError):
+        CeleryMonitor(mock_celery_app, BufferedStorage(DictStorage()), retention=RetentionPolicy(max_age=60))
+    CeleryMonitor(mock_celery_app, BufferedStorage(MemoryStorage()), retention=RetentionPolicy(max_age=60))
+
+
+@pytest.mark.parametrize("durable_queue, queue_durable", [(False, None), (True, True)])
+def test_monitor_queue_durability(
+    mock_celery_app: Mock, mock_storage: Mock, durable_queue: bool, queue_durable: bool | None
+) -> None:
+    """The queue is made durable only when asked, otherwise the setting of the Celery app applies."""
+    monitor = CeleryMonitor(mock_celery_app, mock_storage, node_id="veggie", durable_queue=durable_queue)
+    with patch("veggie.monitor.EventReceiver") as event_receiver:
+        monitor._receive_events(Mock())
+    assert event_receiver.call_args.kwargs["queue_durable"] is queue_durable
+
+
+def test_monitor_ingests_with_several_receivers_and_writers() -> None:
+    """Events consumed by several receivers and stored by several writers are all stored, merged per task."""
+    celery_app = Celery("test_monitor", broker="memory://")
+    storage = MemoryStorage()
+    monitor = CeleryMonitor(celery_app, storage, receivers=2, writers=3)
+    thread = threading.Thread(target=monitor.start, kwargs={"webapp": False})
+    thread.start()
+    while len(monitor._receivers) < 2:
+        time.sleep(0.01)
+    # Lets the receivers declare their queue, events sent before are not routed to it
+    time.sleep(0.5)
+
+    with celery_app.connection_for_write() as connection:
+        dispatcher = EventDispatcher(connection, hostname="worker@test", app=celery_app)
+        for i in range(50):
+            for event_type in ("task-sent", "task-received", "task-started", "task-succeeded"):
+                dispatcher.send(event_type, uuid=str(i), name="tasks.add")
+
+    deadline = time.monotonic() + 10
+    while sum(monitor.metrics.counters.values()) < 200 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    monitor.stop()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+
+    events = storage.get_events()
+    assert len(events) == 50
+    assert {event["type"] for event in events} == {"task-succeeded"}
+
+
+def test_monitor_stops_under_load() -> None:
+    """The monitor stops while its receiver is blocked on a full pipeline."""
+
+    class SlowStorage(MemoryStorage):
+        def store_events(self, events: list[dict]) -> None:
+            time.sleep(0.05)
+            super().store_events(events)
+
+    celery_app = Celery("test_monitor", broker="memory://")
+    storage = SlowStorage()
+    monitor = CeleryMonitor(celery_app, storage)
+    monitor.pipelines = [
+        EventPipeline(storage=ThreadedAsyncStorage(storage), queue_size=1, batch_size=1, max_pending_batches=1)
+    ]
+    thread = threading.Thread(target=monitor.start, kwargs={"webapp": False}, daemon=True)
+    thread.start()
+    while len(monitor._receivers) < 1:
+        time.sleep(0.01)
+    time.sleep(0.5)
+
+    with celery_app.connection_for_write() as connection:
+        dispatcher = EventDispatcher(connection, hostname="worker@test", app=celery_app)
+        for i in range(200):
+            dispatcher.send("task-sent", uuid=str(i), name="tasks.add")
+
+    deadline = time.monotonic() + 10
+    while not storage.get_events() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    monitor.stop()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert 0 < len(storage.get_events()) < 200
+
+
+def test_receiver_connecting_while_monitor_stops_stops() -> None:
+    """A receiver that connects after the monitor started stopping doesn't keep consuming."""
+    celery_app = Celery("test_monitor", broker="memory://")
+    monitor = CeleryMonitor(celery_app, MemoryStorage())
+    monitor._receivers_stopping.set()
+
+    with celery_app.connection_for_write() as connection:
+        thread = threading.Thread(target=monitor._receive_events, args=(connection,), daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert monitor._receivers == []
+
+
+def test_monitor_reconnects_and_reports_health(mock_storage: Mock) -> None:
+    """While the broker is unreachable, receivers retry and the health endpoint reports ingestion as down."""
+    celery_app = Celery("test_monitor", broker="redis://127.0.0.1:1/0")
+    monitor = CeleryMonitor(celery_app, mock_storage, reconnect_max_delay=0.05)
+    thread = threading.Thread(target=monitor.start, kwargs={"webapp": False})
+    thread.start()
+    deadline = time.monotonic() + 10
+    while monitor.health.reconnects < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    response = monitor.flask_app.test_client().get("/api/health")
+    monitor.stop()
+    thread.join(timeout=10)
+
+    assert not thread.is_alive()
+    assert response.status_code == 503
+    health = response.get_json()
+    assert health["status"] == "down"
+    assert health["receivers"]["reconnects"] >= 2
+    assert "Connection refused" in health["receivers"]["last_error"]
+
+
+def test_monitor_replays_spool_on_start(tmp_path: Path) -> None:
+    """Events left in the spool by a previous run are stored when the monitor starts."""
+    path = str(tmp_path / "events.spool")
+    spool = EventSpool(path=path)
+    spool.append({"uuid": "1", "type": "task-sent", "name": "tasks.add", "sent_timestamp": 1670000000.0})
+    spool.close()
+
+    storage = MemoryStorage()
+    monitor = CeleryMonitor(Celery("test_monitor", broker="memory://"), storage, spool_path=path)
+    thread = threading.Thread(target=monitor.start, kwargs={"webapp": False})
+    thread.start()
+    while monitor.health.connected < 1:
+        time.sleep(0.01)
+    monitor.stop()
+    thread.join(timeout=10)
+
+    event = storage.get_event_by_id("1")
+    assert event is not None and event["name"] == "tasks.add"
+    assert list(EventSpool(path=path).replay()) == []
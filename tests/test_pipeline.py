@@ -0,0 +1,252 @@
+"""Tests for the asyncio event pipeline"""
+import asyncio
+import threading
+from pathlib import Path
+
+import pytest
+from veggie.bus import EventBus
+from veggie.pipeline import EventPipeline, ThreadedAsyncStorage
+from veggie.spool import EventSpool
+from veggie.storage import MemoryStorage
+
+
+class RecordingStorage:
+    """Async storage that records the stored batches, optionally blocking until released"""
+
+    def __init__(self, blocked: bool = False) -> None:
+        """Initializes the storage"""
+        self.batches: list[list[dict]] = []
+        self.released = asyncio.Event()
+        if not blocked:
+            self.released.set()
+
+    async def store_events(self, events: list[dict]) -> None:
+        """Records a batch once released"""
+        await self.released.wait()
+        self.batches.append(events)
+
+    async def get_event_by_id(self, id: str) -> dict | None:
+        """Not used"""
+        return None
+
+    async def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """Not used"""
+        return []
+
+    async def close(self) -> None:
+        """Not used"""
+
+
+@pytest.mark.asyncio
+async def test_pipeline_batches_events_in_order() -> None:
+    """Received events are stored in batches, in the order they were received."""
+    storage = RecordingStorage()
+    pipeline = EventPipeline(storage=storage, batch_size=3, batch_interval=10)
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0)
+
+    events = [{"uuid": str(i % 2), "type": "task-sent", "sent_timestamp": float(i)} for i in range(7)]
+    for event in events:
+        await pipeline.put(event)
+    await pipeline.stop()
+    await task
+
+    assert [len(batch) for batch in storage.batches] == [3, 3, 1]
+    assert [event for batch in storage.batches for event in batch] == events
+    assert not pipeline.is_running
+
+
+@pytest.mark.asyncio
+async def test_pipeline_flushes_partial_batch_after_interval() -> None:
+    """A batch that isn't full is stored once the batch interval has passed."""
+    storage = RecordingStorage()
+    pipeline = EventPipeline(storage=storage, batch_size=100, batch_interval=0.01)
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0)
+
+    await pipeline.put({"uuid": "1", "type": "task-sent"})
+    await asyncio.sleep(0.1)
+    assert storage.batches == [[{"uuid": "1", "type": "task-sent"}]]
+
+    await pipeline.stop()
+    await task
+
+
+@pytest.mark.asyncio
+async def test_pipeline_publishes_merged_events_after_storing() -> None:
+    """Subscribers get one merged event per task of a batch, only after the batch is stored."""
+    storage = RecordingStorage(blocked=True)
+    event_bus = EventBus()
+    subscriber = event_bus.subscribe()
+    pipeline = EventPipeline(storage=storage, event_bus=event_bus, batch_size=10, batch_interval=10)
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0)
+
+    await pipeline.put({"uuid": "1", "type": "task-succeeded", "succeeded_timestamp": 2.0, "result": "42"})
+    await pipeline.put({"uuid": "1", "type": "task-started", "started_timestamp": 1.0})
+    await pipeline.put({"uuid": "2", "type": "task-sent", "sent_timestamp": 1.0})
+    stopping = asyncio.create_task(pipeline.stop())
+    await asyncio.sleep(0.01)
+    assert subscriber.get_batch(timeout=0, window=0) == ([], 0)
+
+    storage.released.set()
+    await stopping
+    await task
+
+    events, _ = subscriber.get_batch(timeout=0, window=0.01)
+    assert events == [
+        {"uuid": "1", "type": "task-succeeded", "succeeded_timestamp": 2.0, "result": "42", "started_timestamp": 1.0},
+        {"uuid": "2", "type": "task-sent", "sent_timestamp": 1.0},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_applies_backpressure() -> None:
+    """While storage is blocked, the bounded queues fill up and `put()` waits."""
+    storage = RecordingStorage(blocked=True)
+    pipeline = EventPipeline(storage=storage, queue_size=5, batch_size=2, batch_interval=0, max_pending_batches=1)
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0)
+
+    async def _put_all() -> None:
+        for i in range(100):
+            await pipeline.put({"uuid": str(i), "type": "task-sent"})
+
+    producer = asyncio.create_task(_put_all())
+    await asyncio.sleep(0.05)
+    assert not producer.done()
+    assert pipeline.pending()["events"] == 5
+
+    storage.released.set()
+    await producer
+    await pipeline.stop()
+    await task
+    assert sum(len(batch) for batch in storage.batches) == 100
+
+
+@pytest.mark.asyncio
+async def test_pipeline_keeps_running_when_storage_fails() -> None:
+    """A batch that keeps failing to be stored is dropped after its retries without stopping the pipeline."""
+
+    class FailingStorage(RecordingStorage):
+        async def store_events(self, events: list[dict]) -> None:
+            if events[0]["uuid"] == "bad":
+                raise RuntimeError("disk full")
+            await super().store_events(events)
+
+    storage = FailingStorage()
+    pipeline = EventPipeline(storage=storage, batch_size=1, batch_interval=10, retry_delay=0)
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0)
+
+    await pipeline.put({"uuid": "bad"})
+    await pipeline.put({"uuid": "good"})
+    await pipeline.stop()
+    await task
+
+    assert storage.batches == [[{"uuid": "good"}]]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_submit_from_thread() -> None:
+    """Events submitted from another thread go through a synchronous storage."""
+    storage = MemoryStorage()
+    pipeline = EventPipeline(storage=ThreadedAsyncStorage(storage), batch_size=10, batch_interval=0.01)
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0)
+
+    with pytest.raises(RuntimeError):
+        pipeline.submit({"uuid": "1"})
+
+    def submit_events() -> None:
+        for i in range(20):
+            pipeline.submit({"uuid": str(i), "type": "task-sent"})
+
+    thread = threading.Thread(target=submit_events)
+    thread.start()
+    await asyncio.to_thread(thread.join)
+    await pipeline.stop()
+    await task
+
+    assert len(storage.get_events()) == 20
+    with pytest.raises(RuntimeError):
+        pipeline.submit({"uuid": "1"})
+
+
+@pytest.mark.asyncio
+async def test_threaded_async_storage_search() -> None:
+    """The async adapter passes the search to the storage."""
+    storage = MemoryStorage()
+    storage.store_events(
+        [{"uuid": "1", "type": "task-failed", "exception": "KeyError"}, {"uuid": "2", "type": "task-succeeded"}]
+    )
+    events = await ThreadedAsyncStorage(storage).query_events(search="KeyError")
+    assert [event["uuid"] for event in events] == ["1"]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_keeps_failed_batches_in_spool(tmp_path: Path) -> None:
+    """Stored events are marked in the spool, those of a failed batch are set aside for the next run."""
+
+    class FailingStorage(RecordingStorage):
+        async def store_events(self, events: list[dict]) -> None:
+            if events[0]["uuid"] == "bad":
+                raise RuntimeError("disk full")
+            await super().store_events(events)
+
+    spool = EventSpool(path=str(tmp_path / "events.spool"))
+    pipeline = EventPipeline(storage=FailingStorage(), batch_size=1, batch_interval=10, spool=spool, retry_delay=0)
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0)
+
+    await pipeline.put({"uuid": "good"})
+    await pipeline.put({"uuid": "bad"})
+    await pipeline.put({"uuid": "good"})
+    await pipeline.stop()
+    await task
+    # The failed batch doesn't hold back the events stored after it
+    assert spool.pending() == 0
+    spool.close()
+
+    assert list(EventSpool(path=str(tmp_path / "events.spool")).replay()) == [{"uuid": "bad"}]
+
+
+@pytest.mark.asyncio
+async def test_pipeline_retries_failed_batch(tmp_path: Path) -> None:
+    """A batch that fails once is stored on retry, and the spool moves past it."""
+
+    class FlakyStorage(RecordingStorage):
+        failures = 1
+
+        async def store_events(self, events: list[dict]) -> None:
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("database is locked")
+            await super().store_events(events)
+
+    storage = FlakyStorage()
+    spool = EventSpool(path=str(tmp_path / "events.spool"))
+    pipeline = EventPipeline(storage=storage, batch_size=1, batch_interval=10, spool=spool, retry_delay=0.01)
+    task = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0)
+
+    await pipeline.put({"uuid": "1"})
+    await pipeline.put({"uuid": "2"})
+    await pipeline.stop()
+    await task
+    assert storage.batches == [[{"uuid": "1"}], [{"uuid": "2"}]]
+    assert spool.pending() == 0
+    spool.close()
+
+    assert list(EventSpool(path=str(tmp_path / "events.spool")).replay()) == []
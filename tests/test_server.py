@@ -0,0 +1,65 @@
+"""Tests for the web app servers"""
+import threading
+import urllib.request
+
+import pytest
+from flask import Flask
+from veggie.server import ServerConfig, WaitressServer, WerkzeugServer, create_server
+
+
+def _hello_app() -> Flask:
+    """Returns an app with a single route"""
+    app = Flask(__name__)
+    app.add_url_rule("/", endpoint="index", view_func=lambda: "hello")
+    return app
+
+
+def test_werkzeug_server_serves_until_shutdown() -> None:
+    """The server answers requests from its thread and returns from `serve()` once shut down."""
+    server = create_server(app_factory=_hello_app, config=ServerConfig(host="127.0.0.1", port=0))
+    assert isinstance(server, WerkzeugServer)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/", timeout=5) as response:
+        assert response.read() == b"hello"
+
+    server.shutdown()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_waitress_server_serves_until_shutdown() -> None:
+    """The waitress server answers requests and shuts down gracefully."""
+    pytest.importorskip("waitress")
+    server = create_server(app_factory=_hello_app, config=ServerConfig(host="127.0.0.1", port=0, server="waitress"))
+    assert isinstance(server, WaitressServer)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/", timeout=5) as response:
+        assert response.read() == b"hello"
+
+    server.shutdown()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_gunicorn_shutdown_without_serving() -> None:
+    """Shutting down a gunicorn server that isn't serving does nothing."""
+    pytest.importorskip("gunicorn")
+    server = create_server(app_factory=_hello_app, config=ServerConfig(host="127.0.0.1", port=0, server="gunicorn"))
+    server.shutdown()
+
+
+def test_create_server_rejects_unknown_server() -> None:
+    """An unknown server name is an error."""
+    with pytest.raises(ValueError):
+        create_server(app_factory=_hello_app, config=ServerConfig(server="tornado"))
+
+
+def test_stream_limit_defaults_to_three_quarters_of_threads() -> None:
+    """Live event streams leave a quarter of the threads to other requests unless configured."""
+    assert ServerConfig().stream_limit == 48
+    assert ServerConfig(threads=2).stream_limit == 1
+    assert ServerConfig(threads=2, max_streams=5).stream_limit == 5
@@ -0,0 +1,76 @@
+"""Tests for the event spool"""
+from pathlib import Path
+
+from veggie.spool import EventSpool
+
+
+def _event(i: int) -> dict:
+    """Returns the sent event of the i-th task"""
+    return {"uuid": str(i), "type": "task-sent", "sent_timestamp": 1670000000.0 + i}
+
+
+def test_spool_replays_events_not_stored(tmp_path: Path) -> None:
+    """After a restart, only the events after the last contiguous stored one are replayed."""
+    path = str(tmp_path / "events.spool")
+    spool = EventSpool(path=path)
+    tickets = [spool.append(_event(i)) for i in range(5)]
+    # Events 3 is stored before 2, so only the first two are committed
+    spool.mark_stored([tickets[0], tickets[1], tickets[3]])
+    assert spool.pending() == 3
+    spool.close()
+
+    spool = EventSpool(path=path)
+    assert list(spool.replay()) == [_event(2), _event(3), _event(4)]
+
+
+def test_spool_skips_truncated_line(tmp_path: Path) -> None:
+    """A last line cut short by a crash is skipped."""
+    path = tmp_path / "events.spool"
+    spool = EventSpool(path=str(path))
+    spool.append(_event(0))
+    spool.close()
+    with open(path, "a") as file:
+        file.write('{"uuid": "1", "ty')
+
+    assert list(EventSpool(path=str(path)).replay()) == [_event(0)]
+
+
+def test_spool_compacts_stored_events(tmp_path: Path) -> None:
+    """The stored head of the file is dropped once it exceeds max_bytes, keeping the pending events."""
+    path = tmp_path / "events.spool"
+    spool = EventSpool(path=str(path), max_bytes=200)
+    tickets = [spool.append(_event(i)) for i in range(20)]
+    spool.mark_stored(tickets[:15])
+    spool.append(_event(20))
+    spool.close()
+
+    assert path.stat().st_size < 500
+    assert list(EventSpool(path=str(path)).replay()) == [_event(i) for i in range(15, 21)]
+
+
+def test_spool_reset(tmp_path: Path) -> None:
+    """Reset empties the spool."""
+    path = str(tmp_path / "events.spool")
+    spool = EventSpool(path=path)
+    spool.append(_event(0))
+    spool.reset()
+    spool.append(_event(1))
+    spool.close()
+
+    assert list(EventSpool(path=path).replay()) == [_event(1)]
+
+
+def test_spool_replays_failed_events(tmp_path: Path) -> None:
+    """Failed events no longer hold back the committed position, and are replayed until reset."""
+    path = str(tmp_path / "events.spool")
+    spool = EventSpool(path=path)
+    tickets = [spool.append(_event(i)) for i in range(3)]
+    spool.mark_failed([_event(0)], [tickets[0]])
+    spool.mark_stored([tickets[1]])
+    assert spool.pending() == 1
+    spool.close()
+
+    spool = EventSpool(path=path)
+    assert list(spool.replay()) == [_event(0), _event(2)]
+    spool.reset()
+    assert list(spool.replay()) == []
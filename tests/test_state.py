@@ -0,0 +1,46 @@
+"""Tests for the task event merging"""
+from functools import reduce
+from typing import Any
+
+from veggie.state import merge_event, supersedes
+
+
+def test_later_state_supersedes() -> None:
+    started = {"uuid": "1", "type": "task-started", "started_timestamp": 2.0, "hostname": "w1"}
+    succeeded = {"uuid": "1", "type": "task-succeeded", "succeeded_timestamp": 3.0, "runtime": 1.0}
+
+    assert supersedes(succeeded, started)
+    assert not supersedes(started, succeeded)
+    assert merge_event(succeeded, started) == merge_event(started, succeeded) == {**started, **succeeded}
+
+
+def test_earlier_state_only_fills_missing_fields() -> None:
+    started = {"uuid": "1", "type": "task-started", "started_timestamp": 2.0, "hostname": "w1"}
+    received = {"uuid": "1", "type": "task-received", "received_timestamp": 1.0, "hostname": "w2", "name": "add"}
+
+    assert merge_event(started, received) == {**started, "received_timestamp": 1.0, "name": "add"}
+
+
+def test_same_state_ordered_by_timestamp() -> None:
+    first = {"uuid": "1", "type": "task-started", "started_timestamp": 2.0, "pid": 1}
+    second = {"uuid": "1", "type": "task-started", "started_timestamp": 5.0, "pid": 2}
+
+    assert merge_event(second, first)["pid"] == 2
+    assert merge_event(first, second)["pid"] == 2
+
+
+def test_retry_ordered_by_timestamp() -> None:
+    events = [
+        {"uuid": "1", "type": "task-started", "started_timestamp": 1.0},
+        {"uuid": "1", "type": "task-retried", "retried_timestamp": 2.0, "exception": "Timeout()"},
+        {"uuid": "1", "type": "task-received", "received_timestamp": 3.0},
+    ]
+    initial: dict[str, Any] = {}
+
+    assert reduce(merge_event, events, initial)["type"] == "task-received"
+    assert reduce(merge_event, [events[0], events[2], events[1]], initial)["type"] == "task-retried"
+    assert reduce(merge_event, [events[1], events[0]], initial)["type"] == "task-retried"
+
+
+def test_events_without_type_are_merged_in_order() -> None:
+    assert merge_event({"uuid": "1", "a": 1}, {"uuid": "1", "a": 2}) == {"uuid": "1", "a": 2}
@@ -1,12 +1,25 @@
 """Tests for the Storage classes"""
+import itertools
 import json
+import random
 import sqlite3
 import tempfile
+import threading
+import time
 from pathlib import Path
 from typing import Any
 
 import pytest
-from veggie.storage import SQLiteStorage, Storage
+from veggie.state import merge_event
+from veggie.storage import (
+    BufferedStorage,
+    CachedStorage,
+    MemoryStorage,
+    PartitionedSQLiteStorage,
+    RetentionPolicy,
+    SQLiteStorage,
+    Storage,
+)
 
 
 @pytest.fixture
@@ -22,6 +35,16 @@ def sqlite_storage(temp_db_path: str) -> Storage:
     return SQLiteStorage(path=temp_db_path)
 
 
+@pytest.fixture(params=["sqlite", "memory", "partitioned"])
+def storage(request: pytest.FixtureRequest, temp_db_path: str, tmp_path: Path) -> Storage:
+    """Returns each storage backend, for the tests that all backends must pass."""
+    if request.param == "memory":
+        return MemoryStorage()
+    if request.param == "partitioned":
+        return PartitionedSQLiteStorage(directory=str(tmp_path / "partitions"), partition="hour")
+    return SQLiteStorage(path=temp_db_path)
+
+
 def test_store_event_new(sqlite_storage: SQLiteStorage) -> None:
     """Test storing a new event."""
     event = {"uuid": "12345", "name": "task_completed", "sent_timestamp": 1670000000.0, "data": {"result": "success"}}
@@ -56,32 +79,40 @@ def test_store_event_update(sqlite_storage: SQLiteStorage) -> None:
         assert json.loads(row[0]) == updated_event
 
 
-def test_get_events(sqlite_storage: SQLiteStorage) -> None:
+def test_sqlite_storage_requires_json_operators(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """An SQLite library without the JSON operators is rejected with its version, before opening the database."""
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", (3, 37, 2))
+    with pytest.raises(RuntimeError, match="requires SQLite 3.38.0"):
+        SQLiteStorage(path=str(tmp_path / "events.db"))
+    assert not (tmp_path / "events.db").exists()
+
+
+def test_get_events(storage: Storage) -> None:
     """Test retrieving all events."""
     events = [
         {"uuid": "1", "name": "task_1", "sent_timestamp": 1670000000.0, "data": {"result": "success"}},
         {"uuid": "2", "name": "task_2", "sent_timestamp": 1670000001.0, "data": {"result": "failure"}},
     ]
     for event in events:
-        sqlite_storage.store_event(event)
+        storage.store_event(event)
 
-    retrieved_events = sqlite_storage.get_events()
+    retrieved_events = storage.get_events()
     assert len(retrieved_events) == len(events)
     assert retrieved_events[0]["uuid"] == "2"  # Check sorting by sent_timestamp
 
 
-def test_get_event_by_id(sqlite_storage: SQLiteStorage) -> None:
+def test_get_event_by_id(storage: Storage) -> None:
     """Test retrieving a single event by its UUID."""
     event = {"uuid": "12345", "name": "task_completed", "sent_timestamp": 1670000000.0, "data": {"result": "success"}}
-    sqlite_storage.store_event(event)
+    storage.store_event(event)
 
-    retrieved_event = sqlite_storage.get_event_by_id("12345")
+    retrieved_event = storage.get_event_by_id("12345")
     assert retrieved_event == event
 
 
-def test_get_event_by_id_not_found(sqlite_storage: SQLiteStorage) -> None:
+def test_get_event_by_id_not_found(storage: Storage) -> None:
     """Test retrieving a non-existent event by its UUID."""
-    retrieved_event = sqlite_storage.get_event_by_id("non_existent_uuid")
+    retrieved_event = storage.get_event_by_id("non_existent_uuid")
     assert retrieved_event is None
 
 
@@ -105,3 +136,792 @@ def test_index_creation(sqlite_storage: SQLiteStorage) -> None:
         index_names = [index[1] for index in indexes]
         assert "idx_name" in index_names
         assert "idx_sent_timestamp" in index_names
+
+
+def test_store_events_batch(storage: Storage) -> None:
+    """Test storing a batch of events, including several events of the same task."""
+    events = [
+        {"uuid": "1", "name": "task_1", "type": "task-sent", "sent_timestamp": 1670000000.0},
+        {"uuid": "2", "name": "task_2", "type": "task-sent", "sent_timestamp": 1670000001.0},
+        {"uuid": "1", "type": "task-started", "started_timestamp": 1670000002.0},
+    ]
+    storage.store_events(events)
+
+    assert storage.get_event_by_id("1") == {
+        "uuid": "1",
+        "name": "task_1",
+        "type": "task-started",
+        "sent_timestamp": 1670000000.0,
+        "started_timestamp": 1670000002.0,
+    }
+    assert len(storage.get_events()) == 2
+
+
+def test_buffered_storage_flushes_on_close(storage: Storage) -> None:
+    """Test that buffered events are written when the storage is closed."""
+    buffered_storage = BufferedStorage(storage=storage, batch_size=100, flush_interval=60)
+    for i in range(10):
+        buffered_storage.store_event({"uuid": str(i), "name": "task", "sent_timestamp": 1670000000.0 + i})
+
+    assert buffered_storage.lag()["pending_events"] == 10
+    assert storage.get_events() == []
+
+    buffered_storage.close()
+    assert len(storage.get_events()) == 10
+    assert buffered_storage.lag() == {"pending_events": 0, "lag_seconds": 0.0, "flushed_events": 10}
+
+
+def test_buffered_storage_flushes_full_batches(storage: Storage) -> None:
+    """Test that a full batch is written without waiting for the flush interval."""
+    buffered_storage = BufferedStorage(storage=storage, batch_size=5, flush_interval=60)
+    for i in range(5):
+        buffered_storage.store_event({"uuid": str(i), "name": "task", "sent_timestamp": 1670000000.0 + i})
+
+    deadline = time.monotonic() + 5
+    while buffered_storage.lag()["flushed_events"] < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert len(storage.get_events()) == 5
+    buffered_storage.close()
+
+
+def test_buffered_storage_flush(storage: Storage) -> None:
+    """Test that flush blocks until queued events are readable."""
+    buffered_storage = BufferedStorage(storage=storage, batch_size=100, flush_interval=60)
+    buffered_storage.store_event({"uuid": "1", "name": "task", "sent_timestamp": 1670000000.0})
+    buffered_storage.flush()
+
+    assert buffered_storage.get_event_by_id("1") == {"uuid": "1", "name": "task", "sent_timestamp": 1670000000.0}
+    buffered_storage.close()
+
+
+def test_buffered_storage_retries_failed_batches() -> None:
+    """Test that a batch the wrapped storage fails to store, e.g. while the database is locked, is retried."""
+
+    class LockedStorage(MemoryStorage):
+        failures = 2
+
+        def store_events(self, events: list[dict]) -> None:
+            if self.failures:
+                self.failures -= 1
+                raise sqlite3.OperationalError("database is locked")
+            super().store_events(events)
+
+    storage = LockedStorage()
+    buffered_storage = BufferedStorage(storage=storage, batch_size=100, flush_interval=60, retry_delay=0.01)
+    buffered_storage.store_event({"uuid": "1", "name": "task", "sent_timestamp": 1670000000.0})
+    buffered_storage.flush()
+
+    assert storage.get_event_by_id("1") is not None
+    buffered_storage.close()
+
+
+def _lifecycle_events(final_state: str) -> list[dict]:
+    """Returns the events of a task lifecycle, shaped like the events produced by the monitor."""
+    common = {"uuid": "abc", "hostname": "celery@worker", "utcoffset": 0, "pid": 42, "local_received": 1670000000.5}
+    events = [
+        {
+            **common,
+            "type": "task-sent",
+            "name": "run_model",
+            "args": "()",
+            "kwargs": "{'model_name': 'foo'}",
+            "retries": 0,
+            "eta": None,
+            "expires": None,
+            "queue": "celery",
+            "exchange": "",
+            "routing_key": "celery",
+            "root_id": "abc",
+            "parent_id": None,
+            "clock": 1,
+            "sent_timestamp": 1670000000.0,
+        },
+        {
+            **common,
+            "type": "task-received",
+            "name": "run_model",
+            "args": "()",
+            "kwargs": "{'model_name': 'foo'}",
+            "retries": 0,
+            "eta": None,
+            "expires": None,
+            "root_id": "abc",
+            "parent_id": None,
+            "clock": 2,
+            "received_timestamp": 1670000001.0,
+        },
+        {**common, "type": "task-started", "clock": 3, "started_timestamp": 1670000002.0},
+    ]
+    if final_state == "succeeded":
+        events.append(
+            {
+                **common,
+                "type": "task-succeeded",
+                "result": "{'prediction': 0.85, 'model_name': 'foo'}",
+                "runtime": 1.25,
+                "clock": 4,
+                "succeeded_timestamp": 1670000003.25,
+            }
+        )
+    else:
+        events.append(
+            {
+                **common,
+                "type": "task-failed",
+                "exception": "ValueError('boom')",
+                "traceback": 'Traceback (most recent call last):\n  File "tasks.py"\nValueError: boom',
+                "clock": 4,
+                "failed_timestamp": 1670000003.25,
+            }
+        )
+    return events
+
+
+@pytest.mark.parametrize("final_state", ["succeeded", "failed"])
+def test_store_event_merge_matches_dict_update(storage: Storage, final_state: str) -> None:
+    """Test that merging in SQL gives the same document as merging the events with dict.update."""
+    expected: dict = {}
+    for event in _lifecycle_events(final_state):
+        storage.store_event(event)
+        expected.update(event)
+        assert storage.get_event_by_id("abc") == expected
+
+
+@pytest.mark.parametrize("final_state", ["succeeded", "failed"])
+def test_store_event_merge_out_of_order(temp_db_path: str, final_state: str) -> None:
+    """Test that events stored in any order merge like the Python reducer and keep the final state."""
+    events = _lifecycle_events(final_state)
+    for i, permutation in enumerate(itertools.permutations(events)):
+        storage = SQLiteStorage(path=f"{temp_db_path}.{i}")
+        expected: dict = {}
+        for event in permutation:
+            storage.store_event(event)
+            expected = merge_event(expected, event)
+        assert storage.get_event_by_id("abc") == expected
+        assert expected["type"] == f"task-{final_state}"
+        storage.close()
+
+
+def test_store_event_merge_keeps_value_types(storage: Storage) -> None:
+    """Test that nulls, booleans, nested objects and arrays survive the merge unchanged."""
+    first = {"uuid": "1", "flag": True, "options": {"a": 1, "b": [1, 2]}, "items": [1, None, "x"], "eta": None}
+    second = {"uuid": "1", "flag": False, "options": {"a": 2}, "expires": None, "text": 'quote " and é'}
+    storage.store_event(first)
+    storage.store_event(second)
+
+    assert storage.get_event_by_id("1") == {**first, **second}
+
+
+def test_connection_settings(sqlite_storage: SQLiteStorage) -> None:
+    """Test that connections use WAL journaling and the configured pragmas."""
+    with sqlite_storage._get_connection() as con:
+        assert con.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert con.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert con.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+        assert con.execute("PRAGMA cache_size").fetchone()[0] == -65536
+
+
+def test_connection_pool(temp_db_path: str) -> None:
+    """Test that threads share at most `max_connections` connections, waiting while all are in use."""
+    storage = SQLiteStorage(path=temp_db_path, max_connections=2)
+    storage.store_event({"uuid": "1", "name": "task", "sent_timestamp": 1670000000.0})
+
+    # Both connections are in use, so a read from another thread waits for one of them
+    results: list[dict | None] = []
+    thread = threading.Thread(target=lambda: results.append(storage.get_event_by_id("1")))
+    with storage._get_connection():
+        with storage._get_connection():
+            thread.start()
+            thread.join(timeout=0.2)
+            assert thread.is_alive()
+        thread.join(timeout=5)
+        assert results == [{"uuid": "1", "name": "task", "sent_timestamp": 1670000000.0}]
+
+    # Threads started per request, like those of the web server, reuse the pooled connections
+    for _ in range(10):
+        reader = threading.Thread(target=storage.get_events)
+        reader.start()
+        reader.join()
+    assert storage._open_connections == 2
+    storage.close()
+    assert storage._open_connections == 0
+
+
+def test_read_during_write(sqlite_storage: SQLiteStorage) -> None:
+    """Test that reads from another thread are not blocked by an open write transaction."""
+    sqlite_storage.store_event({"uuid": "1", "name": "task_1", "sent_timestamp": 1670000000.0})
+
+    results = []
+    with sqlite_storage._get_connection() as con:
+        con.execute("INSERT INTO events (uuid, data) VALUES ('2', '{}')")
+        thread = threading.Thread(target=lambda: results.append(sqlite_storage.get_events()))
+        thread.start()
+        thread.join()
+
+    assert [event["uuid"] for event in results[0]] == ["1"]
+
+
+def test_close(sqlite_storage: SQLiteStorage) -> None:
+    """Test that the storage can still be used after its connections are closed."""
+    sqlite_storage.close()
+    sqlite_storage.store_event({"uuid": "1", "name": "task_1", "sent_timestamp": 1670000000.0})
+    assert sqlite_storage.get_event_by_id("1") is not None
+
+
+def test_query_events_pages(storage: Storage) -> None:
+    """Test paging through all events with a keyset cursor, including events without a sent timestamp."""
+    for i in range(7):
+        storage.store_event({"uuid": f"{i}", "name": "task", "sent_timestamp": 1670000000.0 + i // 2})
+    for i in range(3):
+        storage.store_event({"uuid": f"n{i}", "name": "task", "received_timestamp": 1670000000.0})
+
+    def all_pages(order: str) -> list[str]:
+        uuids: list[str] = []
+        after = None
+        while True:
+            page = storage.query_events(limit=3, after=after, order=order)
+            uuids.extend(event["uuid"] for event in page)
+            if len(page) < 3:
+                return uuids
+            after = (page[-1].get("sent_timestamp"), page[-1]["uuid"])
+
+    assert all_pages(order="desc") == ["6", "5", "4", "3", "2", "1", "0", "n2", "n1", "n0"]
+    assert all_pages(order="asc") == ["n0", "n1", "n2", "0", "1", "2", "3", "4", "5", "6"]
+
+
+def test_query_events_filters(storage: Storage) -> None:
+    """Test filtering events by name, state, hostname and time range."""
+    storage.store_events(
+        [
+            {"uuid": "1", "name": "a", "type": "task-failed", "hostname": "w1", "sent_timestamp": 1670000000.0},
+            {"uuid": "2", "name": "a", "type": "task-succeeded", "hostname": "w2", "sent_timestamp": 1670000001.0},
+            {"uuid": "3", "name": "b", "type": "task-failed", "hostname": "w1", "sent_timestamp": 1670000002.0},
+        ]
+    )
+
+    def uuids(**filters: Any) -> list[str]:
+        return [event["uuid"] for event in storage.query_events(**filters)]
+
+    assert uuids(name="a") == ["2", "1"]
+    assert uuids(state="task-failed") == ["3", "1"]
+    assert uuids(hostname="w2") == ["2"]
+    assert uuids(sent_after=1670000001.0) == ["3", "2"]
+    assert uuids(sent_before=1670000001.0) == ["1"]
+    assert uuids(name="a", state="task-failed", hostname="w1") == ["1"]
+
+
+def test_iter_events(storage: Storage) -> None:
+    """Test iterating over all events in batches, in the order of the pages and after a cursor."""
+    for i in range(7):
+        storage.store_event({"uuid": f"{i}", "name": "a" if i % 2 else "b", "sent_timestamp": 1670000000.0 + i})
+    storage.store_event({"uuid": "n0", "name": "a", "received_timestamp": 1670000000.0})
+
+    def uuids(**kwargs: Any) -> list[str]:
+        return [event["uuid"] for event in storage.iter_events(batch_size=2, **kwargs)]
+
+    assert uuids() == ["6", "5", "4", "3", "2", "1", "0", "n0"]
+    assert uuids(order="asc") == ["n0", "0", "1", "2", "3", "4", "5", "6"]
+    assert uuids(name="a") == ["5", "3", "1", "n0"]
+    assert uuids(after=(1670000003.0, "3")) == ["2", "1", "0", "n0"]
+    assert uuids(after=(None, "n0"), order="asc") == ["0", "1", "2", "3", "4", "5", "6"]
+    # The default implementation, paging with query_events()
+    assert list(Storage.iter_events(storage, batch_size=3)) == list(storage.iter_events())
+
+
+def test_query_events_search(storage: Storage) -> None:
+    """Test searching words in the arguments, results and exceptions of tasks."""
+    storage.store_events(
+        [
+            {"uuid": "1", "type": "task-received", "args": "(12345,)", "kwargs": "{'order_id': 12345}"},
+            {"uuid": "2", "type": "task-received", "args": "(123,)", "kwargs": "{'order_id': 123}"},
+            {"uuid": "3", "type": "task-failed", "exception": "KeyError('customer')", "traceback": "File tasks.py"},
+        ]
+    )
+    storage.store_event({"uuid": "2", "type": "task-succeeded", "result": "'shipped'"})
+
+    def uuids(search: str) -> list[str]:
+        return sorted(event["uuid"] for event in storage.query_events(search=search))
+
+    assert uuids("12345") == ["1"]
+    assert uuids("order_id=123") == ["2"]
+    assert uuids("123*") == ["1", "2"]
+    assert uuids("keyerror CUSTOMER") == ["3"]
+    assert uuids("shipped") == ["2"]
+    assert uuids('tasks.py "') == ["3"]
+    assert uuids("12345 shipped") == []
+    assert uuids("*") == ["1", "2", "3"]
+
+
+def test_search_index_follows_events(temp_db_path: str) -> None:
+    """Test that the search index is built for existing events and kept in sync by updates and deletions."""
+    storage = SQLiteStorage(path=temp_db_path, use_search=False)
+    storage.store_event({"uuid": "1", "sent_timestamp": time.time() - 100, "result": "'first'"})
+    storage.close()
+
+    storage = SQLiteStorage(path=temp_db_path)
+    assert [event["uuid"] for event in storage.query_events(search="first")] == ["1"]
+    storage.store_event({"uuid": "1", "type": "task-succeeded", "result": "'second'"})
+    storage.store_event({"uuid": "2", "sent_timestamp": time.time(), "result": "'second'"})
+    assert storage.query_events(search="first") == []
+    storage.prune(RetentionPolicy(max_age=50))
+    assert [event["uuid"] for event in storage.query_events(search="second")] == ["2"]
+    with storage._get_connection() as con:
+        con.execute(f"INSERT INTO {storage.SEARCH_TABLE} ({storage.SEARCH_TABLE}) VALUES ('integrity-check')")
+
+
+def test_auto_vacuum_incremental(sqlite_storage: SQLiteStorage) -> None:
+    """Test that new databases are created with incremental vacuum."""
+    with sqlite3.connect(sqlite_storage.path) as con:
+        assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2  # INCREMENTAL
+
+
+def test_prune_max_age(temp_db_path: str) -> None:
+    """Test deleting events older than the maximum age, in several batches."""
+    sqlite_storage = SQLiteStorage(path=temp_db_path, prune_batch_size=2)
+    now = time.time()
+    for i in range(5):
+        sqlite_storage.store_event({"uuid": f"old{i}", "type": "task-succeeded", "sent_timestamp": now - 7200})
+    sqlite_storage.store_event({"uuid": "old_received", "type": "task-started", "received_timestamp": now - 7200})
+    sqlite_storage.store_event({"uuid": "new", "type": "task-succeeded", "sent_timestamp": now})
+
+    assert sqlite_storage.prune(RetentionPolicy(max_age=3600)) == 6
+    assert [event["uuid"] for event in sqlite_storage.get_events()] == ["new"]
+
+
+def test_prune_reclaims_space(temp_db_path: str) -> None:
+    """Test that pruning gives the pages of deleted events back to the OS."""
+    sqlite_storage = SQLiteStorage(path=temp_db_path, use_search=False)
+    now = time.time()
+    sqlite_storage.store_events(
+        [
+            {"uuid": str(i), "type": "task-succeeded", "sent_timestamp": now - 7200, "result": "x" * 1000}
+            for i in range(5000)
+        ]
+    )
+    sqlite_storage.store_event({"uuid": "new", "type": "task-succeeded", "sent_timestamp": now})
+    with sqlite_storage._get_connection() as con:
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = Path(temp_db_path).stat().st_size
+
+    assert sqlite_storage.prune(RetentionPolicy(max_age=3600)) == 5000
+    with sqlite_storage._get_connection() as con:
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        assert con.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert Path(temp_db_path).stat().st_size < size / 10
+
+
+def test_prune_max_age_by_state(storage: Storage) -> None:
+    """Test keeping failed events longer than other events."""
+    now = time.time()
+    storage.store_event({"uuid": "succeeded", "type": "task-succeeded", "sent_timestamp": now - 7200})
+    storage.store_event({"uuid": "failed", "type": "task-failed", "sent_timestamp": now - 7200})
+    storage.store_event({"uuid": "old_failed", "type": "task-failed", "sent_timestamp": now - 86400 * 2})
+
+    policy = RetentionPolicy(max_age=3600, max_age_by_state={"task-failed": 86400})
+    assert storage.prune(policy) == 2
+    assert [event["uuid"] for event in storage.get_events()] == ["failed"]
+
+
+def test_prune_max_events(storage: Storage) -> None:
+    """Test keeping only the newest events."""
+    for i in range(5):
+        storage.store_event({"uuid": str(i), "sent_timestamp": 1670000000.0 + i})
+    storage.store_event({"uuid": "not_sent", "received_timestamp": 1670000000.0})
+
+    assert storage.prune(RetentionPolicy(max_events=3)) == 3
+    assert [event["uuid"] for event in storage.get_events()] == ["4", "3", "2"]
+
+
+def test_generated_columns(sqlite_storage: SQLiteStorage) -> None:
+    """Test that the queried task fields are available as columns."""
+    for event in _lifecycle_events("succeeded"):
+        sqlite_storage.store_event(event)
+
+    with sqlite3.connect(sqlite_storage.path) as con:
+        row = con.execute(
+            "SELECT state, hostname, received_timestamp, started_timestamp, finished_timestamp, runtime, root_id "
+            "FROM events WHERE uuid = 'abc'"
+        ).fetchone()
+    assert row == ("task-succeeded", "celery@worker", 1670000001.0, 1670000002.0, 1670000003.25, 1.25, "abc")
+
+
+def test_migrate_old_schema(temp_db_path: str) -> None:
+    """Test that a database created by an older version gets the new columns and indexes, without obsolete ones."""
+    with sqlite3.connect(temp_db_path) as con:
+        con.execute(
+            """
+                CREATE TABLE events (
+                    uuid TEXT,
+                    data JSON,
+                    name TEXT GENERATED ALWAYS AS (json_extract(data, '$.name')) VIRTUAL,
+                    sent_timestamp REAL GENERATED ALWAYS AS (json_extract(data, '$.sent_timestamp')) VIRTUAL,
+                PRIMARY KEY (uuid)
+                )
+            """
+        )
+        con.execute("CREATE INDEX idx_name ON events (name)")
+        con.execute("CREATE INDEX idx_sent_timestamp ON events (sent_timestamp)")
+        con.execute("CREATE INDEX idx_finished_timestamp ON events (sent_timestamp, name)")
+        con.execute(
+            "INSERT INTO events (uuid, data) VALUES (?, ?)",
+            ("1", json.dumps({"uuid": "1", "name": "task", "type": "task-failed", "sent_timestamp": 1670000000.0})),
+        )
+
+    sqlite_storage = SQLiteStorage(path=temp_db_path)
+
+    assert [event["uuid"] for event in sqlite_storage.query_events(state="task-failed")] == ["1"]
+    with sqlite3.connect(temp_db_path) as con:
+        assert [row[2] for row in con.execute("PRAGMA index_info(idx_name)")] == ["name", "sent_timestamp", "uuid"]
+        assert not list(con.execute("PRAGMA index_info(idx_finished_timestamp)"))
+        assert [row[2] for row in con.execute("PRAGMA index_info(idx_state)")] == ["state", "sent_timestamp", "uuid"]
+
+
+def _store_random_tasks(storage: Storage, count: int = 300) -> None:
+    """Stores tasks with random names, hosts, states and timings."""
+    rng = random.Random(0)
+    for i in range(count):
+        sent_timestamp = 1670000000.0 + rng.uniform(0, 600)
+        event = {
+            "uuid": str(i),
+            "name": rng.choice(["a", "b"]),
+            "hostname": rng.choice(["w1", "w2"]),
+            "type": rng.choice(["task-sent", "task-started", "task-succeeded", "task-failed"]),
+            "sent_timestamp": sent_timestamp,
+        }
+        if event["type"] != "task-sent":
+            event["received_timestamp"] = sent_timestamp + rng.uniform(0, 5)
+        if event["type"] == "task-succeeded":
+            event["runtime"] = rng.uniform(0, 10)
+        storage.store_event(event)
+
+
+@pytest.mark.parametrize("group_by", [(), ("name",), ("name", "hostname")])
+def test_get_stats_matches_python(temp_db_path: str, group_by: tuple[str, ...]) -> None:
+    """Test that the SQL aggregation gives the same results as the default implementation."""
+    sqlite_storage = SQLiteStorage(path=temp_db_path, use_rollups=False)
+    _store_random_tasks(sqlite_storage)
+    sqlite_storage.store_event({"uuid": "custom", "type": "task-progress", "name": "a", "sent_timestamp": 1670000100.0})
+
+    kwargs: dict = {"start": 1670000060.0, "end": 1670000540.0, "bucket_seconds": 120, "group_by": group_by}
+    stats = sqlite_storage.get_stats(**kwargs)
+    expected = Storage.get_stats(sqlite_storage, **kwargs)
+
+    assert len(stats) == len(expected) > 0
+    assert any("unknown" in row["states"] for row in expected)
+    for row, expected_row in zip(stats, expected, strict=True):
+        assert row["runtime"] == pytest.approx(expected_row["runtime"])
+        assert row["queue_wait"] == pytest.approx(expected_row["queue_wait"])
+        assert {**row, "runtime": None, "queue_wait": None} == {**expected_row, "runtime": None, "queue_wait": None}
+
+
+def test_get_stats(storage: Storage) -> None:
+    """Test counts, failure ratio and percentiles of a single bucket."""
+    for i in range(10):
+        storage.store_event(
+            {
+                "uuid": str(i),
+                "name": "a",
+                "type": "task-failed" if i == 0 else "task-succeeded",
+                "sent_timestamp": 1670000000.0 + i,
+                "received_timestamp": 1670000001.0 + i,
+                "runtime": float(i + 1),
+            }
+        )
+
+    (row,) = storage.get_stats(start=1670000000.0, end=1670000060.0, bucket_seconds=60)
+    assert row["bucket"] == 1670000000 - 1670000000 % 60
+    assert row["name"] == "a"
+    assert row["count"] == 10
+    assert row["states"] == {"task-failed": 1, "task-succeeded": 9}
+    assert row["failure_ratio"] == 0.1
+    assert row["runtime"] == {"avg": 5.5, "p50": 5.0, "p95": 10.0, "p99": 10.0}
+    assert row["queue_wait"]["p50"] == 1.0
+
+
+def test_get_stats_invalid_group_by(sqlite_storage: SQLiteStorage) -> None:
+    """Test that stats can't be grouped by arbitrary columns."""
+    with pytest.raises(ValueError):
+        sqlite_storage.get_stats(start=0, end=1, group_by=("data",))
+
+
+@pytest.mark.parametrize("group_by", [(), ("name",)])
+@pytest.mark.parametrize("bucket_seconds", [60, 3600])
+def test_get_stats_from_rollups(
+    sqlite_storage: SQLiteStorage, temp_db_path: str, group_by: tuple[str, ...], bucket_seconds: int
+) -> None:
+    """Test that stats served from rollups match the ones computed from the events, apart from percentiles."""
+    _store_random_tasks(sqlite_storage)
+    # Updates move tasks between states and give them a runtime after they were counted
+    for i in range(0, 300, 7):
+        sqlite_storage.store_event({"uuid": str(i), "type": "task-succeeded", "runtime": 0.2})
+    # Custom states are counted as unknown by both
+    sqlite_storage.store_event({"uuid": "custom", "type": "task-progress", "name": "a", "sent_timestamp": 1670000100.0})
+    raw_storage = SQLiteStorage(path=temp_db_path + ".raw", use_rollups=False)
+    raw_storage.store_events(sqlite_storage.get_events())
+
+    # Neither end of the range is aligned to the rollup buckets
+    kwargs: dict = {"start": 1669999990.0, "end": 1670000530.5, "bucket_seconds": bucket_seconds, "group_by": group_by}
+    stats = sqlite_storage.get_stats(**kwargs)
+    expected = raw_storage.get_stats(**kwargs)
+
+    assert len(stats) == len(expected) > 0
+    assert any("unknown" in row["states"] for row in expected)
+    for row, expected_row in zip(stats, expected, strict=True):
+        assert row["percentiles_estimated"] and not expected_row["percentiles_estimated"]
+        ignored = {"runtime": None, "queue_wait": None, "percentiles_estimated": None}
+        assert {**row, **ignored} == {**expected_row, **ignored}
+        for metric in ("runtime", "queue_wait"):
+            assert row[metric]["avg"] == pytest.approx(expected_row[metric]["avg"])
+            for percentile in ("p50", "p95", "p99"):
+                assert row[metric][percentile] >= expected_row[metric][percentile]
+
+
+def test_rollups_follow_state_changes(sqlite_storage: SQLiteStorage) -> None:
+    """Test that a task is counted once, in its latest state."""
+    for event in _lifecycle_events("succeeded"):
+        sqlite_storage.store_event(event)
+
+    with sqlite3.connect(sqlite_storage.path) as con:
+        rows = con.execute("SELECT bucket, name, sent, started, succeeded, runtime_count FROM rollup_minute").fetchall()
+    assert rows == [(1670000000 - 1670000000 % 60, "run_model", 0, 0, 1, 1)]
+
+
+def test_rollups_follow_prune(sqlite_storage: SQLiteStorage, temp_db_path: str) -> None:
+    """Test that stats served from rollups still match the events after retention deleted some of them."""
+    _store_random_tasks(sqlite_storage)
+    failed_cutoff = time.time() - 1670000300.0
+    policy = RetentionPolicy(max_events=200, max_age_by_state={"task-failed": failed_cutoff})
+    assert sqlite_storage.prune(policy) == 100
+    raw_storage = SQLiteStorage(path=temp_db_path + ".raw", use_rollups=False)
+    raw_storage.store_events(sqlite_storage.get_events())
+
+    kwargs: dict = {"start": 1669999980.0, "end": 1670000640.0, "bucket_seconds": 60}
+    stats = sqlite_storage.get_stats(**kwargs)
+    expected = raw_storage.get_stats(**kwargs)
+    assert [(row["bucket"], row["name"], row["states"]) for row in stats] == [
+        (row["bucket"], row["name"], row["states"]) for row in expected
+    ]
+    with sqlite3.connect(sqlite_storage.path) as con:
+        assert con.execute("SELECT sum(sent + started + succeeded + failed) FROM rollup_hour").fetchone()[0] == len(
+            sqlite_storage.get_events()
+        )
+        assert (
+            con.execute("SELECT count(*) FROM rollup_minute WHERE sent + started + succeeded + failed = 0").fetchone()[
+                0
+            ]
+            == 0
+        )
+
+
+def test_rebuild_rollups(sqlite_storage: SQLiteStorage) -> None:
+    """Test that rebuilding the rollups from the events gives the incrementally maintained ones."""
+    _store_random_tasks(sqlite_storage)
+    with sqlite3.connect(sqlite_storage.path) as con:
+        maintained = con.execute("SELECT * FROM rollup_hour ORDER BY bucket, name").fetchall()
+        con.execute("DELETE FROM rollup_hour")
+
+    sqlite_storage.rebuild_rollups()
+
+    with sqlite3.connect(sqlite_storage.path) as con:
+        rebuilt = con.execute("SELECT * FROM rollup_hour ORDER BY bucket, name").fetchall()
+    assert len(rebuilt) == len(maintained) > 0
+    for row, maintained_row in zip(rebuilt, maintained, strict=True):
+        assert row == pytest.approx(maintained_row)
+
+
+def test_cached_storage_get_event_by_id(sqlite_storage: SQLiteStorage) -> None:
+    """Test that lookups are cached and that events of cached tasks are merged into them."""
+    storage = CachedStorage(storage=sqlite_storage)
+    events = _lifecycle_events("succeeded")
+    storage.store_event(events[0])
+
+    assert storage.get_event_by_id("abc") == sqlite_storage.get_event_by_id("abc")
+    assert storage.get_event_by_id("missing") is None
+    for event in reversed(events[1:]):
+        storage.store_event(event)
+        assert storage.get_event_by_id("abc") == sqlite_storage.get_event_by_id("abc")
+    assert storage.cache_info() == {"hits": 3, "misses": 2, "size": 1, "max_size": 10000}
+
+
+def test_cached_storage_evicts_least_recently_used(sqlite_storage: SQLiteStorage) -> None:
+    """Test that the cache keeps at most `max_size` tasks, evicting the least recently used first."""
+    storage = CachedStorage(storage=sqlite_storage, max_size=2)
+    for i in range(3):
+        storage.store_event({"uuid": str(i), "type": "task-sent", "sent_timestamp": 1670000000.0 + i})
+    storage.get_event_by_id("0")
+    storage.get_event_by_id("1")
+    storage.get_event_by_id("0")
+    storage.get_event_by_id("2")
+
+    assert list(storage._cache) == ["0", "2"]
+
+
+def test_cached_storage_recent_page(sqlite_storage: SQLiteStorage) -> None:
+    """Test that the first page is served from memory and follows new and updated tasks."""
+    storage = CachedStorage(storage=sqlite_storage, recent_size=20)
+    _store_random_tasks(storage, count=50)
+    assert storage.query_events(limit=10) == sqlite_storage.query_events(limit=10)
+    misses = storage.cache_info()["misses"]
+
+    storage.store_event({"uuid": "new", "type": "task-sent", "name": "a", "sent_timestamp": 1670001000.0})
+    storage.store_event({"uuid": "late", "type": "task-received", "received_timestamp": 1670001001.0})
+    storage.store_event({"uuid": "late", "type": "task-sent", "name": "b", "sent_timestamp": 1670001002.0})
+    storage.store_event({"uuid": "new", "type": "task-started", "started_timestamp": 1670001003.0})
+    for limit in [10, 20]:
+        assert storage.query_events(limit=limit) == sqlite_storage.query_events(limit=limit)
+    assert storage.cache_info()["misses"] == misses + 2
+
+    assert storage.query_events(limit=5, name="a") == sqlite_storage.query_events(limit=5, name="a")
+    assert storage.query_events(limit=30) == sqlite_storage.query_events(limit=30)
+
+
+def test_cached_storage_prune(sqlite_storage: SQLiteStorage) -> None:
+    """Test that pruning clears the cache."""
+    storage = CachedStorage(storage=sqlite_storage)
+    storage.store_event({"uuid": "1", "type": "task-sent", "sent_timestamp": 1.0})
+    storage.query_events()
+
+    assert storage.prune(RetentionPolicy(max_age=60)) == 1
+    assert storage.query_events() == []
+    assert storage.get_event_by_id("1") is None
+
+
+def test_memory_storage_evicts_oldest_tasks() -> None:
+    """Test that new tasks reuse the slots of the tasks seen first once the ring buffer is full."""
+    storage = MemoryStorage(max_tasks=3)
+    for i in range(5):
+        storage.store_event({"uuid": str(i), "type": "task-sent", "sent_timestamp": 1670000000.0 + i})
+    storage.store_event({"uuid": "2", "type": "task-started", "started_timestamp": 1670000010.0})
+
+    assert [event["uuid"] for event in storage.get_events()] == ["4", "3", "2"]
+    assert storage.get_event_by_id("0") is None
+    event = storage.get_event_by_id("2")
+    assert event is not None and event["type"] == "task-started"
+
+    assert storage.prune(RetentionPolicy(max_events=1)) == 2
+    storage.store_event({"uuid": "5", "type": "task-sent", "sent_timestamp": 1670000005.0})
+    assert [event["uuid"] for event in storage.get_events()] == ["5", "4"]
+
+
+def test_memory_storage_matches_sqlite(temp_db_path: str) -> None:
+    """Test that both backends return the same pages and stats for the same events in random order."""
+    memory_storage = MemoryStorage()
+    sqlite_storage = SQLiteStorage(path=temp_db_path, use_rollups=False)
+    _store_random_tasks(memory_storage)
+    _store_random_tasks(sqlite_storage)
+    # Lifecycles merged into some of the random tasks
+    events = [{**event, "uuid": str(i)} for i in range(20) for event in _lifecycle_events("failed")]
+    random.Random(1).shuffle(events)
+    memory_storage.store_events(events)
+    sqlite_storage.store_events(events)
+
+    filter_sets: list[dict[str, Any]] = [
+        {},
+        {"name": "a"},
+        {"state": "task-failed", "order": "asc"},
+        {"sent_before": 1670000300.0},
+    ]
+    for filters in filter_sets:
+        assert memory_storage.query_events(limit=50, **filters) == sqlite_storage.query_events(limit=50, **filters)
+    kwargs: dict = {"start": 1670000000.0, "end": 1670000600.0, "bucket_seconds": 60, "group_by": ("hostname",)}
+    assert memory_storage.get_stats(**kwargs) == sqlite_storage.get_stats(**kwargs)
+
+
+def _store_tasks_over_hours(storage: Storage, hours: int = 5, count: int = 400) -> None:
+    """Stores tasks over several hours, some of them sent just before an hour starts and seen first after it."""
+    rng = random.Random(0)
+    arrivals = []
+    for i in range(count):
+        sent_timestamp = 1670000400.0 + rng.uniform(0, hours * 3600)
+        task = {"uuid": str(i), "name": rng.choice(["a", "b"]), "hostname": rng.choice(["w1", "w2"])}
+        sent = {**task, "type": "task-sent", "sent_timestamp": sent_timestamp, "kwargs": f"{{'order_id': {i}}}"}
+        received_timestamp = sent_timestamp + rng.uniform(1, 2)
+        arrivals.append((sent_timestamp, sent))
+        if i % 10 == 0:
+            # The sent event arrives after the received one, in the next partition
+            sent["sent_timestamp"] = sent_timestamp // 3600 * 3600 - rng.uniform(0.1, 0.5)
+            received_timestamp = sent_timestamp // 3600 * 3600 + rng.uniform(0.1, 0.5)
+            arrivals[-1] = (received_timestamp + 1, sent)
+        arrivals.append(
+            (received_timestamp, {**task, "type": "task-received", "received_timestamp": received_timestamp})
+        )
+        if i % 3 == 0:
+            succeeded = {**task, "type": "task-succeeded", "succeeded_timestamp": received_timestamp + 3}
+            arrivals.append((received_timestamp + 3, {**succeeded, "runtime": rng.uniform(0, 10)}))
+    # Stored in batches in the order the events arrive, like the pipeline does
+    events = [event for _, event in sorted(arrivals, key=lambda arrival: arrival[0])]
+    for i in range(0, len(events), 50):
+        storage.store_events(events[i : i + 50])
+
+
+def test_partitioned_storage_matches_sqlite(tmp_path: Path) -> None:
+    """Test that partitioned storage returns the same pages and stats as a single database."""
+    sqlite_storage = SQLiteStorage(path=str(tmp_path / "events.db"), use_rollups=False)
+    partitioned_storage = PartitionedSQLiteStorage(
+        directory=str(tmp_path / "partitions"), partition="hour", use_rollups=False
+    )
+    _store_tasks_over_hours(sqlite_storage)
+    _store_tasks_over_hours(partitioned_storage)
+
+    assert len(list((tmp_path / "partitions").glob("events-*.db"))) == 6
+    assert partitioned_storage.get_events() == sqlite_storage.get_events()
+    assert partitioned_storage.get_event_by_id("10") == sqlite_storage.get_event_by_id("10")
+    filter_sets: list[dict[str, Any]] = [
+        {},
+        {"order": "asc"},
+        {"name": "a", "sent_after": 1670005000.0},
+        {"sent_before": 1670010000.0},
+    ]
+    for filters in filter_sets:
+        pages = list(partitioned_storage.iter_events(batch_size=7, **filters))
+        assert pages == list(sqlite_storage.iter_events(**filters))
+        assert partitioned_storage.query_events(limit=30, **filters) == sqlite_storage.query_events(limit=30, **filters)
+    assert partitioned_storage.query_events(search="order_id=20") == sqlite_storage.query_events(search="order_id=20")
+    for bucket_seconds in (600, 7200):
+        kwargs: dict = {"start": 1670000000.0, "end": 1670020000.0, "bucket_seconds": bucket_seconds}
+        assert partitioned_storage.get_stats(**kwargs) == sqlite_storage.get_stats(**kwargs)
+
+
+def test_partitioned_storage_keeps_tasks_in_one_partition(tmp_path: Path) -> None:
+    """Test that the events of a task stay in the partition of its first event, also after reopening."""
+    storage = PartitionedSQLiteStorage(directory=str(tmp_path), partition="day")
+    storage.store_event({"uuid": "1", "type": "task-received", "received_timestamp": 1670025600.5})
+    storage.store_event({"uuid": "1", "type": "task-sent", "sent_timestamp": 1670025599.5, "name": "a"})
+    storage.close()
+
+    storage = PartitionedSQLiteStorage(directory=str(tmp_path), partition="day")
+    storage.store_event({"uuid": "1", "type": "task-succeeded", "succeeded_timestamp": 1670025610.0})
+    assert [path.name for path in tmp_path.glob("events-*.db")] == ["events-2022-12-03.db"]
+    event = storage.get_event_by_id("1")
+    assert event is not None and event["type"] == "task-succeeded"
+    assert [event["uuid"] for event in storage.query_events(sent_after=1670025599.0, sent_before=1670025600.0)] == ["1"]
+
+
+def test_partitioned_storage_prune(tmp_path: Path) -> None:
+    """Test that retention drops whole partitions and only deletes single events in the partition at the limit."""
+    storage = PartitionedSQLiteStorage(directory=str(tmp_path), partition="hour")
+    now = time.time()
+    storage.store_events([{"uuid": str(i), "type": "task-sent", "sent_timestamp": now - i * 1800} for i in range(10)])
+    assert len(list(tmp_path.glob("events-*.db"))) in (5, 6)
+
+    assert storage.prune(RetentionPolicy(max_age=3 * 3600 + 60)) == 3
+    assert len(list(tmp_path.glob("events-*.db*"))) < 15
+    assert [event["uuid"] for event in storage.get_events()] == [str(i) for i in range(7)]
+
+    assert storage.prune(RetentionPolicy(max_events=2)) == 5
+    assert [event["uuid"] for event in storage.get_events()] == ["0", "1"]
+
+
+def test_partitioned_storage_rescans_directory(tmp_path: Path) -> None:
+    """Test that a reader sees the partitions created and dropped by another instance, and never creates any."""
+    writer = PartitionedSQLiteStorage(directory=str(tmp_path), partition="hour")
+    reader = PartitionedSQLiteStorage(directory=str(tmp_path), partition="hour")
+    now = time.time()
+    writer.store_events([{"uuid": str(i), "type": "task-sent", "sent_timestamp": now - i * 3600} for i in range(3)])
+    assert [event["uuid"] for event in reader.query_events()] == ["0", "1", "2"]
+
+    assert writer.prune(RetentionPolicy(max_events=1)) == 2
+    assert [event["uuid"] for event in reader.query_events()] == ["0"]
+    assert reader.get_event_by_id("2") is None
+    assert len(list(tmp_path.glob("events-*.db"))) == 1
@@ -0,0 +1,50 @@
+"""Tests for the worker registry"""
+import time
+
+from veggie.workers import WorkerRegistry
+
+
+def _heartbeat(hostname: str, timestamp: float, event_type: str = "worker-heartbeat", **fields: object) -> dict:
+    return {"type": event_type, "hostname": hostname, "timestamp": timestamp, "freq": 2.0, **fields}
+
+
+def test_heartbeat_updates_worker() -> None:
+    registry = WorkerRegistry()
+    now = time.time()
+    registry.update(_heartbeat("w1", now - 10, event_type="worker-online", sw_ver="5.3.0"))
+    registry.update(_heartbeat("w1", now, active=3, processed=42, loadavg=[0.5, 0.4, 0.3]))
+
+    assert registry.get_workers() == [
+        {
+            "hostname": "w1",
+            "online": True,
+            "active": 3,
+            "processed": 42,
+            "loadavg": [0.5, 0.4, 0.3],
+            "freq": 2.0,
+            "sw_ident": None,
+            "sw_ver": "5.3.0",
+            "last_heartbeat": now,
+        }
+    ]
+
+
+def test_worker_offline() -> None:
+    registry = WorkerRegistry()
+    now = time.time()
+    registry.update(_heartbeat("w2", now))
+    registry.update(_heartbeat("w1", now))
+    registry.update(_heartbeat("w1", now, event_type="worker-offline"))
+
+    assert [(worker["hostname"], worker["online"]) for worker in registry.get_workers()] == [
+        ("w1", False),
+        ("w2", True),
+    ]
+
+
+def test_missed_heartbeats() -> None:
+    registry = WorkerRegistry()
+    registry.update(_heartbeat("w1", time.time() - 5))
+
+    (worker,) = registry.get_workers()
+    assert worker["online"] is False
@@ -0,0 +1,6 @@
+"""
+Entry point of `python -m veggie`
+"""
+from .cli import main
+
+main()
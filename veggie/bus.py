@@ -0,0 +1,96 @@
+"""
+In-process fan-out of ingested events
+"""
+import queue
+import threading
+import time
+
+from .state import merge_event
+
+
+class Subscription:
+    """
+    Events published to the bus since the subscription started
+
+    Each subscription has a bounded queue. If a subscriber falls behind, new events are dropped for it instead
+    of slowing down the publisher, and the number of dropped events is reported with the next batch.
+    """
+
+    def __init__(self, max_queue_size: int) -> None:
+        """Initializes the subscription"""
+        self._queue: queue.Queue[dict] = queue.Queue(maxsize=max_queue_size)
+        self._dropped = 0
+
+    def put(self, event: dict) -> None:
+        """Queues an event without blocking"""
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._dropped += 1
+
+    def get_batch(self, timeout: float, window: float) -> tuple[list[dict], int]:
+        """
+        Waits for events and returns them merged by task
+
+        Args:
+            timeout: Maximum time in seconds to wait for the first event.
+            window: Time in seconds to keep collecting events after the first one.
+
+        Returns:
+            One event per task, merged with `merge_event()`, in the order the tasks were first seen, and the
+            number of events dropped since the previous batch. The list is empty if no event arrived before the
+            timeout.
+        """
+        try:
+            events = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return [], self._take_dropped()
+
+        deadline = time.monotonic() + window
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                events.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        merged: dict[str, dict] = {}
+        for event in events:
+            merged[event["uuid"]] = merge_event(merged.get(event["uuid"], {}), event)
+        return list(merged.values()), self._take_dropped()
+
+    def _take_dropped(self) -> int:
+        dropped, self._dropped = self._dropped, 0
+        return dropped
+
+
+class EventBus:
+    """Publishes events to all current subscribers"""
+
+    def __init__(self, max_queue_size: int = 10000) -> None:
+        """
+        Initializes the bus
+
+        Args:
+            max_queue_size: Maximum number of events queued per subscriber.
+        """
+        self.max_queue_size = max_queue_size
+        self._subscriptions: tuple[Subscription, ...] = ()
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> Subscription:
+        """Starts a new subscription"""
+        subscription = Subscription(max_queue_size=self.max_queue_size)
+        with self._lock:
+            self._subscriptions = (*self._subscriptions, subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """Ends a subscription"""
+        with self._lock:
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+
+    def publish(self, event: dict) -> None:
+        """Sends event to all subscribers"""
+        # The tuple is replaced rather than modified, so publishing doesn't need the lock
+        for subscription in self._subscriptions:
+            subscription.put(event)
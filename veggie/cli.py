@@ -0,0 +1,182 @@
+"""
+Command line interface
+"""
+import argparse
+import importlib
+import os
+import sys
+
+from celery import Celery
+from loguru import logger
+
+from .server import SERVERS, ServerConfig, create_server
+from .storage import PartitionedSQLiteStorage, RetentionPolicy, SQLiteStorage, Storage
+
+PARTITION_HELP = "store each day or hour in its own database file, with --db as their directory"
+
+
+def load_celery_app(path: str) -> Celery:
+    """
+    Imports a Celery app given as "module:attribute", or "module" for an attribute named "app"
+
+    Modules are looked up in the current directory first, as with `celery -A`.
+
+    Raises:
+        ValueError: If the attribute is not a Celery app.
+    """
+    module_name, _, attribute = path.partition(":")
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    celery_app = getattr(importlib.import_module(module_name), attribute or "app")
+    if not isinstance(celery_app, Celery):
+        raise ValueError(f"{path} is not a Celery app")
+    return celery_app
+
+
+def open_storage(args: argparse.Namespace) -> Storage:
+    """Opens the database given by --db, or the directory of partitions with --partition"""
+    if args.partition:
+        return PartitionedSQLiteStorage(directory=args.db, partition=args.partition)
+    return SQLiteStorage(path=args.db)
+
+
+def rebuild_rollups(args: argparse.Namespace) -> None:
+    """Recomputes the rollup tables of a SQLite database, or of each partition with --partition"""
+    logger.info(f"Rebuilding rollups of {args.db}")
+    storage: SQLiteStorage | PartitionedSQLiteStorage = (
+        PartitionedSQLiteStorage(directory=args.db, partition=args.partition)
+        if args.partition
+        else SQLiteStorage(path=args.db)
+    )
+    try:
+        storage.rebuild_rollups()
+    finally:
+        storage.close()
+    logger.info("Rollups rebuilt")
+
+
+def ingest(args: argparse.Namespace) -> None:
+    """Receives events from the broker and stores them, without serving the web app"""
+    # Imported here, so that the other commands don't build the dashboard
+    from .monitor import CeleryMonitor
+
+    if args.cpus:
+        # Keeps the receiver off the cores of the web workers, where the OS supports it
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, args.cpus)
+        else:
+            logger.warning("CPU affinity is not supported on this platform")
+
+    retention = None
+    if args.max_age is not None or args.max_events is not None:
+        retention = RetentionPolicy(max_age=args.max_age, max_events=args.max_events)
+    monitor = CeleryMonitor(
+        celery_app=load_celery_app(args.app),
+        storage=open_storage(args),
+        retention=retention,
+        receivers=args.receivers,
+        writers=args.writers,
+        node_id=args.node_id,
+        durable_queue=args.durable_queue,
+        spool_path=args.spool,
+    )
+    monitor.start(webapp=False)
+
+
+def serve(args: argparse.Namespace) -> None:
+    """Serves the web app from the events stored by `veggie ingest`"""
+    from .webapp.flask_app import get_flask_app
+
+    celery_app = load_celery_app(args.app)
+    config = ServerConfig(
+        host=args.host,
+        port=args.port,
+        server=args.server,
+        threads=args.threads,
+        workers=args.workers,
+        keep_alive=args.keep_alive,
+        graceful_timeout=args.graceful_timeout,
+        max_streams=args.max_streams,
+    )
+    # Each worker process opens its own connection to the database
+    create_server(
+        app_factory=lambda: get_flask_app(
+            storage=open_storage(args), celery_app=celery_app, max_streams=config.stream_limit
+        ),
+        config=config,
+    ).serve()
+
+
+def export(args: argparse.Namespace) -> None:
+    """Writes the tasks sent in a time range to a Parquet or Arrow IPC file"""
+    from .export import write_export
+
+    storage = open_storage(args)
+    try:
+        with open(args.output, "wb") as file:
+            write_export(storage, file, format=args.format, start=args.start, end=args.end)
+    finally:
+        storage.close()
+    logger.info(f"Exported tasks to {args.output}")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Builds the argument parser with a subcommand per command"""
+    parser = argparse.ArgumentParser(prog="veggie", description="Monitor and execute Celery tasks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser("rebuild-rollups", help="recompute the stats rollups of a SQLite database")
+    rebuild.add_argument("--db", required=True, help="path of the SQLite database")
+    rebuild.add_argument("--partition", choices=list(PartitionedSQLiteStorage.PARTITIONS), help=PARTITION_HELP)
+    rebuild.set_defaults(func=rebuild_rollups)
+
+    ingest_parser = subparsers.add_parser("ingest", help="receive events from the broker and store them")
+    ingest_parser.add_argument("-A", "--app", required=True, help="Celery app, as module:attribute")
+    ingest_parser.add_argument("--db", required=True, help="path of the SQLite database")
+    ingest_parser.add_argument("--partition", choices=list(PartitionedSQLiteStorage.PARTITIONS), help=PARTITION_HELP)
+    ingest_parser.add_argument("--max-age", type=float, help="delete events older than this many seconds")
+    ingest_parser.add_argument("--max-events", type=int, help="keep at most this many events")
+    ingest_parser.add_argument("--receivers", type=int, default=1, help="threads receiving events")
+    ingest_parser.add_argument("--writers", type=int, default=1, help="pipelines storing events")
+    ingest_parser.add_argument("--node-id", help="name of the event queue, shared by processes using the same one")
+    ingest_parser.add_argument("--durable-queue", action="store_true", help="keep the event queue while stopped")
+    ingest_parser.add_argument("--spool", help="path of a spool file keeping the events until they are stored")
+    ingest_parser.add_argument("--cpus", type=int, nargs="+", help="run on these CPU cores only (Linux)")
+    ingest_parser.set_defaults(func=ingest)
+
+    export_parser = subparsers.add_parser("export", help="export task history to Parquet or Arrow IPC")
+    export_parser.add_argument("--db", required=True, help="path of the SQLite database")
+    export_parser.add_argument("--partition", choices=list(PartitionedSQLiteStorage.PARTITIONS), help=PARTITION_HELP)
+    export_parser.add_argument("-o", "--output", required=True, help="path of the exported file")
+    export_parser.add_argument("--format", choices=("parquet", "arrow"), default="parquet")
+    export_parser.add_argument("--start", type=float, help="only tasks sent at or after this Unix timestamp")
+    export_parser.add_argument("--end", type=float, help="only tasks sent before this Unix timestamp")
+    export_parser.set_defaults(func=export)
+
+    defaults = ServerConfig()
+    serve_parser = subparsers.add_parser("serve", help="serve the web app from the stored events")
+    serve_parser.add_argument("-A", "--app", required=True, help="Celery app, as module:attribute")
+    serve_parser.add_argument("--db", required=True, help="path of the SQLite database")
+    serve_parser.add_argument("--partition", choices=list(PartitionedSQLiteStorage.PARTITIONS), help=PARTITION_HELP)
+    serve_parser.add_argument("--host", default=defaults.host, help="interface to listen on")
+    serve_parser.add_argument("--port", type=int, default=int(os.getenv("VEGGIE_PORT", defaults.port)))
+    serve_parser.add_argument("--server", choices=list(SERVERS), default=defaults.server)
+    serve_parser.add_argument("--threads", type=int, default=defaults.threads, help="threads per process")
+    serve_parser.add_argument("--workers", type=int, default=defaults.workers, help="processes, gunicorn only")
+    serve_parser.add_argument("--keep-alive", type=int, default=defaults.keep_alive, help="seconds")
+    serve_parser.add_argument("--graceful-timeout", type=int, default=defaults.graceful_timeout, help="seconds")
+    serve_parser.add_argument(
+        "--max-streams",
+        type=int,
+        default=defaults.max_streams,
+        help="live event streams per process, 3/4 of --threads by default",
+    )
+    serve_parser.set_defaults(func=serve)
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Runs the command given in the arguments"""
+    args = get_parser().parse_args(argv)
+    args.func(args)
@@ -0,0 +1,173 @@
+"""
+Export of task history to Parquet and Arrow IPC
+
+pyarrow is an optional dependency, installed with `pip install veggie[export]`.
+"""
+import io
+from typing import Any, BinaryIO, Iterator
+
+from .storage import Storage
+
+FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+TIMESTAMP_FIELDS = (
+    "sent_timestamp",
+    "received_timestamp",
+    "started_timestamp",
+    "succeeded_timestamp",
+    "failed_timestamp",
+    "retried_timestamp",
+    "revoked_timestamp",
+    "rejected_timestamp",
+)
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def _import_pyarrow() -> Any:
+    """
+    Imports pyarrow
+
+    Raises:
+        ImportError: If pyarrow is not installed.
+    """
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError("Exporting events requires `pip install veggie[export]`") from e
+    return pyarrow
+
+
+def get_schema() -> Any:
+    """Returns the Arrow schema of exported tasks, one row per task"""
+    pa = _import_pyarrow()
+    timestamp = pa.timestamp("us", tz="UTC")
+    return pa.schema(
+        [
+            pa.field("uuid", pa.string(), nullable=False),
+            pa.field("name", pa.string()),
+            pa.field("state", pa.string()),
+            pa.field("hostname", pa.string()),
+            *(pa.field(field, timestamp) for field in TIMESTAMP_FIELDS),
+            pa.field("runtime", pa.float64()),
+        ]
+    )
+
+
+def iter_event_pages(
+    storage: Storage, start: float | None = None, end: float | None = None, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[list[dict]]:
+    """
+    Yields the events sent in a time range, oldest first, in pages read with a keyset cursor
+
+    Only one page is held in memory at a time, however large the range.
+    """
+    after = None
+    while True:
+        events = storage.query_events(limit=chunk_size, after=after, sent_after=start, sent_before=end, order="asc")
+        if events:
+            yield events
+        if len(events) < chunk_size:
+            return
+        after = (events[-1].get("sent_timestamp"), events[-1]["uuid"])
+
+
+def events_to_batch(events: list[dict], schema: Any) -> Any:
+    """Converts events to an Arrow record batch, with timestamps as microseconds since the epoch"""
+    pa = _import_pyarrow()
+    columns: dict[str, list] = {
+        "uuid": [event["uuid"] for event in events],
+        "name": [event.get("name") for event in events],
+        "state": [event.get("type") for event in events],
+        "hostname": [event.get("hostname") for event in events],
+        "runtime": [event.get("runtime") for event in events],
+    }
+    for field in TIMESTAMP_FIELDS:
+        columns[field] = [round(event[field] * 1_000_000) if event.get(field) is not None else None for event in events]
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Writable stream keeping the written bytes until they are taken"""
+
+    def __init__(self) -> None:
+        """Initializes an empty sink"""
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        """The sink is always writable"""
+        return True
+
+    def write(self, data: Any) -> int:
+        """Keeps a copy of the written bytes"""
+        chunk = bytes(data)
+        self._chunks.append(chunk)
+        self._position += len(chunk)
+        return len(chunk)
+
+    def tell(self) -> int:
+        """Returns the number of bytes written so far"""
+        return self._position
+
+    def take(self) -> bytes:
+        """Returns the bytes written since the previous call"""
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_export(
+    storage: Storage,
+    format: str = "parquet",
+    start: float | None = None,
+    end: float | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """
+    Returns the export of the tasks sent in a time range as an iterator of chunks, e.g. to stream it in a response
+
+    Args:
+        storage: Storage to export from.
+        format: "parquet" for a Parquet file with a row group per chunk, or "arrow" for an Arrow IPC stream with
+            a record batch per chunk.
+        start: Only export tasks sent at or after this timestamp.
+        end: Only export tasks sent before this timestamp.
+        chunk_size: Number of tasks read from storage and written at a time.
+
+    Raises:
+        ValueError: If the format is unknown.
+        ImportError: If pyarrow is not installed.
+    """
+    # Checked before the first chunk is requested, e.g. before a response starts streaming
+    if format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    _import_pyarrow()
+    return _iter_export(storage, format=format, start=start, end=end, chunk_size=chunk_size)
+
+
+def _iter_export(
+    storage: Storage, format: str, start: float | None, end: float | None, chunk_size: int
+) -> Iterator[bytes]:
+    pa = _import_pyarrow()
+    schema = get_schema()
+    sink = _ChunkSink()
+    if format == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    with writer:
+        for events in iter_event_pages(storage, start=start, end=end, chunk_size=chunk_size):
+            writer.write_batch(events_to_batch(events, schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def write_export(storage: Storage, file: BinaryIO, **kwargs: Any) -> None:
+    """Writes an export to a binary file, with the same arguments as `iter_export()`"""
+    for chunk in iter_export(storage, **kwargs):
+        file.write(chunk)
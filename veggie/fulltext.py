@@ -0,0 +1,93 @@
+"""
+Full-text search of task arguments, results and exceptions
+
+SQLiteStorage indexes the fields below in an FTS5 table whose content is read from the generated columns of the
+events table, so the text is not stored twice. Triggers on the events table keep the index up to date as events
+are written and deleted. Other backends match the same queries by scanning their tasks.
+
+A search is a list of words that must all appear in a task, in any of the fields. Words are split on
+punctuation like by the FTS5 tokenizer, so `order_id=12345` matches the words "order", "id" and "12345" in this
+order. A word ending with `*` matches any word starting with it.
+"""
+import re
+
+# Searched task fields, all also generated columns of the events table
+FIELDS = ("args", "kwargs", "result", "exception", "traceback")
+
+# Words, as split by the unicode61 tokenizer of FTS5
+WORD = re.compile(r"[^\W_]+")
+
+
+def parse(search: str) -> list[tuple[list[str], bool]]:
+    """
+    Splits a search into terms
+
+    Returns:
+        The words of each whitespace-separated term, and whether the term is a prefix.
+    """
+    terms = []
+    for term in search.split():
+        words = WORD.findall(term)
+        if words:
+            terms.append((words, term.endswith("*")))
+    return terms
+
+
+def match_query(search: str) -> str | None:
+    """
+    Builds the FTS5 query of a search, quoting each term so that user input can't be a syntax error
+
+    Returns:
+        The query, or None if the search has no words.
+    """
+    terms = [f'"{" ".join(words)}"' + ("*" if prefix else "") for words, prefix in parse(search)]
+    return " AND ".join(terms) or None
+
+
+def matches(event: dict, search: str) -> bool:
+    """Whether a task matches a search, for the backends without a full-text index"""
+    text = "\n".join(str(event[field]) for field in FIELDS if event.get(field) is not None)
+    for words, prefix in parse(search):
+        pattern = r"(?<![^\W_])" + r"[\W_]+".join(map(re.escape, words)) + ("" if prefix else r"(?![^\W_])")
+        if re.search(pattern, text, flags=re.IGNORECASE) is None:
+            return False
+    return True
+
+
+def create_statements(table: str, events_table: str) -> list[str]:
+    """Statements creating the full-text index of the events table and the triggers maintaining it"""
+    columns = ", ".join(FIELDS)
+    new_values, old_values = (
+        ", ".join(f"new.{field}" for field in FIELDS),
+        ", ".join(f"old.{field}" for field in FIELDS),
+    )
+    insert_new = f"INSERT INTO {table} (rowid, {columns}) VALUES (new.rowid, {new_values});"
+    # An external content index is updated by deleting the old values exactly as they were indexed
+    delete_old = f"INSERT INTO {table} ({table}, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});"
+    changed = " OR ".join(f"old.{field} IS NOT new.{field}" for field in FIELDS)
+
+    return [
+        f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}
+            USING fts5({columns}, content='{events_table}', content_rowid='rowid')
+        """,
+        f"CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {events_table} BEGIN {insert_new} END",
+        f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_update AFTER UPDATE ON {events_table} WHEN {changed}
+            BEGIN {delete_old} {insert_new} END
+        """,
+        f"CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {events_table} BEGIN {delete_old} END",
+    ]
+
+
+def drop_statements(table: str) -> list[str]:
+    """Statements dropping the full-text index and its triggers"""
+    return [
+        *(f"DROP TRIGGER IF EXISTS {table}_{trigger}" for trigger in ("insert", "update", "delete")),
+        f"DROP TABLE IF EXISTS {table}",
+    ]
+
+
+def rebuild_statement(table: str) -> str:
+    """Statement reindexing all the rows of the events table"""
+    return f"INSERT INTO {table} ({table}) VALUES ('rebuild')"
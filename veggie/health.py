@@ -0,0 +1,84 @@
+"""
+Health of event ingestion
+"""
+import threading
+import time
+
+from .pipeline import EventPipeline
+from .spool import EventSpool
+
+
+class IngestionHealth:
+    """
+    Connection state of the event receivers and backlog of the pipelines
+
+    Receivers report their connections and disconnections from their threads, the health endpoint reads the
+    state from web server threads.
+    """
+
+    def __init__(self, receivers: int, pipelines: list[EventPipeline], spool: EventSpool | None = None) -> None:
+        """
+        Initializes the health of receivers that are not connected yet
+
+        Args:
+            receivers: Number of receivers expected to be connected.
+            pipelines: Pipelines whose pending events are reported.
+            spool: Spool whose events not stored yet are reported.
+        """
+        self.receivers = receivers
+        self.pipelines = pipelines
+        self.spool = spool
+        self.connected = 0
+        self.reconnects = 0
+        self.last_error: str | None = None
+        self.last_event_timestamp: float | None = None
+        self._lock = threading.Lock()
+
+    def receiver_connected(self) -> None:
+        """Records that a receiver connected to the broker"""
+        with self._lock:
+            self.connected += 1
+
+    def receiver_disconnected(self, error: str | None = None) -> None:
+        """Records that a receiver lost its connection, with the error if it failed"""
+        with self._lock:
+            self.connected -= 1
+            if error is not None:
+                self.reconnects += 1
+                self.last_error = error
+
+    def receiver_failed(self, error: str) -> None:
+        """Records that a receiver failed to connect"""
+        with self._lock:
+            self.reconnects += 1
+            self.last_error = error
+
+    def event_received(self) -> None:
+        """Records the time of the latest event"""
+        self.last_event_timestamp = time.time()
+
+    @property
+    def status(self) -> str:
+        """Overall status: ok if all receivers are connected, degraded if only some are and down if none is"""
+        if self.connected >= self.receivers:
+            return "ok"
+        return "degraded" if self.connected > 0 else "down"
+
+    def to_dict(self) -> dict:
+        """Returns the health as a JSON-serializable dict"""
+        pending = [pipeline.pending() for pipeline in self.pipelines]
+        return {
+            "status": self.status,
+            "receivers": {
+                "expected": self.receivers,
+                "connected": self.connected,
+                "reconnects": self.reconnects,
+                "last_error": self.last_error,
+            },
+            "last_event_timestamp": self.last_event_timestamp,
+            "pending": {
+                "events": sum(counts["events"] for counts in pending),
+                "batches": sum(counts["batches"] for counts in pending),
+                "spooled": self.spool.pending() if self.spool is not None else None,
+            },
+        }
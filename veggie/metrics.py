@@ -0,0 +1,136 @@
+"""
+In-memory task metrics in the Prometheus text format
+"""
+import threading
+from bisect import bisect_left
+
+from .rollups import HISTOGRAM_BOUNDS
+
+# Task states counted by `TaskMetrics`, by event type
+COUNTED_STATES = {
+    "task-sent": "sent",
+    "task-received": "received",
+    "task-started": "started",
+    "task-succeeded": "succeeded",
+    "task-failed": "failed",
+    "task-retried": "retried",
+    "task-revoked": "revoked",
+    "task-rejected": "rejected",
+}
+# States after which a task gets no more events
+FINAL_STATES = ("succeeded", "failed", "revoked", "rejected")
+UNKNOWN_NAME = "unknown"
+
+
+class Histogram:
+    """Counts of values per fixed bucket, and their sum"""
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self) -> None:
+        """Initializes an empty histogram"""
+        # One count per bound, plus one for values above the last bound
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Adds a value to its bucket"""
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.sum += value
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class TaskMetrics:
+    """
+    Counters and histograms of the received task events
+
+    Events may be observed from several receiver threads, so updates take a lock. Each update is a few dict
+    lookups and integer increments. Rendering copies the dicts first without the lock, so it can run in web server
+    threads while events are observed; values of one task name may be a few events apart between two metrics.
+    """
+
+    def __init__(self, max_tracked_tasks: int = 100000) -> None:
+        """
+        Initializes the metrics
+
+        Args:
+            max_tracked_tasks: Maximum number of unfinished tasks whose name and sent timestamp are kept, to
+                label the events that don't carry the name and to compute the queue wait. The oldest tasks are
+                forgotten first.
+        """
+        self.max_tracked_tasks = max_tracked_tasks
+        self.counters: dict[tuple[str, str], int] = {}
+        self.runtimes: dict[str, Histogram] = {}
+        self.queue_waits: dict[str, Histogram] = {}
+        # Task id -> (name, sent timestamp). Dicts keep insertion order, so the first key is the oldest task.
+        self._tasks: dict[str, tuple[str | None, float | None]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, event: dict) -> None:
+        """Updates the metrics with a processed event"""
+        state = COUNTED_STATES.get(event.get("type", ""))
+        if state is None:
+            return
+        uuid = event.get("uuid", "")
+
+        with self._lock:
+            tracked_name, sent_timestamp = self._tasks.get(uuid, (None, None))
+            name = event.get("name") or tracked_name or UNKNOWN_NAME
+            if state == "sent":
+                self._track(uuid, name, event.get("sent_timestamp"))
+            elif state == "received":
+                received_timestamp = event.get("received_timestamp")
+                if sent_timestamp is not None and received_timestamp is not None:
+                    self._histogram(self.queue_waits, name).observe(received_timestamp - sent_timestamp)
+                self._track(uuid, name, None)
+            elif state in FINAL_STATES:
+                self._tasks.pop(uuid, None)
+                if event.get("runtime") is not None:
+                    self._histogram(self.runtimes, name).observe(event["runtime"])
+
+            key = (name, state)
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def _track(self, uuid: str, name: str, sent_timestamp: float | None) -> None:
+        """Remembers a task until it finishes, forgetting the oldest one if too many are tracked"""
+        self._tasks[uuid] = (name, sent_timestamp)
+        if len(self._tasks) > self.max_tracked_tasks:
+            del self._tasks[next(iter(self._tasks))]
+
+    @staticmethod
+    def _histogram(histograms: dict[str, Histogram], name: str) -> Histogram:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        return histogram
+
+    def render(self) -> str:
+        """Renders the metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP veggie_tasks_total Number of task events received, by task name and state.",
+            "# TYPE veggie_tasks_total counter",
+        ]
+        # Copying the items is atomic, iterating a dict while the receiver adds keys to it is not
+        counters = list(self.counters.items())
+        for (name, state), count in sorted(counters):
+            lines.append(f'veggie_tasks_total{{name="{_escape(name)}",state="{state}"}} {count}')
+
+        for metric, histograms, description in (
+            ("veggie_task_runtime_seconds", self.runtimes, "Runtime of finished tasks"),
+            ("veggie_task_queue_wait_seconds", self.queue_waits, "Time from sending to receiving a task"),
+        ):
+            lines.append(f"# HELP {metric} {description}, by task name.")
+            lines.append(f"# TYPE {metric} histogram")
+            items = list(histograms.items())
+            for name, histogram in sorted(items, key=lambda item: item[0]):
+                label = f'name="{_escape(name)}"'
+                cumulative = 0
+                for bound, count in zip([*HISTOGRAM_BOUNDS, "+Inf"], list(histogram.counts), strict=True):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum{{{label}}} {histogram.sum}")
+                lines.append(f"{metric}_count{{{label}}} {cumulative}")
+        return "\n".join(lines) + "\n"
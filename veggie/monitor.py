@@ -3,14 +3,25 @@ Celery monitor
 """
 import asyncio
 import os
+import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from celery import Celery
 from celery.events import EventReceiver
 from kombu import Connection
 from loguru import logger
 
-from .storage import Storage
+from .bus import EventBus
+from .health import IngestionHealth
+from .metrics import TaskMetrics
+from .pipeline import EventPipeline, ThreadedAsyncStorage
+from .server import ServerConfig, create_server
+from .spool import EventSpool
+from .storage import RetentionPolicy, Storage
 from .webapp.flask_app import get_flask_app
+from .workers import WorkerRegistry
 
 
 class CeleryMonitor:
@@ -18,79 +29,328 @@ class CeleryMonitor:
     Celery monitor class
     """
 
-    def __init__(self, celery_app: Celery, storage: Storage) -> None:
+    def __init__(
+        self,
+        celery_app: Celery,
+        storage: Storage,
+        retention: RetentionPolicy | None = None,
+        prune_interval: float = 60.0,
+        server: ServerConfig | None = None,
+        receivers: int = 1,
+        writers: int = 1,
+        node_id: str | None = None,
+        durable_queue: bool = False,
+        spool_path: str | None = None,
+        reconnect_max_delay: float = 60.0,
+    ) -> None:
         """
         Initializes the monitor
+
+        Args:
+            celery_app: The Celery app to monitor.
+            storage: Storage of the received events.
+            retention: Retention policy enforced in the background. None keeps all events.
+            prune_interval: Seconds between two runs of the retention policy.
+            server: Settings of the web app server. None uses the development server on the port in the
+                VEGGIE_PORT environment variable, 5000 by default.
+            receivers: Number of threads receiving events. They consume from one queue, and the broker balances
+                the events between them.
+            writers: Number of pipelines storing events. Events are routed to them by task id, so all events of a
+                task are stored, in order, by the same writer.
+            node_id: Name of the event queue, `celeryev.<node_id>`. Monitors started with the same node id share
+                the queue, e.g. to spread ingestion over several processes. None generates a unique one.
+            durable_queue: Whether the event queue outlives the monitor, so the broker keeps the events sent while
+                the monitor is down. Its lifetime without consumers is the `event_queue_expires` setting of the
+                Celery app. Requires a `node_id`.
+            spool_path: Path of a local spool file. Received events are appended to it until they are stored, and
+                replayed on restart. None keeps them in memory only.
+            reconnect_max_delay: Maximum seconds between two attempts of a receiver to reconnect to the broker.
+
+        Raises:
+            ValueError: If the server is gunicorn, which can't run next to the event receiver. Serve the web app
+                separately, see `veggie.server`. Or if the queue is durable without a node id, or if a retention
+                policy is given for a storage that doesn't support it.
         """
+        server = server or ServerConfig(port=int(os.getenv("VEGGIE_PORT", 5000)))
+        if server.server == "gunicorn":
+            raise ValueError("gunicorn must run in its own process, without the event receiver")
+        if durable_queue and node_id is None:
+            raise ValueError("A durable queue needs a node_id, to be found again after a restart")
+        if retention is not None and not storage.supports_retention:
+            raise ValueError(f"{type(storage).__name__} does not support retention policies")
+
         self.celery_app = celery_app
         self.storage = storage
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.server = server
+        self.receivers = receivers
+        self.node_id = node_id or f"veggie-{uuid.uuid4().hex}"
+        self.durable_queue = durable_queue
+        self.reconnect_max_delay = reconnect_max_delay
+        self.spool = EventSpool(path=spool_path) if spool_path is not None else None
+        self.event_bus = EventBus()
+        self.metrics = TaskMetrics()
+        self.workers = WorkerRegistry()
+        self.pipelines = [
+            EventPipeline(storage=ThreadedAsyncStorage(storage), event_bus=self.event_bus, spool=self.spool)
+            for _ in range(writers)
+        ]
+        self.health = IngestionHealth(receivers=receivers, pipelines=self.pipelines, spool=self.spool)
+        self._receivers: list[EventReceiver] = []
+        self._receivers_stopping = threading.Event()
+        # Guards `_receivers`, so that a receiver connecting while the monitor stops is told to stop as well
+        self._receivers_lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stop_requested = asyncio.Event()
+
+        self.flask_app = get_flask_app(
+            storage=storage,
+            celery_app=celery_app,
+            event_bus=self.event_bus,
+            metrics=self.metrics,
+            workers=self.workers,
+            health=self.health,
+            max_streams=server.stream_limit,
+        )
 
-        self.flask_app = get_flask_app(storage=storage, celery_app=celery_app)
+    def _store_event(self, event: dict) -> None:
+        """
+        Updates the metrics and passes event on to be stored and published to the live subscribers
+
+        While the monitor runs, events go through the pipeline of their task, which blocks the receiver thread if
+        storage falls behind. Otherwise, e.g. when a handler is called directly, the event is stored and published
+        right away.
+        """
+        self.health.event_received()
+        self.metrics.observe(event)
+        pipeline = self.pipelines[hash(event.get("uuid")) % len(self.pipelines)]
+        if pipeline.is_running:
+            pipeline.submit(event)
+        else:
+            self.storage.store_event(event)
+            self.event_bus.publish(event)
 
     def _process_task_sent(self, event: dict) -> None:
         event["sent_timestamp"] = event["timestamp"]
         event.pop("timestamp")
-        self.storage.store_event(event)
+        self._store_event(event)
 
     def _process_task_received(self, event: dict) -> None:
         event["received_timestamp"] = event["timestamp"]
         event.pop("timestamp")
-        self.storage.store_event(event)
+        self._store_event(event)
 
     def _process_task_started(self, event: dict) -> None:
         event["started_timestamp"] = event["timestamp"]
         event.pop("timestamp")
-        self.storage.store_event(event)
+        self._store_event(event)
 
     def _process_task_succeeded(self, event: dict) -> None:
         event["succeeded_timestamp"] = event["timestamp"]
         event.pop("timestamp")
-        self.storage.store_event(event)
+        self._store_event(event)
 
     def _process_task_failed(self, event: dict) -> None:
         event["failed_timestamp"] = event["timestamp"]
         event.pop("timestamp")
-        self.storage.store_event(event)
+        self._store_event(event)
+
+    def _process_task_retried(self, event: dict) -> None:
+        event["retried_timestamp"] = event["timestamp"]
+        event.pop("timestamp")
+        self._store_event(event)
+
+    def _process_task_revoked(self, event: dict) -> None:
+        event["revoked_timestamp"] = event["timestamp"]
+        event.pop("timestamp")
+        self._store_event(event)
+
+    def _process_task_rejected(self, event: dict) -> None:
+        event["rejected_timestamp"] = event["timestamp"]
+        event.pop("timestamp")
+        self._store_event(event)
+
+    def _process_worker_event(self, event: dict) -> None:
+        """Updates the worker registry. Worker events are not stored."""
+        self.health.event_received()
+        self.workers.update(event)
+
+    def _receive_events(self, connection: Connection) -> str | None:
+        """Consumes events until the receiver is stopped or the connection fails, and returns the error if any"""
+        receiver = EventReceiver(
+            connection,
+            handlers={
+                "task-sent": self._process_task_sent,
+                "task-received": self._process_task_received,
+                "task-started": self._process_task_started,
+                "task-succeeded": self._process_task_succeeded,
+                "task-failed": self._process_task_failed,
+                "task-retried": self._process_task_retried,
+                "task-revoked": self._process_task_revoked,
+                "task-rejected": self._process_task_rejected,
+                "worker-online": self._process_worker_event,
+                "worker-heartbeat": self._process_worker_event,
+                "worker-offline": self._process_worker_event,
+            },
+            node_id=self.node_id,
+            app=self.celery_app,
+            # None leaves the `event_queue_durable` setting of the Celery app in effect
+            queue_durable=True if self.durable_queue else None,
+        )
+        with self._receivers_lock:
+            self._receivers.append(receiver)
+            if self._receivers_stopping.is_set():
+                receiver.should_stop = True
+        self.health.receiver_connected()
+        error = None
+        try:
+            receiver.capture(limit=None, timeout=None)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            with self._receivers_lock:
+                self._receivers.remove(receiver)
+            self.health.receiver_disconnected(error=error)
+        return error
+
+    def _run_receiver(self) -> None:
+        """Receives events, reconnecting to the broker with exponential backoff until the monitor stops"""
+        delay = min(1.0, self.reconnect_max_delay)
+        while not self._receivers_stopping.is_set():
+            try:
+                with Connection(self.celery_app.conf.broker_url) as connection:
+                    connection.ensure_connection(max_retries=0)
+                    delay = min(1.0, self.reconnect_max_delay)
+                    error = self._receive_events(connection)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                self.health.receiver_failed(error=error)
+            if self._receivers_stopping.is_set():
+                break
+            logger.warning(f"Event receiver disconnected ({error}), reconnecting in up to {delay:.0f} seconds")
+            # Jitter spreads the reconnections of several receivers
+            self._receivers_stopping.wait(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self.reconnect_max_delay)
 
     async def start_event_receiver(self) -> None:
-        """Starts the event receiver"""
-
-        def _run_receiver() -> None:
-            broker_url = self.celery_app.conf.broker_url
-            with Connection(broker_url) as con:
-                receiver = EventReceiver(
-                    con,
-                    handlers={
-                        "task-sent": self._process_task_sent,
-                        "task-received": self._process_task_received,
-                        "task-started": self._process_task_started,
-                        "task-succeeded": self._process_task_succeeded,
-                        "task-failed": self._process_task_failed,
-                    },
-                )
-                receiver.capture(limit=None, timeout=None)
-
-        await asyncio.to_thread(_run_receiver)
+        """Starts the event receivers, each in its own thread"""
+        self._receivers_stopping.clear()
+        # Receivers block their threads for good, so they get their own pool instead of the default executor
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.receivers, thread_name_prefix="veggie-receiver")
+        futures = [loop.run_in_executor(executor, self._run_receiver) for _ in range(self.receivers)]
+        try:
+            await asyncio.gather(*futures)
+        finally:
+            # The receivers check these flags every second, so their threads end after the monitor stops
+            with self._receivers_lock:
+                self._receivers_stopping.set()
+                for receiver in self._receivers:
+                    receiver.should_stop = True
+            # Joining the threads would block the event loop, which receivers need to submit their last events
+            executor.shutdown(wait=False)
+            await asyncio.gather(*futures, return_exceptions=True)
+
+    async def start_pruner(self) -> None:
+        """Periodically deletes events according to the retention policy"""
+        if self.retention is None:
+            return
+
+        while True:
+            try:
+                deleted = await asyncio.to_thread(self.storage.prune, self.retention)
+                if deleted:
+                    logger.info(f"Pruned {deleted} events")
+            except Exception:
+                logger.exception("Failed to prune events")
+            await asyncio.sleep(self.prune_interval)
 
     async def start_webapp(self) -> None:
         """Starts the webapp asynchronously"""
+        server = create_server(app_factory=lambda: self.flask_app, config=self.server)
+        try:
+            await asyncio.to_thread(server.serve)
+        finally:
+            server.shutdown()
 
-        def _run_webapp() -> None:
-            """Starts the UI asynchronously"""
-            self.flask_app.run(host="0.0.0.0", port=os.getenv("VEGGIE_PORT", 5000))
-
-        await asyncio.to_thread(_run_webapp)
+    def _replay_spool(self, batch_size: int = 500) -> None:
+        """Stores the spooled events of the previous run, which may not have been stored, and empties the spool"""
+        assert self.spool is not None
+        replayed = 0
+        batch: list[dict] = []
+        for event in self.spool.replay():
+            batch.append(event)
+            if len(batch) == batch_size:
+                self.storage.store_events(batch)
+                replayed += len(batch)
+                batch = []
+        if batch:
+            self.storage.store_events(batch)
+            replayed += len(batch)
+        self.spool.reset()
+        if replayed:
+            logger.info(f"Replayed {replayed} events from the spool")
 
-    def start(self) -> None:
-        """Starts all services in the event loop"""
+    async def run(self, webapp: bool = True) -> None:
+        """
+        Runs all services until one of them fails or `stop()` is called
 
-        async def _start_coroutine() -> None:
-            event_receiver_task = asyncio.create_task(self.start_event_receiver())
-            logger.info("Started Event Receiver")
+        Args:
+            webapp: Whether to serve the web app. With False, the monitor only ingests events, and the web app
+                can be served by other processes reading the same storage.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop_requested = asyncio.Event()
+        if self.spool is not None:
+            await asyncio.to_thread(self._replay_spool)
+        pipeline_tasks = [asyncio.create_task(pipeline.run()) for pipeline in self.pipelines]
+        # Lets the pipelines start before the receivers submit events to them
+        await asyncio.sleep(0)
 
-            webapp_task = asyncio.create_task(self.start_webapp())
+        tasks = [asyncio.create_task(self.start_event_receiver()), asyncio.create_task(self.start_pruner())]
+        logger.info(f"Started {self.receivers} Event Receivers and {len(self.pipelines)} writers")
+        if webapp:
+            tasks.append(asyncio.create_task(self.start_webapp()))
             logger.info("Started Web App")
 
-            await asyncio.gather(event_receiver_task, webapp_task)
+        services = asyncio.gather(*tasks)
+        stop_requested = asyncio.create_task(self._stop_requested.wait())
+        waited: list[asyncio.Future] = [services, stop_requested]
+        try:
+            await asyncio.wait(waited, return_when=asyncio.FIRST_COMPLETED)
+            if services.done():
+                # Raises the error of the service that failed, if any
+                services.result()
+        finally:
+            stop_requested.cancel()
+            services.cancel()
+            # Waits for the services to clean up, e.g. for the web server to complete the requests in progress
+            await asyncio.gather(services, return_exceptions=True)
+            # Stores and publishes the events already received
+            for pipeline in self.pipelines:
+                await pipeline.stop()
+            await asyncio.gather(*pipeline_tasks)
+            self._loop = None
+
+    def stop(self) -> None:
+        """Stops the monitor from another thread. `start()` returns once the received events are stored."""
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stop_requested.set)
 
-        asyncio.run(_start_coroutine())
+    def start(self, webapp: bool = True) -> None:
+        """
+        Starts all services in the event loop, blocking until they stop
+
+        Args:
+            webapp: Whether to serve the web app. With False, the monitor only ingests events, and the web app
+                can be served by other processes reading the same storage.
+        """
+        try:
+            asyncio.run(self.run(webapp=webapp))
+        finally:
+            # Flushes any buffered events before exiting
+            self.storage.close()
+            if self.spool is not None:
+                self.spool.close()
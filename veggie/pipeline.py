@@ -0,0 +1,284 @@
+"""
+Asyncio pipeline from the event receiver to storage and live subscribers
+"""
+import asyncio
+import threading
+from typing import Protocol
+
+from loguru import logger
+
+from .bus import EventBus
+from .spool import EventSpool
+from .state import merge_event
+from .storage import Storage
+
+# Marks the end of the stream of events, passed through all stages when the pipeline stops
+_STOP = object()
+# How often a thread blocked in `EventPipeline.submit()` checks whether the pipeline is stopping
+SUBMIT_POLL_SECONDS = 0.1
+
+
+class AsyncStorage(Protocol):
+    """Storage used from asyncio code"""
+
+    async def store_events(self, events: list[dict]) -> None:
+        """Stores a batch of events"""
+
+    async def get_event_by_id(self, id: str) -> dict | None:
+        """Gets single event by its ID"""
+
+    async def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """Gets a page of events, with the same arguments as the synchronous storage"""
+
+    async def close(self) -> None:
+        """Releases any resources held by the storage"""
+
+
+class ThreadedAsyncStorage:
+    """
+    AsyncStorage running the methods of a synchronous storage in worker threads
+
+    The event loop keeps running while the storage blocks, e.g. on disk I/O or on a database lock.
+    """
+
+    def __init__(self, storage: Storage) -> None:
+        """Initializes the adapter"""
+        self.storage = storage
+
+    async def store_events(self, events: list[dict]) -> None:
+        """Stores a batch of events in a worker thread"""
+        await asyncio.to_thread(self.storage.store_events, events)
+
+    async def get_event_by_id(self, id: str) -> dict | None:
+        """Gets single event by its ID in a worker thread"""
+        return await asyncio.to_thread(self.storage.get_event_by_id, id)
+
+    async def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """Gets a page of events in a worker thread"""
+        return await asyncio.to_thread(
+            self.storage.query_events,
+            limit=limit,
+            after=after,
+            name=name,
+            state=state,
+            hostname=hostname,
+            sent_after=sent_after,
+            sent_before=sent_before,
+            search=search,
+            order=order,
+        )
+
+    async def close(self) -> None:
+        """Closes the storage in a worker thread"""
+        await asyncio.to_thread(self.storage.close)
+
+
+class EventPipeline:
+    """
+    Moves events through receive -> reduce -> persist -> publish stages connected by bounded queues
+
+    - receive: `submit()` queues an event from the receiver thread, blocking it while the queue is full.
+    - reduce: groups events into batches of up to `batch_size` events or `batch_interval` seconds. Each batch
+      keeps all events in order for storage, and their merge per task for the live subscribers.
+    - persist: stores each batch in one call to the storage, retried with backoff if it fails.
+    - publish: sends the merged events of stored batches to the event bus.
+
+    If storage falls behind, the full queues throttle each stage down to the receiver, so the events wait in
+    the broker instead of piling up in memory.
+    """
+
+    def __init__(
+        self,
+        storage: AsyncStorage,
+        event_bus: EventBus | None = None,
+        queue_size: int = 10000,
+        batch_size: int = 500,
+        batch_interval: float = 0.5,
+        max_pending_batches: int = 4,
+        spool: EventSpool | None = None,
+        max_retries: int = 3,
+        retry_delay: float = 0.5,
+    ) -> None:
+        """
+        Initializes the pipeline
+
+        Args:
+            storage: Storage the batches are persisted to.
+            event_bus: Bus the stored events are published to. None doesn't publish them.
+            queue_size: Maximum number of received events waiting to be batched.
+            batch_size: Maximum number of events per batch.
+            batch_interval: Maximum time in seconds to wait for more events before a batch is persisted.
+            max_pending_batches: Maximum number of batches waiting to be persisted, and to be published.
+            spool: Spool the events are appended to when received, and marked in once stored. None doesn't
+                keep events outside of memory until they are stored.
+            max_retries: Number of times a batch that failed to be stored is tried again. After that, it is
+                dropped and its events are set aside in the spool, if any, to be replayed on restart.
+            retry_delay: Seconds before the first retry, doubled for each next one.
+        """
+        self.storage = storage
+        self.event_bus = event_bus
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.spool = spool
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._received: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._batches: asyncio.Queue = asyncio.Queue(maxsize=max_pending_batches)
+        self._stored: asyncio.Queue = asyncio.Queue(maxsize=max_pending_batches)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+        self._stopped: asyncio.Event | None = None
+        self._stopping = False
+
+    @property
+    def is_running(self) -> bool:
+        """Whether the pipeline accepts events"""
+        return self._loop is not None
+
+    async def run(self) -> None:
+        """Runs the stages until the pipeline is stopped and all received events are processed"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped = asyncio.Event()
+        self._stopping = False
+        try:
+            await asyncio.gather(self._reduce(), self._persist(), self._publish())
+        finally:
+            self._loop = None
+            self._stopped.set()
+
+    async def put(self, event: dict) -> None:
+        """Queues an event from the event loop, waiting while the queue is full"""
+        await self._received.put(self._spooled(event))
+
+    def submit(self, event: dict) -> None:
+        """
+        Queues an event from another thread, blocking it while the queue is full
+
+        Raises:
+            RuntimeError: If the pipeline is not running, or stops before the event is queued. A spooled event is
+                then left in the spool, to be replayed on restart.
+        """
+        loop = self._loop
+        if loop is None or self._stopping:
+            raise RuntimeError("The pipeline is not running")
+        if threading.get_ident() == self._loop_thread:
+            raise RuntimeError("Use `await pipeline.put()` from the event loop")
+        future = asyncio.run_coroutine_threadsafe(self._received.put(self._spooled(event)), loop)
+        # Once stopping, the pipeline may no longer empty its queue, so waiting on a full one must not block forever
+        while True:
+            try:
+                return future.result(timeout=SUBMIT_POLL_SECONDS)
+            except TimeoutError:
+                if self._stopping:
+                    future.cancel()
+                    raise RuntimeError("The pipeline is stopping") from None
+
+    async def stop(self) -> None:
+        """Stops accepting events and waits until the events already received are stored and published"""
+        if self._loop is None or self._stopped is None:
+            return
+        stopped = self._stopped
+        self._stopping = True
+        await self._received.put(_STOP)
+        await stopped.wait()
+
+    def _spooled(self, event: dict) -> tuple[dict, int | None]:
+        """Appends an event to the spool, if any, and returns it with its spool ticket"""
+        return event, self.spool.append(event) if self.spool is not None else None
+
+    def pending(self) -> dict:
+        """Returns the number of events waiting to be batched and of batches waiting to be stored"""
+        return {"events": self._received.qsize(), "batches": self._batches.qsize()}
+
+    async def _next_batch(self) -> tuple[list[tuple[dict, int | None]], bool]:
+        """Waits for the first event and collects more until the batch is full or due"""
+        event = await self._received.get()
+        if event is _STOP:
+            return [], True
+        batch = [event]
+        deadline = asyncio.get_running_loop().time() + self.batch_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(self._received.get(), timeout)
+            except TimeoutError:
+                break
+            if event is _STOP:
+                return batch, True
+            batch.append(event)
+        return batch, False
+
+    async def _reduce(self) -> None:
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._next_batch()
+            if not batch:
+                continue
+            events = [event for event, _ in batch]
+            tickets = [ticket for _, ticket in batch if ticket is not None]
+            merged: dict[str, dict] = {}
+            for event in events:
+                merged[event["uuid"]] = merge_event(merged.get(event["uuid"], {}), event)
+            await self._batches.put((events, tickets, list(merged.values())))
+        await self._batches.put(_STOP)
+
+    async def _persist(self) -> None:
+        while (batch := await self._batches.get()) is not _STOP:
+            events, tickets, merged = batch
+            if not await self._store(events):
+                if self.spool is not None:
+                    # Set aside to be replayed on restart, so that the spool can drop the events stored after them
+                    await asyncio.to_thread(self.spool.mark_failed, events, tickets)
+                continue
+            if self.spool is not None:
+                await asyncio.to_thread(self.spool.mark_stored, tickets)
+            await self._stored.put(merged)
+        await self._stored.put(_STOP)
+
+    async def _store(self, events: list[dict]) -> bool:
+        """Stores a batch, retrying with exponential backoff, and returns whether it succeeded"""
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.storage.store_events(events)
+                return True
+            except Exception:
+                if attempt == self.max_retries:
+                    logger.exception(f"Failed to store a batch of {len(events)} events")
+                    break
+                logger.warning(f"Failed to store a batch of {len(events)} events, retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
+                delay *= 2
+        return False
+
+    async def _publish(self) -> None:
+        while (merged := await self._stored.get()) is not _STOP:
+            if self.event_bus is not None:
+                for event in merged:
+                    self.event_bus.publish(event)
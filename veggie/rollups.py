@@ -0,0 +1,258 @@
+"""
+Pre-aggregated task metrics for SQLiteStorage
+
+Rollup tables hold, per time bucket and task name, the number of tasks in each state and the count, sum, min,
+max and a fixed-bucket histogram of their runtime and queue wait. Tasks are assigned to buckets by their sent
+timestamp, like in `Storage.get_stats()`. The tables are kept up to date by triggers on the events table, so
+every write or deletion of an event updates the rollups in the same statement.
+"""
+
+# Resolutions of the rollup tables in seconds, by table name
+RESOLUTIONS = {"rollup_minute": 60, "rollup_hour": 3600}
+
+# Rollup count column of each task state. States not listed, custom or missing, are counted in "other" and reported
+# as OTHER_STATE, by every stats path so that stats read from rollups and from events agree.
+STATE_COLUMNS = {
+    "task-sent": "sent",
+    "task-received": "received",
+    "task-started": "started",
+    "task-succeeded": "succeeded",
+    "task-failed": "failed",
+    "task-retried": "retried",
+    "task-revoked": "revoked",
+    "task-rejected": "rejected",
+}
+OTHER_STATE = "unknown"
+
+# Metric expressions, in terms of a row of the events table
+METRICS = {"runtime": "{row}.runtime", "queue_wait": "({row}.received_timestamp - {row}.sent_timestamp)"}
+
+# Upper bounds in seconds of the histogram buckets. The last bucket has no upper bound.
+HISTOGRAM_BOUNDS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# Columns aggregated with sum(), min() and max() respectively
+SUM_COLUMNS = [
+    *STATE_COLUMNS.values(),
+    "other",
+    *(
+        column
+        for metric in METRICS
+        for column in (
+            f"{metric}_count",
+            f"{metric}_sum",
+            *(f"{metric}_h{i}" for i in range(len(HISTOGRAM_BOUNDS) + 1)),
+        )
+    ),
+]
+MIN_COLUMNS = [f"{metric}_min" for metric in METRICS]
+MAX_COLUMNS = [f"{metric}_max" for metric in METRICS]
+COLUMNS = SUM_COLUMNS + MIN_COLUMNS + MAX_COLUMNS
+
+
+def column_terms(row: str) -> dict[str, str]:
+    """
+    SQL expressions of the contribution of one task to each rollup column
+
+    Args:
+        row: Name of the events row, e.g. "new" and "old" in triggers or the table name in queries.
+    """
+    states = ", ".join(f"'{state}'" for state in STATE_COLUMNS)
+    terms = {column: f"({row}.state IS '{state}')" for state, column in STATE_COLUMNS.items()}
+    terms["other"] = f"({row}.state IS NULL OR {row}.state NOT IN ({states}))"
+    for metric, template in METRICS.items():
+        value = template.format(row=row)
+        terms[f"{metric}_count"] = f"({value} IS NOT NULL)"
+        terms[f"{metric}_sum"] = f"coalesce({value}, 0)"
+        bounds = [None, *HISTOGRAM_BOUNDS, None]
+        for i, (lower, upper) in enumerate(zip(bounds[:-1], bounds[1:], strict=True)):
+            conditions = [f"{value} > {lower}" if lower is not None else None]
+            conditions.append(f"{value} <= {upper}" if upper is not None else None)
+            terms[f"{metric}_h{i}"] = f"coalesce({' AND '.join(c for c in conditions if c)}, 0)"
+        terms[f"{metric}_min"] = value
+        terms[f"{metric}_max"] = value
+    return terms
+
+
+def bucket_term(row: str, seconds: int) -> str:
+    """SQL expression of the rollup bucket of a task"""
+    return f"CAST({row}.sent_timestamp / {seconds} AS INTEGER) * {seconds}"
+
+
+def create_statements(table: str, seconds: int, events_table: str) -> list[str]:
+    """Statements creating a rollup table and the triggers maintaining it"""
+    columns = ", ".join(
+        [f"{column} INTEGER NOT NULL DEFAULT 0" for column in SUM_COLUMNS]
+        + [f"{column} REAL" for column in MIN_COLUMNS + MAX_COLUMNS]
+    )
+    new_terms, old_terms = column_terms("new"), column_terms("old")
+
+    insert_new = f"""
+        INSERT INTO {table} (bucket, name, {", ".join(COLUMNS)})
+        SELECT {bucket_term("new", seconds)}, coalesce(new.name, ''), {", ".join(new_terms[c] for c in COLUMNS)}
+        WHERE new.sent_timestamp IS NOT NULL
+        ON CONFLICT (bucket, name) DO UPDATE SET {", ".join(
+            [f"{c} = {c} + excluded.{c}" for c in SUM_COLUMNS]
+            + [f"{c} = min(coalesce({c}, excluded.{c}), coalesce(excluded.{c}, {c}))" for c in MIN_COLUMNS]
+            + [f"{c} = max(coalesce({c}, excluded.{c}), coalesce(excluded.{c}, {c}))" for c in MAX_COLUMNS]
+        )};
+    """
+    # Minimum and maximum can't be undone, they keep covering all values a task ever had
+    remove_old = f"""
+        UPDATE {table} SET {", ".join(f"{c} = {c} - {old_terms[c]}" for c in SUM_COLUMNS)}
+        WHERE bucket = {bucket_term("old", seconds)} AND name = coalesce(old.name, '');
+    """
+    # Deleted tasks, e.g. by retention, are removed from their bucket, and buckets left without tasks are dropped
+    empty = " AND ".join(f"{column} = 0" for column in [*STATE_COLUMNS.values(), "other"])
+    delete_old = f"""
+        {remove_old}
+        DELETE FROM {table} WHERE bucket = {bucket_term("old", seconds)} AND name = coalesce(old.name, '') AND {empty};
+    """
+    changed = " OR ".join(
+        f"old.{column} IS NOT new.{column}"
+        for column in ("state", "name", "sent_timestamp", "received_timestamp", "runtime")
+    )
+
+    return [
+        f"CREATE TABLE IF NOT EXISTS {table} (bucket INTEGER, name TEXT, {columns}, PRIMARY KEY (bucket, name))",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON {events_table} BEGIN {insert_new} END",
+        f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_update AFTER UPDATE ON {events_table} WHEN {changed}
+            BEGIN {remove_old} {insert_new} END
+        """,
+        f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {events_table}
+            WHEN old.sent_timestamp IS NOT NULL BEGIN {delete_old} END
+        """,
+    ]
+
+
+def rebuild_statements(table: str, seconds: int, events_table: str) -> list[str]:
+    """Statements recomputing a rollup table from the events table"""
+    terms = column_terms(events_table)
+    aggregates = (
+        [f"sum({terms[c]})" for c in SUM_COLUMNS]
+        + [f"min({terms[c]})" for c in MIN_COLUMNS]
+        + [f"max({terms[c]})" for c in MAX_COLUMNS]
+    )
+    return [
+        f"DELETE FROM {table}",
+        f"""
+            INSERT INTO {table} (bucket, name, {", ".join(COLUMNS)})
+            SELECT {bucket_term(events_table, seconds)} AS rollup_bucket, coalesce(name, '') AS rollup_name,
+                {", ".join(aggregates)}
+            FROM {events_table} WHERE sent_timestamp IS NOT NULL
+            GROUP BY rollup_bucket, rollup_name
+        """,
+    ]
+
+
+def stats_query(
+    table: str,
+    seconds: int,
+    events_table: str,
+    start: float,
+    end: float,
+    bucket_seconds: int,
+    group_by: tuple[str, ...],
+    name: str | None,
+) -> tuple[str, list]:
+    """
+    Query aggregating rollups into stats buckets
+
+    Whole rollup buckets inside the time range are read from the rollup table. The partial buckets at the start
+    and end of the range, such as the current one, are aggregated from the events table.
+
+    Returns:
+        The query and its parameters. Each row has the stats bucket, the group columns and then `COLUMNS`.
+    """
+    rollup_start = -(-start // seconds) * seconds
+    rollup_end = end // seconds * seconds
+    if rollup_start >= rollup_end:
+        rollup_start = rollup_end = end
+
+    terms = column_terms(events_table)
+    name_filter = " AND name = ?" if name is not None else ""
+    groups = "".join(f", {column}" for column in group_by)
+    aggregates = (
+        [f"sum({c})" for c in SUM_COLUMNS] + [f"min({c})" for c in MIN_COLUMNS] + [f"max({c})" for c in MAX_COLUMNS]
+    )
+
+    query = f"""
+        SELECT CAST(bucket / ? AS INTEGER) * ? AS stats_bucket{groups}, {", ".join(aggregates)}
+        FROM (
+            SELECT bucket, name, {", ".join(COLUMNS)} FROM {table}
+            WHERE bucket >= ? AND bucket < ?{name_filter}
+            UNION ALL
+            SELECT {bucket_term(events_table, seconds)}, coalesce(name, ''), {", ".join(terms[c] for c in COLUMNS)}
+            FROM {events_table}
+            WHERE ((sent_timestamp >= ? AND sent_timestamp < ?) OR (sent_timestamp >= ? AND sent_timestamp < ?))
+                {name_filter}
+        )
+        GROUP BY stats_bucket{groups} ORDER BY stats_bucket{groups}
+    """
+    name_params = [name] if name is not None else []
+    params = [
+        bucket_seconds,
+        bucket_seconds,
+        rollup_start,
+        rollup_end,
+        *name_params,
+        start,
+        rollup_start,
+        rollup_end,
+        end,
+        *name_params,
+    ]
+    return query, params
+
+
+def estimate_percentile(percentile: int, histogram: list[int], minimum: float, maximum: float) -> float:
+    """
+    Estimates a percentile from a histogram
+
+    The estimate is the upper bound of the histogram bucket holding the nearest rank, clamped to the observed
+    minimum and maximum.
+    """
+    rank = max(1, -(-percentile * sum(histogram) // 100))
+    cumulative = 0
+    for bound, count in zip([*HISTOGRAM_BOUNDS, maximum], histogram, strict=True):
+        cumulative += count
+        if cumulative >= rank:
+            return max(minimum, min(bound, maximum))
+    return maximum
+
+
+def row_to_stats(row: tuple, group_by: tuple[str, ...], percentiles: tuple[int, ...]) -> dict:
+    """Converts a row of `stats_query()` into the stats format of `Storage.get_stats()`"""
+    key_size = 1 + len(group_by)
+    values = dict(zip(COLUMNS, row[key_size:], strict=True))
+
+    states = {state: values[column] for state, column in STATE_COLUMNS.items() if values[column]}
+    if values["other"]:
+        states[OTHER_STATE] = values["other"]
+    finished = values["succeeded"] + values["failed"]
+
+    stats = {
+        "bucket": row[0],
+        # Rollups store a missing name as an empty string
+        **{column: value or None for column, value in zip(group_by, row[1:key_size], strict=True)},
+        "count": sum(states.values()),
+        "states": states,
+        "failure_ratio": values["failed"] / finished if finished else None,
+        "percentiles_estimated": True,
+    }
+    for metric in METRICS:
+        count = values[f"{metric}_count"]
+        if not count:
+            stats[metric] = {"avg": None, **{f"p{percentile}": None for percentile in percentiles}}
+            continue
+        histogram = [values[f"{metric}_h{i}"] for i in range(len(HISTOGRAM_BOUNDS) + 1)]
+        minimum, maximum = values[f"{metric}_min"], values[f"{metric}_max"]
+        stats[metric] = {
+            "avg": values[f"{metric}_sum"] / count,
+            **{
+                f"p{percentile}": estimate_percentile(percentile, histogram, minimum, maximum)
+                for percentile in percentiles
+            },
+        }
+    return stats
@@ -0,0 +1,229 @@
+"""
+HTTP servers running the web app
+"""
+import os
+import signal
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from loguru import logger
+
+
+@dataclass
+class ServerConfig:
+    """
+    Settings of the HTTP server of the web app
+
+    Attributes:
+        host: Interface to listen on.
+        port: Port to listen on.
+        server: "werkzeug" for Flask's development server, "waitress" for a multi-threaded production server or
+            "gunicorn" for a multi-process production server. waitress and gunicorn are optional dependencies,
+            installed with `pip install veggie[waitress]` or `pip install veggie[gunicorn]`.
+        threads: Number of threads handling requests, per process.
+        workers: Number of processes handling requests. Only gunicorn runs more than one.
+        keep_alive: Seconds an idle keep-alive connection is kept open. Not applied by werkzeug.
+        graceful_timeout: Seconds the requests in progress get to complete when the server shuts down.
+        max_streams: Maximum number of live event streams open at once, per process. Each open status page holds
+            one, and a thread with it, so this must stay below `threads` to leave threads for other requests.
+            Three quarters of `threads` by default.
+    """
+
+    host: str = "0.0.0.0"
+    port: int = 5000
+    server: str = "werkzeug"
+    threads: int = 64
+    workers: int = 1
+    keep_alive: int = 5
+    graceful_timeout: int = 30
+    max_streams: int | None = None
+
+    @property
+    def stream_limit(self) -> int:
+        """Maximum number of live event streams open at once, per process"""
+        if self.max_streams is not None:
+            return self.max_streams
+        return max(1, self.threads * 3 // 4)
+
+
+class WebServer(ABC):
+    """Serves a WSGI app until it is shut down"""
+
+    def __init__(self, app_factory: Callable[[], Any], config: ServerConfig) -> None:
+        """
+        Initializes the server
+
+        Args:
+            app_factory: Creates the WSGI app. Multi-process servers call it once in each process.
+            config: Server settings.
+        """
+        self.app_factory = app_factory
+        self.config = config
+
+    @abstractmethod
+    def serve(self) -> None:
+        """Serves requests, blocking until the server is shut down"""
+
+    @abstractmethod
+    def shutdown(self) -> None:
+        """Stops accepting connections and waits for the requests in progress, up to the graceful timeout"""
+
+
+class WerkzeugServer(WebServer):
+    """Flask's development server, handling each request in a new thread"""
+
+    def __init__(self, app_factory: Callable[[], Any], config: ServerConfig) -> None:
+        """Binds the server to its address"""
+        from werkzeug.serving import make_server
+
+        super().__init__(app_factory=app_factory, config=config)
+        self._server = make_server(host=config.host, port=config.port, app=app_factory(), threaded=True)
+
+    @property
+    def port(self) -> int:
+        """Port the server listens on, useful when the configured port is 0"""
+        return self._server.server_port
+
+    def serve(self) -> None:
+        """Serves requests until `shutdown()` is called"""
+        self._server.serve_forever()
+
+    def shutdown(self) -> None:
+        """Stops serving. Requests in progress complete in their own threads."""
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class WaitressServer(WebServer):
+    """waitress server, handling requests in a fixed pool of threads"""
+
+    def __init__(self, app_factory: Callable[[], Any], config: ServerConfig) -> None:
+        """
+        Binds the server to its address
+
+        Raises:
+            ImportError: If waitress is not installed.
+        """
+        try:
+            from waitress.server import create_server
+        except ImportError as e:
+            raise ImportError("The waitress server requires `pip install veggie[waitress]`") from e
+
+        super().__init__(app_factory=app_factory, config=config)
+        # All sockets of the server, owned by its thread. Passed explicitly so `shutdown()` can close them.
+        self._map: dict = {}
+        self._server = create_server(
+            app_factory(),
+            map=self._map,
+            host=config.host,
+            port=config.port,
+            threads=config.threads,
+            channel_timeout=config.keep_alive,
+        )
+
+    @property
+    def port(self) -> int:
+        """Port the server listens on, useful when the configured port is 0"""
+        return self._server.effective_port
+
+    def serve(self) -> None:
+        """Serves requests until `shutdown()` is called"""
+        self._server.run()
+
+    def shutdown(self) -> None:
+        """Stops accepting connections, waits for the requests in progress and closes all connections"""
+        from waitress import wasyncore
+        from waitress.server import BaseWSGIServer
+
+        listeners = [dispatcher for dispatcher in list(self._map.values()) if isinstance(dispatcher, BaseWSGIServer)]
+        for listener in listeners:
+            listener.accepting = False
+        self._server.task_dispatcher.shutdown(timeout=self.config.graceful_timeout)
+        # Sockets are closed from the server thread, which then returns from `serve()`
+        if listeners:
+            listeners[0].trigger.pull_trigger(lambda: wasyncore.close_all(self._map))
+
+
+class GunicornServer(WebServer):
+    """
+    gunicorn server, handling requests in several processes with a pool of threads each
+
+    gunicorn handles the SIGINT and SIGTERM signals itself, so it must run in the main thread of the main process.
+    Each worker process creates its own app, and so its own storage connection.
+    """
+
+    def __init__(self, app_factory: Callable[[], Any], config: ServerConfig) -> None:
+        """
+        Configures the server
+
+        Raises:
+            ImportError: If gunicorn is not installed.
+        """
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError as e:
+            raise ImportError("The gunicorn server requires `pip install veggie[gunicorn]`") from e
+
+        super().__init__(app_factory=app_factory, config=config)
+        options = {
+            "bind": f"{config.host}:{config.port}",
+            "workers": config.workers,
+            "threads": config.threads,
+            "worker_class": "gthread",
+            "keepalive": config.keep_alive,
+            "graceful_timeout": config.graceful_timeout,
+        }
+
+        class _Application(BaseApplication):
+            def load_config(self) -> None:
+                for key, value in options.items():
+                    self.cfg.set(key, value)
+
+            def load(self) -> Any:
+                return app_factory()
+
+        self._application = _Application()
+        self._serving = False
+
+    def serve(self) -> None:
+        """
+        Serves requests until the process receives SIGINT or SIGTERM
+
+        Raises:
+            RuntimeError: If not called from the main thread.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("gunicorn must run in the main thread")
+        self._serving = True
+        try:
+            self._application.run()
+        finally:
+            self._serving = False
+
+    def shutdown(self) -> None:
+        """Sends SIGTERM to this process, on which gunicorn stops gracefully. Does nothing if not serving."""
+        if self._serving:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+SERVERS: dict[str, type[WebServer]] = {
+    "werkzeug": WerkzeugServer,
+    "waitress": WaitressServer,
+    "gunicorn": GunicornServer,
+}
+
+
+def create_server(app_factory: Callable[[], Any], config: ServerConfig) -> WebServer:
+    """
+    Creates the server selected in the config
+
+    Raises:
+        ValueError: If the server is unknown.
+        ImportError: If the server is not installed.
+    """
+    if config.server not in SERVERS:
+        raise ValueError(f"Unknown server {config.server}, expected one of {', '.join(SERVERS)}")
+    logger.info(f"Serving the web app with {config.server} on {config.host}:{config.port}")
+    return SERVERS[config.server](app_factory=app_factory, config=config)
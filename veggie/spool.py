@@ -0,0 +1,172 @@
+"""
+Append-only local spool of the received events that are not stored yet
+"""
+import json
+import os
+import threading
+from collections import deque
+from typing import Iterator
+
+from loguru import logger
+
+
+class EventSpool:
+    """
+    Write-ahead log of received events, replayed on restart
+
+    Each event is appended to the spool file as a JSON line when it is received and marked once its batch is
+    stored. A sidecar file records the position before which all events are stored, so after a crash or a storage
+    failure only the events after it are replayed. Appends are single unbuffered writes, so they survive a crash of
+    the process; `fsync=True` also makes them survive a crash of the machine, at the cost of a disk flush per event.
+
+    Events are marked stored in any order, e.g. by several writers. The committed position only advances over
+    events that are all stored. Once it passes `max_bytes`, the stored head of the file is dropped. Events that
+    can't be stored are moved to a second file with `mark_failed()`, so that they don't hold the position back,
+    and are replayed too.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 16 * 1024 * 1024, fsync: bool = False) -> None:
+        """
+        Opens the spool, creating it if needed
+
+        Args:
+            path: Path of the spool file. The committed position is kept in `<path>.committed`, and the events that
+                failed to be stored in `<path>.failed`.
+            max_bytes: Size of stored events after which the file is compacted.
+            fsync: Whether to flush each event to disk before returning from `append()`.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self._committed_path = f"{path}.committed"
+        self._failed_path = f"{path}.failed"
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # Positions are logical: the bytes dropped by compactions are counted in `_base`
+        self._base = 0
+        self._end = os.fstat(self._fd).st_size
+        self._committed = self._read_committed()
+        # End position of each appended event not committed yet, in order, and those already stored
+        self._pending: deque[int] = deque()
+        self._stored: set[int] = set()
+
+    def _read_committed(self) -> int:
+        try:
+            with open(self._committed_path) as file:
+                return min(int(file.read() or 0), self._end)
+        except FileNotFoundError:
+            return 0
+
+    def _write_committed(self, position: int) -> None:
+        """Atomically replaces the committed position, relative to the start of the file"""
+        temp_path = f"{self._committed_path}.tmp"
+        with open(temp_path, "w") as file:
+            file.write(str(position))
+        os.replace(temp_path, self._committed_path)
+
+    def append(self, event: dict) -> int:
+        """
+        Appends an event
+
+        Returns:
+            The ticket of the event, to pass to `mark_stored()` once it is stored.
+        """
+        line = (json.dumps(event, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            os.write(self._fd, line)
+            if self.fsync:
+                os.fsync(self._fd)
+            self._end += len(line)
+            self._pending.append(self._end)
+            return self._end
+
+    def mark_stored(self, tickets: list[int]) -> None:
+        """Marks events as stored and advances the committed position over the events that are all stored"""
+        with self._lock:
+            self._stored.update(tickets)
+            committed = self._committed
+            while self._pending and self._pending[0] in self._stored:
+                committed = self._pending.popleft()
+                self._stored.discard(committed)
+            if committed == self._committed:
+                return
+            self._committed = committed
+            if committed - self._base > self.max_bytes:
+                self._compact()
+            else:
+                self._write_committed(committed - self._base)
+
+    def mark_failed(self, events: list[dict], tickets: list[int]) -> None:
+        """
+        Sets aside events that failed to be stored, to be replayed on restart, and marks them done in the spool
+
+        Args:
+            events: The events that failed to be stored.
+            tickets: Their tickets.
+        """
+        lines = b"".join((json.dumps(event, separators=(",", ":")) + "\n").encode() for event in events)
+        with self._lock, open(self._failed_path, "ab") as file:
+            file.write(lines)
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        # A crash before the events are marked replays them twice, which is harmless
+        self.mark_stored(tickets)
+
+    def _compact(self) -> None:
+        """Rewrites the file without its committed head. Called with the lock held."""
+        with open(self.path, "rb") as file:
+            file.seek(self._committed - self._base)
+            tail = file.read()
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(tail)
+        # A crash between the two replacements replays stored events, which is harmless, but never skips any
+        self._write_committed(0)
+        os.replace(temp_path, self.path)
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self._base = self._committed
+
+    def pending(self) -> int:
+        """Returns the number of appended events that are not stored yet"""
+        with self._lock:
+            return len(self._pending)
+
+    def replay(self) -> Iterator[dict]:
+        """
+        Yields the events of the previous run that may not be stored
+
+        These are the events that failed to be stored, then those after the committed position. Call it before
+        appending new events. A last line cut short by a crash is skipped.
+        """
+        if os.path.exists(self._failed_path):
+            yield from self._read_lines(self._failed_path, 0)
+        yield from self._read_lines(self.path, self._committed - self._base)
+
+    @staticmethod
+    def _read_lines(path: str, position: int) -> Iterator[dict]:
+        """Yields the events of a file from a position"""
+        with open(path, "rb") as file:
+            file.seek(position)
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skipped a corrupted line of the spool {path}")
+
+    def reset(self) -> None:
+        """Empties the spool, once all events are stored"""
+        with self._lock:
+            os.ftruncate(self._fd, 0)
+            self._write_committed(0)
+            if os.path.exists(self._failed_path):
+                os.remove(self._failed_path)
+            self._base = self._end = self._committed = 0
+            self._pending.clear()
+            self._stored.clear()
+
+    def close(self) -> None:
+        """Closes the spool file"""
+        with self._lock:
+            os.close(self._fd)
@@ -0,0 +1,64 @@
+"""
+Merging of task events that may arrive out of order
+
+Events of the same task are merged into one document. As in Celery's `State`, an event that logically happened
+before the current state of the task, e.g. a `task-started` processed after `task-succeeded`, only fills in the
+fields the document doesn't have yet and never moves the task back to an earlier state.
+"""
+
+# Lifecycle position of each event type, from the same order as Celery's state precedence
+PRECEDENCE = {
+    "task-sent": 0,
+    "task-retried": 1,
+    "task-rejected": 2,
+    "task-received": 3,
+    "task-started": 4,
+    "task-revoked": 5,
+    "task-failed": 7,
+    "task-succeeded": 8,
+}
+# Position of custom event types
+UNKNOWN_PRECEDENCE = 6
+# A retried task starts its lifecycle again, so retries are ordered by time only
+RETRIED = "task-retried"
+
+
+def precedence(event_type: str) -> int:
+    """Returns the lifecycle position of an event type"""
+    return PRECEDENCE.get(event_type, UNKNOWN_PRECEDENCE)
+
+
+def timestamp_field(event_type: str) -> str:
+    """Returns the field holding the time of an event, e.g. `started_timestamp` for `task-started`"""
+    return f"{event_type.removeprefix('task-')}_timestamp"
+
+
+def supersedes(event: dict, current: dict) -> bool:
+    """
+    Whether an event moves a task to its state
+
+    Events of a later lifecycle state supersede earlier ones. Events of the same state, and any event when a
+    retry is involved, are ordered by their timestamps. Events without a type or timestamp to compare are
+    taken in arrival order.
+    """
+    event_type, current_type = event.get("type"), current.get("type")
+    if event_type is None or current_type is None:
+        return True
+    if RETRIED in (event_type, current_type) or precedence(event_type) == precedence(current_type):
+        timestamp = event.get(timestamp_field(event_type))
+        current_timestamp = current.get(timestamp_field(current_type))
+        return timestamp is None or current_timestamp is None or timestamp >= current_timestamp
+    return precedence(event_type) > precedence(current_type)
+
+
+def merge_event(current: dict, event: dict) -> dict:
+    """
+    Merges an event into the document of its task
+
+    Returns:
+        A new dict. If the event supersedes the current state, it is `current` updated with the event, like
+        `dict.update()`. Otherwise the event only adds the keys missing from `current`.
+    """
+    if supersedes(event, current):
+        return {**current, **event}
+    return {**current, **{key: value for key, value in event.items() if key not in current}}
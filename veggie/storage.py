@@ -1,9 +1,156 @@
 """Storage backend for Celery Admin"""
+import bisect
+import datetime
+import heapq
+import itertools
 import json
 import pathlib
 import sqlite3
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Any
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Generator, Iterable, Iterator
+
+from loguru import logger
+
+from . import fulltext, rollups
+from .state import PRECEDENCE, RETRIED, UNKNOWN_PRECEDENCE, merge_event, timestamp_field
+
+
+def _sort_key(sent_timestamp: float | None, uuid: str) -> tuple:
+    """Sort key of the `(sent_timestamp, uuid)` event order, where a missing timestamp sorts first"""
+    return (sent_timestamp is not None, sent_timestamp or 0.0, uuid)
+
+
+PERCENTILES = (50, 95, 99)
+STATS_GROUP_BY = ("name", "hostname")
+# SQLiteStorage merges events with the JSON `->` operator, added in SQLite 3.38.0
+MIN_SQLITE_VERSION = (3, 38, 0)
+
+
+def _percentile_rank(percentile: int, count: int) -> int:
+    """1-based nearest rank of a percentile among `count` sorted values"""
+    return max(1, -(-percentile * count // 100))
+
+
+def _summarize(values: list[float]) -> dict:
+    """Average and percentiles of the values, None if there are no values"""
+    if not values:
+        return {"avg": None, **{f"p{percentile}": None for percentile in PERCENTILES}}
+    values = sorted(values)
+    return {
+        "avg": sum(values) / len(values),
+        **{f"p{percentile}": values[_percentile_rank(percentile, len(values)) - 1] for percentile in PERCENTILES},
+    }
+
+
+def _stats_state(state: str | None) -> str:
+    """State a task is counted in by stats: the Celery task states by name and any other one as unknown"""
+    return state if state in rollups.STATE_COLUMNS else rollups.OTHER_STATE
+
+
+def _stats_row(key: tuple, group_by: tuple[str, ...], states: dict[str, int]) -> dict:
+    """Creates a stats row with the counts of a bucket and group, without the runtime and queue wait stats"""
+    finished = states.get("task-succeeded", 0) + states.get("task-failed", 0)
+    return {
+        "bucket": key[0],
+        **dict(zip(group_by, key[1:], strict=True)),
+        "count": sum(states.values()),
+        "states": states,
+        "failure_ratio": states.get("task-failed", 0) / finished if finished else None,
+        "percentiles_estimated": False,
+    }
+
+
+def _check_group_by(group_by: tuple[str, ...]) -> None:
+    """Raises ValueError if stats can't be grouped by the given fields"""
+    for column in group_by:
+        if column not in STATS_GROUP_BY:
+            raise ValueError(f"Cannot group by {column}, expected any of {', '.join(STATS_GROUP_BY)}")
+
+
+def _compute_stats(
+    events: Iterable[dict], start: float, end: float, bucket_seconds: int, group_by: tuple[str, ...], name: str | None
+) -> list[dict]:
+    """Computes the stats rows of `Storage.get_stats()` from task documents"""
+    _check_group_by(group_by)
+    groups: dict[tuple, list[dict]] = {}
+    for event in events:
+        sent_timestamp = event.get("sent_timestamp")
+        if sent_timestamp is None or not start <= sent_timestamp < end:
+            continue
+        if name is not None and event.get("name") != name:
+            continue
+        bucket = int(sent_timestamp // bucket_seconds * bucket_seconds)
+        groups.setdefault((bucket, *(event.get(column) for column in group_by)), []).append(event)
+
+    rows = []
+    # Sorted like SQL, where NULL comes first
+    for key, tasks in sorted(groups.items(), key=lambda item: [(value is not None, value) for value in item[0]]):
+        states: dict[str, int] = {}
+        for event in tasks:
+            state = _stats_state(event.get("type"))
+            states[state] = states.get(state, 0) + 1
+        runtimes = [event["runtime"] for event in tasks if event.get("runtime") is not None]
+        queue_waits = [
+            event["received_timestamp"] - event["sent_timestamp"]
+            for event in tasks
+            if event.get("received_timestamp") is not None
+        ]
+        rows.append(
+            {
+                **_stats_row(key=key, group_by=group_by, states=states),
+                "runtime": _summarize(runtimes),
+                "queue_wait": _summarize(queue_waits),
+            }
+        )
+    return rows
+
+
+def _supersedes_sql(event_data: str, current_data: str) -> str:
+    """SQL version of `veggie.state.supersedes()`, for two JSON documents"""
+
+    def precedence(event_type: str) -> str:
+        cases = " ".join(f"WHEN '{name}' THEN {position}" for name, position in PRECEDENCE.items())
+        return f"(CASE {event_type} {cases} ELSE {UNKNOWN_PRECEDENCE} END)"
+
+    def timestamp(data: str, event_type: str) -> str:
+        return f"json_extract({data}, '$.' || replace({event_type}, 'task-', '') || '_timestamp')"
+
+    event_type, current_type = f"json_extract({event_data}, '$.type')", f"json_extract({current_data}, '$.type')"
+    event_timestamp, current_timestamp = timestamp(event_data, event_type), timestamp(current_data, current_type)
+    return f"""
+        CASE
+            WHEN {event_type} IS NULL OR {current_type} IS NULL THEN 1
+            WHEN '{RETRIED}' IN ({event_type}, {current_type})
+                OR {precedence(event_type)} = {precedence(current_type)}
+                THEN {event_timestamp} IS NULL OR {current_timestamp} IS NULL
+                    OR {event_timestamp} >= {current_timestamp}
+            ELSE {precedence(event_type)} > {precedence(current_type)}
+        END
+    """
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    Rules for deleting old events
+
+    The age of an event is measured from its sent timestamp, or its received timestamp if it was never sent.
+
+    Attributes:
+        max_age: Maximum age in seconds of events. None keeps events regardless of age.
+        max_events: Maximum number of events kept. The oldest events are deleted first.
+        max_age_by_state: Maximum age in seconds by latest event type, overriding `max_age`.
+            E.g. `{"task-failed": 30 * 86400}` keeps failures for 30 days.
+    """
+
+    max_age: float | None = None
+    max_events: int | None = None
+    max_age_by_state: dict[str, float] = field(default_factory=dict)
 
 
 class Storage(ABC):
@@ -14,6 +161,11 @@ class Storage(ABC):
         """Method to store event info"""
         pass
 
+    def store_events(self, events: list[dict]) -> None:
+        """Method to store a batch of events. Backends can override it to write the batch at once."""
+        for event in events:
+            self.store_event(event)
+
     @abstractmethod
     def get_events(self) -> list[dict]:
         """Method to get events"""
@@ -24,53 +176,420 @@ class Storage(ABC):
         """Method to get single event by its ID"""
         pass
 
+    def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """
+        Method to get a page of events, newest first by default
+
+        Events are ordered by `(sent_timestamp, uuid)`, where a missing sent timestamp sorts lowest.
+        The default implementation filters the output of `get_events()` and backends should override it with
+        a query that doesn't load all events.
+
+        Args:
+            limit: Maximum number of events to return.
+            after: Keyset cursor. The `(sent_timestamp, uuid)` of the last event of the previous page.
+            name: Only return events of tasks with this name.
+            state: Only return events whose latest event type is this, e.g. "task-failed".
+            hostname: Only return events of tasks handled by this host.
+            sent_after: Only return events sent at or after this timestamp.
+            sent_before: Only return events sent before this timestamp.
+            search: Only return tasks whose arguments, result or exception contain these words, see `veggie.fulltext`.
+            order: "desc" for newest first or "asc" for oldest first.
+
+        Returns:
+            List of events as dicts.
+        """
+
+        def sort_key(event: dict) -> tuple:
+            return _sort_key(event.get("sent_timestamp"), event["uuid"])
+
+        def is_after_cursor(event: dict) -> bool:
+            if after is None:
+                return True
+            return sort_key(event) < _sort_key(*after) if order == "desc" else sort_key(event) > _sort_key(*after)
+
+        events = [
+            event
+            for event in self.get_events()
+            if (name is None or event.get("name") == name)
+            and (state is None or event.get("type") == state)
+            and (hostname is None or event.get("hostname") == hostname)
+            and (sent_after is None or (event.get("sent_timestamp") or float("-inf")) >= sent_after)
+            and (sent_before is None or (event.get("sent_timestamp") or float("inf")) < sent_before)
+            and (search is None or fulltext.matches(event, search))
+            and is_after_cursor(event)
+        ]
+        events.sort(key=sort_key, reverse=order == "desc")
+        return events[:limit]
+
+    def iter_events(
+        self,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+        batch_size: int = 1000,
+    ) -> Iterator[dict]:
+        """
+        Method to iterate over all the events matching the filters of `query_events()`, in the same order
+
+        Only about `batch_size` events are held in memory at a time. The default implementation reads pages of
+        `query_events()` with a keyset cursor and backends can override it with a cursor over a single query.
+
+        Args:
+            after: Keyset cursor. Only yield the events after this `(sent_timestamp, uuid)`.
+            name: Only yield events of tasks with this name.
+            state: Only yield events whose latest event type is this, e.g. "task-failed".
+            hostname: Only yield events of tasks handled by this host.
+            sent_after: Only yield events sent at or after this timestamp.
+            sent_before: Only yield events sent before this timestamp.
+            search: Only yield tasks whose arguments, result or exception contain these words.
+            order: "desc" for newest first or "asc" for oldest first.
+            batch_size: Number of events read from the backend at a time.
+        """
+        while True:
+            events = self.query_events(
+                limit=batch_size,
+                after=after,
+                name=name,
+                state=state,
+                hostname=hostname,
+                sent_after=sent_after,
+                sent_before=sent_before,
+                search=search,
+                order=order,
+            )
+            yield from events
+            if len(events) < batch_size:
+                return
+            after = (events[-1].get("sent_timestamp"), events[-1]["uuid"])
+
+    def prune(self, policy: RetentionPolicy) -> int:
+        """
+        Method to delete events according to a retention policy
+
+        Returns:
+            Number of deleted events.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support retention policies")
+
+    @property
+    def supports_retention(self) -> bool:
+        """Whether the backend implements `prune()`"""
+        return type(self).prune is not Storage.prune
+
+    def get_stats(
+        self,
+        start: float,
+        end: float,
+        bucket_seconds: int = 60,
+        group_by: tuple[str, ...] = ("name",),
+        name: str | None = None,
+    ) -> list[dict]:
+        """
+        Method to get aggregated task metrics per time bucket
+
+        Tasks are assigned to buckets by their sent timestamp. The default implementation computes the metrics
+        from the output of `get_events()` and backends should override it with an aggregation query.
+
+        Args:
+            start: Start of the time range, as a Unix timestamp.
+            end: End of the time range, as a Unix timestamp (exclusive).
+            bucket_seconds: Size of the time buckets in seconds.
+            group_by: Task fields to group by within each bucket, any of "name" and "hostname".
+            name: Only aggregate tasks with this name.
+
+        Returns:
+            One dict per bucket and group, sorted by bucket, with the number of tasks, the number of tasks in each
+            state, the failure ratio of finished tasks and the average and percentiles of the runtime and the
+            queue wait (time between sent and received). Tasks in a state other than the Celery task states,
+            custom or missing, are counted as "unknown". `percentiles_estimated` tells whether the percentiles
+            are estimated, e.g. from histograms, rather than exact.
+        """
+        return _compute_stats(
+            events=self.get_events(), start=start, end=end, bucket_seconds=bucket_seconds, group_by=group_by, name=name
+        )
+
+    def close(self) -> None:  # noqa: B027
+        """Method to release any resources held by the storage"""
+        pass
+
 
 class SQLiteStorage(Storage):
     """SQLite Backend"""
 
-    def __init__(self, path: str) -> None:
-        """Initializes SQLite Storage"""
+    # Task fields that are queried often, extracted from the JSON document into columns that can be indexed
+    GENERATED_COLUMNS = {
+        "name": ("TEXT", "json_extract(data, '$.name')"),
+        "sent_timestamp": ("REAL", "json_extract(data, '$.sent_timestamp')"),
+        "state": ("TEXT", "json_extract(data, '$.type')"),
+        "hostname": ("TEXT", "json_extract(data, '$.hostname')"),
+        "received_timestamp": ("REAL", "json_extract(data, '$.received_timestamp')"),
+        "started_timestamp": ("REAL", "json_extract(data, '$.started_timestamp')"),
+        "finished_timestamp": (
+            "REAL",
+            "coalesce(json_extract(data, '$.succeeded_timestamp'), json_extract(data, '$.failed_timestamp'), "
+            "json_extract(data, '$.revoked_timestamp'), json_extract(data, '$.rejected_timestamp'))",
+        ),
+        "runtime": ("REAL", "json_extract(data, '$.runtime')"),
+        "exception": ("TEXT", "json_extract(data, '$.exception')"),
+        "root_id": ("TEXT", "json_extract(data, '$.root_id')"),
+        "parent_id": ("TEXT", "json_extract(data, '$.parent_id')"),
+        # Indexed for full-text search together with "exception"
+        "args": ("TEXT", "json_extract(data, '$.args')"),
+        "kwargs": ("TEXT", "json_extract(data, '$.kwargs')"),
+        "result": ("TEXT", "json_extract(data, '$.result')"),
+        "traceback": ("TEXT", "json_extract(data, '$.traceback')"),
+    }
+    SEARCH_TABLE = "events_search"
+    # Each filter is followed by the page order, so filtered pages are read from the index without sorting
+    INDEXES = {
+        "idx_sent_timestamp": ("sent_timestamp", "uuid"),
+        "idx_name": ("name", "sent_timestamp", "uuid"),
+        "idx_state": ("state", "sent_timestamp", "uuid"),
+        "idx_hostname": ("hostname", "sent_timestamp", "uuid"),
+    }
+    # Indexes created by older versions that no query uses, dropped since they slow down every write
+    OBSOLETE_INDEXES = ("idx_root_id", "idx_finished_timestamp")
+
+    def __init__(
+        self,
+        path: str,
+        journal_mode: str = "WAL",
+        synchronous: str = "NORMAL",
+        busy_timeout: float = 5.0,
+        cache_size_kib: int = 65536,
+        prune_batch_size: int = 1000,
+        use_rollups: bool = True,
+        use_search: bool = True,
+        max_connections: int = 8,
+    ) -> None:
+        """
+        Initializes SQLite Storage
+
+        Requires the SQLite library of Python to be MIN_SQLITE_VERSION or later. Threads share a bounded pool of
+        persistent connections, so neither the receiver thread writing events nor the threads the web server starts
+        per request open a new connection per call, and the number of open connections doesn't grow with them.
+
+        Args:
+            path: Path of the database file.
+            journal_mode: SQLite journal mode. In WAL mode readers don't block the writer and vice versa.
+            synchronous: SQLite synchronous level. NORMAL is safe against corruption in WAL mode.
+            busy_timeout: Seconds a connection waits for a lock before failing with "database is locked".
+            cache_size_kib: Page cache size of each connection in KiB.
+            prune_batch_size: Number of events deleted per transaction when pruning, so that writes of new
+                events are not blocked for long.
+            use_rollups: Whether to maintain per-minute and per-hour rollups of task metrics at write time and
+                serve stats from them. The triggers updating them roughly halve the ingestion throughput, so
+                disable them if stats are rarely read. Disabling it drops the rollups.
+            use_search: Whether to maintain a full-text index of task arguments, results and exceptions at write
+                time, for the `search` filter. Disabling it drops the index.
+            max_connections: Maximum number of connections open at once. Calls wait for a connection while all are
+                in use; streamed reads hold theirs until they are consumed or closed.
+
+        Raises:
+            RuntimeError: If the SQLite library is older than MIN_SQLITE_VERSION.
+        """
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise RuntimeError(
+                f"SQLiteStorage requires SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or later, Python uses "
+                f"SQLite {sqlite3.sqlite_version}. Upgrade Python or the system SQLite library."
+            )
         self.path = str(pathlib.Path(path).resolve())
         self.table_name = "events"
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.cache_size_kib = cache_size_kib
+        self.prune_batch_size = prune_batch_size
+        self.use_rollups = use_rollups
+        self.use_search = use_search
+        self.max_connections = max_connections
+
+        # Connections not in use, the last returned first so that its page cache is still warm
+        self._idle_connections: list[sqlite3.Connection] = []
+        self._open_connections = 0
+        self._connections_available = threading.Condition()
 
         with self._get_connection() as con:
             cursor = con.cursor()
+            # Incremental vacuum lets pruning give space back to the OS without rewriting the whole file.
+            # It can only be enabled before the first table is created, existing databases need a VACUUM.
+            if cursor.execute("SELECT count(*) FROM sqlite_master").fetchone()[0] == 0:
+                cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            elif cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logger.info(f"Run 'PRAGMA auto_vacuum = INCREMENTAL; VACUUM;' on {self.path} to reclaim pruned space")
+            # The journal mode is persistent, so it only needs to be set once per database
+            cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+            columns = ",\n".join(
+                f"{column} {column_type} GENERATED ALWAYS AS ({expression}) VIRTUAL"
+                for column, (column_type, expression) in self.GENERATED_COLUMNS.items()
+            )
             cursor.execute(
                 f"""
                     CREATE TABLE IF NOT EXISTS {self.table_name} (
                         uuid TEXT,
                         data JSON,
-                        name TEXT GENERATED ALWAYS AS (json_extract(data, '$.name')) VIRTUAL,
-                        sent_timestamp REAL GENERATED ALWAYS AS (json_extract(data, '$.sent_timestamp')) VIRTUAL,
+                        {columns},
                     PRIMARY KEY (uuid)
                     )
                 """
             )
-            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_name ON {self.table_name} (name)")
-            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_sent_timestamp ON {self.table_name} (sent_timestamp)")
+            self._migrate(cursor)
+            self._setup_rollups(cursor)
+            self._setup_search(cursor)
+
+    def _migrate(self, cursor: sqlite3.Cursor) -> None:
+        """Adds the generated columns and indexes missing from databases created by older versions, drops old ones"""
+        existing_columns = {row[1] for row in cursor.execute(f"PRAGMA table_xinfo({self.table_name})")}
+        for column, (column_type, expression) in self.GENERATED_COLUMNS.items():
+            if column not in existing_columns:
+                # Only virtual generated columns can be added to an existing table
+                cursor.execute(
+                    f"ALTER TABLE {self.table_name} ADD COLUMN "
+                    f"{column} {column_type} GENERATED ALWAYS AS ({expression}) VIRTUAL"
+                )
+
+        for index in self.OBSOLETE_INDEXES:
+            cursor.execute(f"DROP INDEX IF EXISTS {index}")
+        for index, index_columns in self.INDEXES.items():
+            existing_index_columns = [row[2] for row in cursor.execute(f"PRAGMA index_info({index})")]
+            if existing_index_columns == list(index_columns):
+                continue
+            if existing_index_columns:
+                logger.info(f"Rebuilding index {index} of {self.path}")
+                cursor.execute(f"DROP INDEX {index}")
+            cursor.execute(f"CREATE INDEX {index} ON {self.table_name} ({', '.join(index_columns)})")
+
+    def _setup_rollups(self, cursor: sqlite3.Cursor) -> None:
+        """Creates the rollup tables and their triggers, or drops them if rollups are disabled"""
+        for table, seconds in rollups.RESOLUTIONS.items():
+            exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", [table]).fetchone() is not None
+            if not self.use_rollups:
+                for trigger in ("insert", "update", "delete"):
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {table}_{trigger}")
+                cursor.execute(f"DROP TABLE IF EXISTS {table}")
+                continue
+            for statement in rollups.create_statements(table=table, seconds=seconds, events_table=self.table_name):
+                cursor.execute(statement)
+            if not exists and cursor.execute(f"SELECT 1 FROM {self.table_name} LIMIT 1").fetchone() is not None:
+                logger.warning(f"Run 'veggie rebuild-rollups --db {self.path}' to include existing events in {table}")
+
+    def _setup_search(self, cursor: sqlite3.Cursor) -> None:
+        """Creates the full-text index and its triggers, indexing existing events, or drops it if search is disabled"""
+        if not self.use_search:
+            for statement in fulltext.drop_statements(table=self.SEARCH_TABLE):
+                cursor.execute(statement)
+            return
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", [self.SEARCH_TABLE]).fetchone()
+        for statement in fulltext.create_statements(table=self.SEARCH_TABLE, events_table=self.table_name):
+            cursor.execute(statement)
+        if exists is None and cursor.execute(f"SELECT 1 FROM {self.table_name} LIMIT 1").fetchone() is not None:
+            logger.info(f"Indexing the existing events of {self.path} for search")
+            cursor.execute(fulltext.rebuild_statement(table=self.SEARCH_TABLE))
+
+    def rebuild_rollups(self) -> None:
+        """Recomputes the rollup tables from the stored events, e.g. for databases created by older versions"""
+        if not self.use_rollups:
+            raise RuntimeError("Rollups are disabled")
+        with self._get_connection() as con:
+            for table, seconds in rollups.RESOLUTIONS.items():
+                for statement in rollups.rebuild_statements(table=table, seconds=seconds, events_table=self.table_name):
+                    con.execute(statement)
 
-    def _get_connection(self) -> Any:
-        return sqlite3.connect(self.path)
+    def _acquire_connection(self) -> sqlite3.Connection:
+        """Takes a connection from the pool, opening one if there are fewer than `max_connections`"""
+        with self._connections_available:
+            while not self._idle_connections and self._open_connections >= self.max_connections:
+                self._connections_available.wait()
+            if self._idle_connections:
+                return self._idle_connections.pop()
+            self._open_connections += 1
+
+        try:
+            con = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            con.execute(f"PRAGMA synchronous = {self.synchronous}")
+            con.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}")
+            con.execute(f"PRAGMA cache_size = -{self.cache_size_kib}")
+        except Exception:
+            with self._connections_available:
+                self._open_connections -= 1
+                self._connections_available.notify()
+            raise
+        return con
+
+    def _release_connection(self, con: sqlite3.Connection) -> None:
+        """Returns a connection to the pool"""
+        with self._connections_available:
+            self._idle_connections.append(con)
+            self._connections_available.notify()
+
+    @contextmanager
+    def _get_connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Lends a connection of the pool to the calling thread, in a transaction committed on exit
+
+        Connections must not be requested again while one is held, since a full pool would then wait forever.
+        """
+        con = self._acquire_connection()
+        try:
+            with con:
+                yield con
+        finally:
+            self._release_connection(con)
+
+    def close(self) -> None:
+        """Closes the connections of the pool that are not in use"""
+        with self._connections_available:
+            for con in self._idle_connections:
+                con.close()
+            self._open_connections -= len(self._idle_connections)
+            self._idle_connections.clear()
 
     def store_event(self, event: dict) -> None:
         """Stores event info"""
-        with self._get_connection() as con:
-            cursor = con.cursor()
-            cursor.execute(f"SELECT data FROM {self.table_name} WHERE uuid = ?", (event["uuid"],))
-            row = cursor.fetchone()
+        self.store_events([event])
 
-            if row:
-                # Record exists, merge existing data with new data
-                data = json.loads(row[0])
-                data.update(event)
-                cursor.execute(
-                    f"UPDATE {self.table_name} SET data = ? WHERE uuid = ?", (json.dumps(data), event["uuid"])
-                )
-            else:
-                # Record does not exist, insert a new one
-                cursor.execute(
-                    f"INSERT INTO {self.table_name} (uuid, data) VALUES (?, ?)", (event["uuid"], json.dumps(event))
-                )
+    def store_events(self, events: list[dict]) -> None:
+        """Stores a batch of events in a single transaction, merging them like `veggie.state.merge_event()`"""
+        # If the event supersedes the stored state, new keys are added and existing keys overwritten, i.e. the SQL
+        # equivalent of `data.update(event)`. Otherwise only the new keys are added.
+        # json_patch() is not used since it deletes keys set to null and merges nested objects recursively.
+        # Values are copied as JSON text with `->`, since the SQL values of json_each() lose float precision.
+        supersedes = _supersedes_sql(event_data="excluded.data", current_data=f"{self.table_name}.data")
+        with self._get_connection() as con:
+            con.executemany(
+                f"""
+                    INSERT INTO {self.table_name} (uuid, data) VALUES (?, json(?))
+                    ON CONFLICT (uuid) DO UPDATE SET data = (
+                        SELECT json_group_object(
+                            key, json(iif(is_event, excluded.data, {self.table_name}.data) -> fullkey)
+                        )
+                        FROM (SELECT {supersedes} AS supersedes) JOIN (
+                            SELECT key, fullkey, 0 AS is_event FROM json_each({self.table_name}.data)
+                            UNION ALL
+                            SELECT key, fullkey, 1 AS is_event FROM json_each(excluded.data)
+                        )
+                        WHERE is_event = supersedes OR key NOT IN (
+                            SELECT key FROM json_each(iif(is_event, {self.table_name}.data, excluded.data))
+                        )
+                    )
+                """,
+                [(event["uuid"], json.dumps(event)) for event in events],
+            )
 
     def get_events(self) -> list[dict]:
         """Gets events as list of dicts"""
@@ -80,6 +599,168 @@ class SQLiteStorage(Storage):
             rows = cursor.fetchall()
             return [json.loads(row[0]) for row in rows]
 
+    def _filter_conditions(
+        self,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+    ) -> tuple[list[str], list]:
+        """Builds the WHERE conditions and their parameters for the given filters"""
+        conditions = []
+        params: list = []
+        if name is not None:
+            conditions.append("name = ?")
+            params.append(name)
+        if state is not None:
+            conditions.append("state = ?")
+            params.append(state)
+        if hostname is not None:
+            conditions.append("hostname = ?")
+            params.append(hostname)
+        if sent_after is not None:
+            conditions.append("sent_timestamp >= ?")
+            params.append(sent_after)
+        if sent_before is not None:
+            conditions.append("sent_timestamp < ?")
+            params.append(sent_before)
+        match_query = fulltext.match_query(search) if search is not None else None
+        if match_query is not None:
+            if not self.use_search:
+                raise ValueError("Search is disabled for this database")
+            # Matches are looked up in the full-text index first, then filtered and sorted like other events
+            conditions.append(f"rowid IN (SELECT rowid FROM {self.SEARCH_TABLE} WHERE {self.SEARCH_TABLE} MATCH ?)")
+            params.append(match_query)
+        return conditions, params
+
+    def _keyset_queries(
+        self,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[tuple[str, list, str]]:
+        """
+        Builds the queries reading the events after a keyset cursor in order, to run one after the other
+
+        Returns:
+            The WHERE clause, its parameters and the ORDER BY clause of each query.
+        """
+        conditions, params = self._filter_conditions(
+            name=name, state=state, hostname=hostname, sent_after=sent_after, sent_before=sent_before, search=search
+        )
+        after_timestamp, after_uuid = after if after is not None else (None, "")
+        descending = order == "desc"
+        direction, comparison = ("DESC", "<") if descending else ("ASC", ">")
+
+        # Events with a sent timestamp sort after the ones without it. Each part is a separate query so that the
+        # keyset condition stays a range on the sent timestamp index.
+        with_timestamp: list[tuple[str, list, str]] = []
+        if after is None or after_timestamp is not None or not descending:
+            keyset = ["sent_timestamp IS NOT NULL"]
+            keyset_params: list = []
+            if after_timestamp is not None:
+                keyset.append(
+                    f"sent_timestamp {comparison}= ? AND (sent_timestamp {comparison} ? OR uuid {comparison} ?)"
+                )
+                keyset_params.extend([after_timestamp, after_timestamp, after_uuid])
+            with_timestamp.append(
+                (
+                    " AND ".join(conditions + keyset),
+                    params + keyset_params,
+                    f"sent_timestamp {direction}, uuid {direction}",
+                )
+            )
+
+        without_timestamp: list[tuple[str, list, str]] = []
+        if after is None or after_timestamp is None or descending:
+            keyset = ["sent_timestamp IS NULL"]
+            keyset_params = []
+            if after is not None and after_timestamp is None:
+                keyset.append(f"uuid {comparison} ?")
+                keyset_params.append(after_uuid)
+            without_timestamp.append((" AND ".join(conditions + keyset), params + keyset_params, f"uuid {direction}"))
+
+        return with_timestamp + without_timestamp if descending else without_timestamp + with_timestamp
+
+    def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """Gets a page of events, reading it in order from the index of the filtered column"""
+        queries = self._keyset_queries(
+            after=after,
+            name=name,
+            state=state,
+            hostname=hostname,
+            sent_after=sent_after,
+            sent_before=sent_before,
+            search=search,
+            order=order,
+        )
+        events: list[dict] = []
+        with self._get_connection() as con:
+            cursor = con.cursor()
+            for where, params, query_order in queries:
+                if len(events) >= limit:
+                    break
+                cursor.execute(
+                    f"SELECT data FROM {self.table_name} WHERE {where} ORDER BY {query_order} LIMIT ?",
+                    (*params, limit - len(events)),
+                )
+                events.extend(json.loads(row[0]) for row in cursor.fetchall())
+        return events
+
+    def iter_events(
+        self,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+        batch_size: int = 1000,
+    ) -> Iterator[dict]:
+        """Yields events from an open cursor, fetching `batch_size` rows at a time"""
+        queries = self._keyset_queries(
+            after=after,
+            name=name,
+            state=state,
+            hostname=hostname,
+            sent_after=sent_after,
+            sent_before=sent_before,
+            search=search,
+            order=order,
+        )
+        # Only reads, so no transaction is started. In WAL mode the cursor reads a snapshot and doesn't block writers.
+        # The connection goes back to the pool once the events are consumed or the generator is closed.
+        with self._get_connection() as con:
+            cursor = con.cursor()
+            try:
+                for where, params, query_order in queries:
+                    cursor.execute(f"SELECT data FROM {self.table_name} WHERE {where} ORDER BY {query_order}", params)
+                    while rows := cursor.fetchmany(batch_size):
+                        for row in rows:
+                            yield json.loads(row[0])
+            finally:
+                cursor.close()
+
     def get_event_by_id(self, id: str) -> dict | None:
         """Gets single event by its ID"""
         with self._get_connection() as con:
@@ -89,3 +770,1153 @@ class SQLiteStorage(Storage):
             if row is None:
                 return None
             return json.loads(row[0])
+
+    def _delete_in_batches(self, condition: str, params: list) -> int:
+        """Deletes the events matching the condition, one small transaction at a time"""
+        deleted = 0
+        while True:
+            with self._get_connection() as con:
+                with con:
+                    cursor = con.execute(
+                        f"DELETE FROM {self.table_name} WHERE rowid IN "
+                        f"(SELECT rowid FROM {self.table_name} WHERE {condition} LIMIT ?)",
+                        (*params, self.prune_batch_size),
+                    )
+                # The pragma frees one page per step, so it is stepped until the freelist is empty
+                con.execute("PRAGMA incremental_vacuum").fetchall()
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.prune_batch_size:
+                return deleted
+            # Gives the writer of new events a chance to take the lock between batches
+            time.sleep(0.01)
+
+    def prune(self, policy: RetentionPolicy) -> int:
+        """Deletes events according to a retention policy in small batches"""
+        now = time.time()
+        # Split in two so that the common case uses the sent timestamp index
+        older_than = "(sent_timestamp < ? OR (sent_timestamp IS NULL AND received_timestamp < ?))"
+        deleted = 0
+
+        for state, max_age in policy.max_age_by_state.items():
+            deleted += self._delete_in_batches(f"state = ? AND {older_than}", [state, now - max_age, now - max_age])
+
+        if policy.max_age is not None:
+            states = list(policy.max_age_by_state)
+            deleted += self._delete_in_batches(
+                f"coalesce(state, '') NOT IN ({', '.join('?' * len(states))}) " f"AND {older_than}",
+                [*states, now - policy.max_age, now - policy.max_age],
+            )
+
+        if policy.max_events is not None:
+            # Events without a sent timestamp are the oldest in the sort order, so they go first
+            with self._get_connection() as con:
+                oldest_kept = con.execute(
+                    f"SELECT sent_timestamp, uuid FROM {self.table_name} "
+                    "ORDER BY sent_timestamp DESC, uuid DESC LIMIT 1 OFFSET ?",
+                    (policy.max_events - 1,),
+                ).fetchone()
+            if oldest_kept is not None:
+                sent_timestamp, uuid = oldest_kept
+                if sent_timestamp is None:
+                    deleted += self._delete_in_batches("sent_timestamp IS NULL AND uuid < ?", [uuid])
+                else:
+                    deleted += self._delete_in_batches(
+                        "sent_timestamp IS NULL OR sent_timestamp < ? OR (sent_timestamp = ? AND uuid < ?)",
+                        [sent_timestamp, sent_timestamp, uuid],
+                    )
+
+        return deleted
+
+    def _get_metric_stats(self, expression: str, where: str, params: list, group_by: tuple[str, ...]) -> dict:
+        """Computes the average and percentiles of a metric per bucket and group"""
+        groups = "".join(f", {column}" for column in group_by)
+        percentiles = "".join(
+            f", max(CASE WHEN rank = ({percentile} * n + 99) / 100 THEN value END)" for percentile in PERCENTILES
+        )
+        with self._get_connection() as con:
+            rows = con.execute(
+                f"""
+                    WITH task_values AS (
+                        SELECT CAST(sent_timestamp / ? AS INTEGER) * ? AS bucket{groups}, {expression} AS value
+                        FROM {self.table_name} WHERE {where} AND {expression} IS NOT NULL
+                    ), ranked AS (
+                        SELECT *,
+                            row_number() OVER (PARTITION BY bucket{groups} ORDER BY value) AS rank,
+                            count(*) OVER (PARTITION BY bucket{groups}) AS n
+                        FROM task_values
+                    )
+                    SELECT bucket{groups}, avg(value){percentiles} FROM ranked GROUP BY bucket{groups}
+                """,
+                params,
+            ).fetchall()
+        key_size = 1 + len(group_by)
+        return {
+            row[:key_size]: {
+                "avg": row[key_size],
+                **{f"p{percentile}": value for percentile, value in zip(PERCENTILES, row[key_size + 1 :], strict=True)},
+            }
+            for row in rows
+        }
+
+    def _get_rollup_table(self, bucket_seconds: int, group_by: tuple[str, ...]) -> str | None:
+        """Returns the coarsest rollup table that stats buckets can be built from, if any"""
+        if not self.use_rollups or not set(group_by) <= {"name"}:
+            return None
+        tables = sorted(rollups.RESOLUTIONS, key=rollups.RESOLUTIONS.__getitem__, reverse=True)
+        return next((table for table in tables if bucket_seconds % rollups.RESOLUTIONS[table] == 0), None)
+
+    def get_stats(
+        self,
+        start: float,
+        end: float,
+        bucket_seconds: int = 60,
+        group_by: tuple[str, ...] = ("name",),
+        name: str | None = None,
+    ) -> list[dict]:
+        """
+        Gets aggregated task metrics per time bucket
+
+        If the buckets are whole minutes or hours and only grouped by name, the metrics are read from the rollup
+        tables, with only the partial rollup buckets at the edges of the time range aggregated from the events.
+        Percentiles are then estimated from the rollup histograms. Otherwise everything is computed in SQL over
+        the sent timestamp index.
+        """
+        _check_group_by(group_by)
+        table = self._get_rollup_table(bucket_seconds=bucket_seconds, group_by=group_by)
+        if table is not None:
+            query, query_params = rollups.stats_query(
+                table=table,
+                seconds=rollups.RESOLUTIONS[table],
+                events_table=self.table_name,
+                start=start,
+                end=end,
+                bucket_seconds=bucket_seconds,
+                group_by=group_by,
+                name=name,
+            )
+            with self._get_connection() as con:
+                rows = con.execute(query, query_params).fetchall()
+            return [rollups.row_to_stats(row=row, group_by=group_by, percentiles=PERCENTILES) for row in rows]
+
+        groups = "".join(f", {column}" for column in group_by)
+        where = "sent_timestamp >= ? AND sent_timestamp < ?"
+        params: list = [bucket_seconds, bucket_seconds, start, end]
+        if name is not None:
+            where += " AND name = ?"
+            params.append(name)
+
+        known_states = ", ".join(f"'{state}'" for state in rollups.STATE_COLUMNS)
+        with self._get_connection() as con:
+            counts = con.execute(
+                f"""
+                    SELECT CAST(sent_timestamp / ? AS INTEGER) * ? AS bucket{groups},
+                        iif(state IN ({known_states}), state, '{rollups.OTHER_STATE}') AS stats_state, count(*)
+                    FROM {self.table_name} WHERE {where}
+                    GROUP BY bucket{groups}, stats_state ORDER BY bucket{groups}
+                """,
+                params,
+            ).fetchall()
+        runtimes = self._get_metric_stats(expression="runtime", where=where, params=params, group_by=group_by)
+        queue_waits = self._get_metric_stats(
+            expression="received_timestamp - sent_timestamp", where=where, params=params, group_by=group_by
+        )
+
+        states_by_key: dict[tuple, dict[str, int]] = {}
+        for *key, state, count in counts:
+            states_by_key.setdefault(tuple(key), {})[state] = count
+        return [
+            {
+                **_stats_row(key=key, group_by=group_by, states=states),
+                "runtime": runtimes.get(key, _summarize([])),
+                "queue_wait": queue_waits.get(key, _summarize([])),
+            }
+            for key, states in states_by_key.items()
+        ]
+
+
+class PartitionedSQLiteStorage(Storage):
+    """
+    SQLite backend writing each day or hour of tasks to its own database file
+
+    Each partition is a `SQLiteStorage` with its own indexes, rollups and search index, so writes only update the
+    B-trees of the current partition. Queries only read the partitions overlapping their time range, and retention
+    deletes whole partitions by unlinking their files instead of deleting their rows.
+
+    A task is stored in the partition of its first stored event, by its sent timestamp or otherwise the time of the
+    event. The later events of a task are looked up in the partitions of the previous `task_window` seconds and
+    stored in the same partition, so a task running across a partition boundary is not split.
+
+    The directory is scanned again whenever the partitions are listed, so a process serving the web app sees the
+    partitions created and dropped by the ingesting process. Only storing events creates partition files.
+    """
+
+    # Span in seconds and file name format of each partition, in UTC
+    PARTITIONS = {"day": (86400, "%Y-%m-%d"), "hour": (3600, "%Y-%m-%dT%H")}
+    FILE_PREFIX = "events-"
+    FILE_SUFFIX = ".db"
+    # Maximum number of SQL variables per lookup of existing tasks
+    LOOKUP_BATCH_SIZE = 500
+
+    def __init__(
+        self, directory: str, partition: str = "day", task_window: float | None = None, **sqlite_kwargs: Any
+    ) -> None:
+        """
+        Initializes the storage
+
+        Args:
+            directory: Directory of the partition files, created if needed.
+            partition: Span of each partition, "day" or "hour".
+            task_window: Seconds after the first event of a task during which its other events may arrive.
+                Defaults to the span of a partition.
+            **sqlite_kwargs: Arguments of the `SQLiteStorage` of each partition, e.g. `synchronous`.
+
+        Raises:
+            ValueError: If the partition span is unknown.
+        """
+        if partition not in self.PARTITIONS:
+            raise ValueError(f"partition must be one of {', '.join(self.PARTITIONS)}")
+        self.directory = pathlib.Path(directory).resolve()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.partition_seconds, self._name_format = self.PARTITIONS[partition]
+        self.task_window = task_window if task_window is not None else self.partition_seconds
+        self.sqlite_kwargs = sqlite_kwargs
+
+        self._lock = threading.Lock()
+        # Partitions by start timestamp, opened on first use
+        self._partitions: dict[int, SQLiteStorage | None] = {}
+        # Files of the directory that are not partitions, warned about once
+        self._ignored: set[str] = set()
+        self._scan()
+
+    def _scan(self) -> None:
+        """Updates the partitions from the files in the directory, which other processes may create or delete"""
+        found = set()
+        for path in self.directory.glob(f"{self.FILE_PREFIX}*{self.FILE_SUFFIX}"):
+            name = path.name.removeprefix(self.FILE_PREFIX).removesuffix(self.FILE_SUFFIX)
+            try:
+                partition_time = datetime.datetime.strptime(name, self._name_format).replace(
+                    tzinfo=datetime.timezone.utc
+                )
+            except ValueError:
+                if path.name not in self._ignored:
+                    self._ignored.add(path.name)
+                    logger.warning(f"Ignored {path}, which is not a partition of {self.partition_seconds} seconds")
+                continue
+            found.add(int(partition_time.timestamp()))
+
+        with self._lock:
+            for start in found.difference(self._partitions):
+                self._partitions[start] = None
+            # Checked again with the lock held, since this process may have created the file after the scan
+            deleted = [
+                start for start in self._partitions if start not in found and not self._partition_path(start).exists()
+            ]
+            closed = [self._partitions.pop(start) for start in deleted]
+        for partition in closed:
+            if partition is not None:
+                partition.close()
+
+    def _partition_path(self, start: int) -> pathlib.Path:
+        """Path of the database file of a partition"""
+        name = datetime.datetime.fromtimestamp(start, tz=datetime.timezone.utc).strftime(self._name_format)
+        return self.directory / f"{self.FILE_PREFIX}{name}{self.FILE_SUFFIX}"
+
+    def _partition_start(self, timestamp: float) -> int:
+        """Start of the partition of a timestamp"""
+        return int(timestamp // self.partition_seconds * self.partition_seconds)
+
+    def _get_partition(self, start: int) -> SQLiteStorage:
+        """Returns the storage of a partition, opening or creating its database"""
+        partition = self._open_partition(start, create=True)
+        assert partition is not None
+        return partition
+
+    def _open_partition(self, start: int, create: bool = False) -> SQLiteStorage | None:
+        """Returns the storage of a partition, opening its database, or None if it was deleted and not created"""
+        with self._lock:
+            partition = self._partitions.get(start)
+            if partition is None:
+                path = self._partition_path(start)
+                if not create and not path.exists():
+                    return None
+                partition = SQLiteStorage(path=str(path), **self.sqlite_kwargs)
+                self._partitions[start] = partition
+            return partition
+
+    def _open_partitions(self, starts: list[int]) -> Iterator[tuple[int, SQLiteStorage]]:
+        """Yields the storages of partitions, skipping those deleted since they were listed"""
+        for start in starts:
+            partition = self._open_partition(start)
+            if partition is not None:
+                yield start, partition
+
+    def _starts(self, start: float | None = None, end: float | None = None) -> list[int]:
+        """
+        Start timestamps of the partitions that can hold tasks sent in a time range, oldest first
+
+        A task sent before a partition starts can be stored in it if its first stored event is not the sent one,
+        so the range is extended by the task window.
+        """
+        self._scan()
+        with self._lock:
+            starts = sorted(self._partitions)
+        return [
+            partition_start
+            for partition_start in starts
+            if (start is None or partition_start + self.partition_seconds > start)
+            and (end is None or partition_start <= end + self.task_window)
+        ]
+
+    def _drop(self, start: int) -> int:
+        """
+        Closes a partition and deletes its files
+
+        Returns:
+            Number of deleted events.
+        """
+        opened = self._open_partition(start)
+        count = self._count(opened) if opened is not None else 0
+        with self._lock:
+            partition = self._partitions.pop(start, None)
+        if partition is not None:
+            partition.close()
+        path = self._partition_path(start)
+        for file_path in (path, pathlib.Path(f"{path}-wal"), pathlib.Path(f"{path}-shm")):
+            file_path.unlink(missing_ok=True)
+        logger.info(f"Dropped partition {path} with {count} events")
+        return count
+
+    @staticmethod
+    def _count(partition: SQLiteStorage) -> int:
+        """Number of events of a partition"""
+        with partition._get_connection() as con:
+            return con.execute(f"SELECT count(*) FROM {partition.table_name}").fetchone()[0]
+
+    def _locate(self, ids: list[str], since: float) -> dict[str, int]:
+        """Finds the partitions of the tasks already stored, among the partitions since a timestamp"""
+        located: dict[str, int] = {}
+        for start, partition in self._open_partitions(list(reversed(self._starts(start=since - self.task_window)))):
+            remaining = [id for id in ids if id not in located]
+            if not remaining:
+                break
+            with partition._get_connection() as con:
+                for i in range(0, len(remaining), self.LOOKUP_BATCH_SIZE):
+                    batch = remaining[i : i + self.LOOKUP_BATCH_SIZE]
+                    rows = con.execute(
+                        f"SELECT uuid FROM {partition.table_name} WHERE uuid IN ({', '.join('?' * len(batch))})", batch
+                    )
+                    located.update((row[0], start) for row in rows)
+        return located
+
+    @staticmethod
+    def _event_time(event: dict) -> float:
+        """Time of an event, which decides the partition of a new task"""
+        timestamp = event.get("sent_timestamp")
+        if timestamp is None and "type" in event:
+            timestamp = event.get(timestamp_field(event["type"]))
+        return timestamp if timestamp is not None else time.time()
+
+    def store_event(self, event: dict) -> None:
+        """Stores event info"""
+        self.store_events([event])
+
+    def store_events(self, events: list[dict]) -> None:
+        """Stores a batch of events, each in the partition of its task"""
+        if not events:
+            return
+        events_by_id: dict[str, list[dict]] = {}
+        for event in events:
+            events_by_id.setdefault(event["uuid"], []).append(event)
+        located = self._locate(ids=list(events_by_id), since=min(self._event_time(event) for event in events))
+
+        batches: dict[int, list[dict]] = {}
+        for id, task_events in events_by_id.items():
+            start = located.get(id)
+            if start is None:
+                start = self._partition_start(min(self._event_time(event) for event in task_events))
+            batches.setdefault(start, []).extend(task_events)
+        for start, batch in batches.items():
+            self._get_partition(start).store_events(batch)
+
+    def get_events(self) -> list[dict]:
+        """Gets the events of all partitions, newest first"""
+        events = [event for _, partition in self._open_partitions(self._starts()) for event in partition.get_events()]
+        events.sort(key=lambda event: _sort_key(event.get("sent_timestamp"), event["uuid"]), reverse=True)
+        return events
+
+    def get_event_by_id(self, id: str) -> dict | None:
+        """Gets single event by its ID, looking in the newest partitions first"""
+        for _, partition in self._open_partitions(list(reversed(self._starts()))):
+            event = partition.get_event_by_id(id=id)
+            if event is not None:
+                return event
+        return None
+
+    def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """
+        Gets a page of events, merging the pages of the partitions overlapping the time range and the cursor
+
+        Newest first, partitions are read from the newest one and older ones are skipped once the page can't
+        change, since they only hold tasks sent before the partitions already read.
+        """
+        descending = order == "desc"
+        start, end = sent_after, sent_before
+        if after is not None and after[0] is not None:
+            if not descending:
+                start = after[0] if start is None else max(start, after[0])
+            elif sent_after is not None or sent_before is not None:
+                # Without a time filter, the tasks without a sent timestamp come after the cursor, and they can be
+                # in any partition
+                end = after[0] if end is None else min(end, after[0])
+        starts = self._starts(start=start, end=end)
+        if descending:
+            starts.reverse()
+
+        def sort_key(event: dict) -> tuple:
+            return _sort_key(event.get("sent_timestamp"), event["uuid"])
+
+        pages = []
+        for partition_start, partition in self._open_partitions(starts):
+            pages.append(
+                partition.query_events(
+                    limit=limit,
+                    after=after,
+                    name=name,
+                    state=state,
+                    hostname=hostname,
+                    sent_after=sent_after,
+                    sent_before=sent_before,
+                    search=search,
+                    order=order,
+                )
+            )
+            if descending and sum(len(page) for page in pages) >= limit:
+                last = heapq.nlargest(limit, itertools.chain(*pages), key=sort_key)[-1]
+                if sort_key(last) >= _sort_key(partition_start, ""):
+                    break
+        return list(itertools.islice(heapq.merge(*pages, key=sort_key, reverse=descending), limit))
+
+    def prune(self, policy: RetentionPolicy) -> int:
+        """
+        Deletes events according to a retention policy
+
+        Partitions older than every max age, or past `max_events` counting from the newest one, are dropped whole.
+        Only in the partitions at the limit are events deleted one by one. Tasks without a sent timestamp are the
+        oldest in the sort order, so `max_events` deletes them first, whatever their partition.
+        """
+        now = time.time()
+        deleted = 0
+        max_ages = [age for age in (policy.max_age, *policy.max_age_by_state.values()) if age is not None]
+        if max_ages:
+            for start, partition in self._open_partitions(self._starts()):
+                end = start + self.partition_seconds
+                if policy.max_age is not None and end <= now - max(max_ages):
+                    deleted += self._drop(start)
+                elif start < now - min(max_ages):
+                    deleted += partition.prune(
+                        RetentionPolicy(max_age=policy.max_age, max_age_by_state=policy.max_age_by_state)
+                    )
+
+        if policy.max_events is not None:
+            partitions = list(self._open_partitions(list(reversed(self._starts()))))
+            excess = sum(self._count(partition) for _, partition in partitions) - policy.max_events
+            if excess > 0:
+                deleted += self._prune_not_sent(partitions=[partition for _, partition in partitions], count=excess)
+            kept = 0
+            for start, partition in partitions:
+                if kept >= policy.max_events:
+                    deleted += self._drop(start)
+                    continue
+                count = self._count(partition)
+                if kept + count > policy.max_events:
+                    deleted += partition.prune(RetentionPolicy(max_events=policy.max_events - kept))
+                kept = min(kept + count, policy.max_events)
+        return deleted
+
+    @staticmethod
+    def _prune_not_sent(partitions: list[SQLiteStorage], count: int) -> int:
+        """
+        Deletes up to `count` tasks without a sent timestamp, the first ones by task ID as in the sort order
+
+        Returns:
+            Number of deleted events.
+        """
+
+        def not_sent(partition: SQLiteStorage) -> Generator[tuple[str, SQLiteStorage], None, None]:
+            with partition._get_connection() as con:
+                cursor = con.execute(
+                    f"SELECT uuid FROM {partition.table_name} WHERE sent_timestamp IS NULL ORDER BY uuid"
+                )
+                try:
+                    for row in cursor:
+                        yield row[0], partition
+                finally:
+                    cursor.close()
+
+        # The last task ID to delete in each partition, found before deleting so that no read is in progress
+        last: dict[str, tuple[str, SQLiteStorage]] = {}
+        readers = [not_sent(partition) for partition in partitions]
+        for uuid, partition in itertools.islice(heapq.merge(*readers, key=lambda item: item[0]), count):
+            last[partition.path] = (uuid, partition)
+        for reader in readers:
+            reader.close()
+        return sum(
+            partition._delete_in_batches("sent_timestamp IS NULL AND uuid <= ?", [uuid])
+            for uuid, partition in last.values()
+        )
+
+    def get_stats(
+        self,
+        start: float,
+        end: float,
+        bucket_seconds: int = 60,
+        group_by: tuple[str, ...] = ("name",),
+        name: str | None = None,
+    ) -> list[dict]:
+        """
+        Gets aggregated task metrics per time bucket from the partitions overlapping the time range
+
+        Buckets whose tasks are all in one partition come from that partition. Percentiles can't be combined, so
+        the few buckets with tasks in several partitions are computed again from their events. Buckets larger
+        than a partition always are, so they are slower.
+        """
+        _check_group_by(group_by)
+        rows_by_bucket: dict[int, dict[int, list[dict]]] = {}
+        for partition_start, partition in self._open_partitions(self._starts(start=start, end=end)):
+            for row in partition.get_stats(
+                start=start, end=end, bucket_seconds=bucket_seconds, group_by=group_by, name=name
+            ):
+                rows_by_bucket.setdefault(row["bucket"], {}).setdefault(partition_start, []).append(row)
+
+        rows: list[dict] = []
+        for bucket, partition_rows in rows_by_bucket.items():
+            if len(partition_rows) == 1:
+                rows.extend(*partition_rows.values())
+                continue
+            bucket_start, bucket_end = max(bucket, start), min(bucket + bucket_seconds, end)
+            events = self.iter_events(sent_after=bucket_start, sent_before=bucket_end, name=name)
+            rows.extend(
+                _compute_stats(
+                    events=events,
+                    start=bucket_start,
+                    end=bucket_end,
+                    bucket_seconds=bucket_seconds,
+                    group_by=group_by,
+                    name=name,
+                )
+            )
+        # Sorted like SQL, where NULL comes first
+        rows.sort(key=lambda row: [(value is not None, value) for value in (row["bucket"], *map(row.get, group_by))])
+        return rows
+
+    def rebuild_rollups(self) -> None:
+        """Recomputes the rollup tables of every partition from its stored events"""
+        for _, partition in self._open_partitions(self._starts()):
+            partition.rebuild_rollups()
+
+    def close(self) -> None:
+        """Closes the partitions"""
+        with self._lock:
+            for partition in self._partitions.values():
+                if partition is not None:
+                    partition.close()
+
+
+class _TaskRecord:
+    """Merged document of a task in `MemoryStorage`, with its sort key"""
+
+    __slots__ = ("uuid", "data", "sort_key")
+
+    def __init__(self, uuid: str, data: dict) -> None:
+        """Initializes the record of a task"""
+        self.uuid = uuid
+        self.data = data
+        self.sort_key = _sort_key(data.get("sent_timestamp"), uuid)
+
+
+class MemoryStorage(Storage):
+    """
+    In-memory backend keeping the most recent tasks in a ring buffer
+
+    Each task takes one slot of a fixed-size ring buffer, found through a uuid to slot index, so storing an
+    event is O(1). When the buffer is full, the slot of the task seen first is reused, i.e. the oldest tasks
+    are evicted. Nothing is written to disk and all tasks are lost on restart.
+    """
+
+    def __init__(self, max_tasks: int = 100000) -> None:
+        """
+        Initializes the memory storage
+
+        Args:
+            max_tasks: Number of slots of the ring buffer, i.e. the maximum number of tasks kept.
+        """
+        self.max_tasks = max_tasks
+        self._slots: list[_TaskRecord | None] = [None] * max_tasks
+        self._index: dict[str, int] = {}
+        self._next_slot = 0
+        # Writes come from the event receiver and the pruner. Readers iterate a copy of the slots.
+        self._lock = threading.Lock()
+
+    def store_event(self, event: dict) -> None:
+        """Merges event into its task, taking the next slot of the ring buffer for new tasks"""
+        with self._lock:
+            self._store(event)
+
+    def store_events(self, events: list[dict]) -> None:
+        """Stores a batch of events"""
+        with self._lock:
+            for event in events:
+                self._store(event)
+
+    def _store(self, event: dict) -> None:
+        id = event["uuid"]
+        slot = self._index.get(id)
+        if slot is not None:
+            record = self._slots[slot]
+            assert record is not None
+            record.data = merge_event(record.data, event)
+            record.sort_key = _sort_key(record.data.get("sent_timestamp"), id)
+            return
+
+        slot = self._next_slot
+        evicted = self._slots[slot]
+        if evicted is not None:
+            del self._index[evicted.uuid]
+        self._slots[slot] = _TaskRecord(uuid=id, data=dict(event))
+        self._index[id] = slot
+        self._next_slot = (slot + 1) % self.max_tasks
+
+    def _records(self) -> list[_TaskRecord]:
+        """Returns the stored tasks, from the oldest to the newest slot"""
+        slots = list(self._slots)
+        ordered = slots[self._next_slot :] + slots[: self._next_slot]
+        return [record for record in ordered if record is not None]
+
+    def get_events(self) -> list[dict]:
+        """Gets events as list of dicts, newest first"""
+        records = sorted(self._records(), key=lambda record: record.sort_key, reverse=True)
+        return [dict(record.data) for record in records]
+
+    def get_event_by_id(self, id: str) -> dict | None:
+        """Gets single event by its ID"""
+        slot = self._index.get(id)
+        record = self._slots[slot] if slot is not None else None
+        # The slot may have been reused since the index was read
+        if record is None or record.uuid != id:
+            return None
+        return dict(record.data)
+
+    def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """Gets a page of events, selecting the first `limit` matching tasks with a heap instead of sorting"""
+        descending = order == "desc"
+        after_key = _sort_key(*after) if after is not None else None
+
+        def matches(record: _TaskRecord) -> bool:
+            data = record.data
+            sent_timestamp = data.get("sent_timestamp")
+            return (
+                (name is None or data.get("name") == name)
+                and (state is None or data.get("type") == state)
+                and (hostname is None or data.get("hostname") == hostname)
+                and (sent_after is None or (sent_timestamp is not None and sent_timestamp >= sent_after))
+                and (sent_before is None or (sent_timestamp is not None and sent_timestamp < sent_before))
+                and (search is None or fulltext.matches(data, search))
+                and (after_key is None or (record.sort_key < after_key if descending else record.sort_key > after_key))
+            )
+
+        select = heapq.nlargest if descending else heapq.nsmallest
+        page = select(limit, filter(matches, self._records()), key=lambda record: record.sort_key)
+        return [dict(record.data) for record in page]
+
+    def prune(self, policy: RetentionPolicy) -> int:
+        """Frees the slots of the tasks to delete according to a retention policy"""
+        now = time.time()
+        with self._lock:
+            expired = set()
+            for record in self._records():
+                max_age = policy.max_age_by_state.get(record.data.get("type", ""), policy.max_age)
+                timestamp = record.data.get("sent_timestamp")
+                if timestamp is None:
+                    timestamp = record.data.get("received_timestamp")
+                if max_age is not None and timestamp is not None and timestamp < now - max_age:
+                    expired.add(record.uuid)
+
+            if policy.max_events is not None:
+                remaining = [record for record in self._records() if record.uuid not in expired]
+                kept = heapq.nlargest(policy.max_events, remaining, key=lambda record: record.sort_key)
+                expired.update({record.uuid for record in remaining} - {record.uuid for record in kept})
+
+            for id in expired:
+                self._slots[self._index.pop(id)] = None
+            return len(expired)
+
+    def get_stats(
+        self,
+        start: float,
+        end: float,
+        bucket_seconds: int = 60,
+        group_by: tuple[str, ...] = ("name",),
+        name: str | None = None,
+    ) -> list[dict]:
+        """Gets aggregated task metrics per time bucket, computed over the stored tasks"""
+        return _compute_stats(
+            events=(record.data for record in self._records()),
+            start=start,
+            end=end,
+            bucket_seconds=bucket_seconds,
+            group_by=group_by,
+            name=name,
+        )
+
+
+class BufferedStorage(Storage):
+    """
+    Write-behind wrapper around another storage backend.
+
+    Events are queued in memory and a background writer flushes them to the wrapped storage in batches,
+    either when `batch_size` events are pending or when the oldest pending event has waited `flush_interval`
+    seconds. Reads are delegated to the wrapped storage, so they only see events that have been flushed.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_retries: int = 3,
+        retry_delay: float = 0.5,
+    ) -> None:
+        """
+        Initializes the buffered storage and starts the writer thread
+
+        Args:
+            storage: The storage that batches are flushed to.
+            batch_size: Maximum number of events written in one batch.
+            flush_interval: Maximum time in seconds an event waits in the buffer before being flushed.
+            max_retries: Number of times a batch that failed to be stored is tried again, e.g. while the database
+                is locked. After that, it is dropped and logged.
+            retry_delay: Seconds before the first retry, doubled for each next one.
+        """
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._buffer: deque[tuple[float, dict]] = deque()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._in_flight_since: float | None = None
+        self._flushed = 0
+        self._flush_requested = False
+        self._closed = False
+
+        self._writer = threading.Thread(target=self._run_writer, name="veggie-storage-writer", daemon=True)
+        self._writer.start()
+
+    def _next_batch(self) -> list[tuple[float, dict]]:
+        """Waits until a batch is due and takes it from the buffer"""
+        with self._condition:
+            while not self._closed:
+                if len(self._buffer) >= self.batch_size or (self._buffer and self._flush_requested):
+                    break
+                if self._buffer:
+                    timeout = self._buffer[0][0] + self.flush_interval - time.monotonic()
+                    if timeout <= 0:
+                        break
+                else:
+                    timeout = None
+                self._condition.wait(timeout)
+
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            if not self._buffer:
+                self._flush_requested = False
+            self._in_flight = len(batch)
+            self._in_flight_since = batch[0][0] if batch else None
+            return batch
+
+    def _store(self, events: list[dict]) -> None:
+        """Stores a batch in the wrapped storage, retrying with exponential backoff"""
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.storage.store_events(events)
+                return
+            except Exception:
+                if attempt == self.max_retries:
+                    logger.exception(f"Failed to store a batch of {len(events)} events")
+                    return
+                logger.warning(f"Failed to store a batch of {len(events)} events, retrying in {delay:.1f} seconds")
+                time.sleep(delay)
+                delay *= 2
+
+    def _run_writer(self) -> None:
+        """Flushes batches until the storage is closed and the buffer is drained"""
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._store([event for _, event in batch])
+
+            with self._condition:
+                self._flushed += len(batch)
+                self._in_flight = 0
+                self._in_flight_since = None
+                self._condition.notify_all()
+                if self._closed and not self._buffer:
+                    return
+
+    def store_event(self, event: dict) -> None:
+        """Queues event to be stored by the writer thread"""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Cannot store events after the storage is closed")
+            self._buffer.append((time.monotonic(), event))
+            if len(self._buffer) == 1 or len(self._buffer) >= self.batch_size:
+                self._condition.notify_all()
+
+    def store_events(self, events: list[dict]) -> None:
+        """Queues a batch of events to be stored by the writer thread"""
+        for event in events:
+            self.store_event(event)
+
+    def get_events(self) -> list[dict]:
+        """Gets events from the wrapped storage"""
+        return self.storage.get_events()
+
+    def get_event_by_id(self, id: str) -> dict | None:
+        """Gets single event by its ID from the wrapped storage"""
+        return self.storage.get_event_by_id(id=id)
+
+    def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """Gets a page of events from the wrapped storage"""
+        return self.storage.query_events(
+            limit=limit,
+            after=after,
+            name=name,
+            state=state,
+            hostname=hostname,
+            sent_after=sent_after,
+            sent_before=sent_before,
+            search=search,
+            order=order,
+        )
+
+    def iter_events(
+        self,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+        batch_size: int = 1000,
+    ) -> Iterator[dict]:
+        """Iterates over the events of the wrapped storage"""
+        return self.storage.iter_events(
+            after=after,
+            name=name,
+            state=state,
+            hostname=hostname,
+            sent_after=sent_after,
+            sent_before=sent_before,
+            search=search,
+            order=order,
+            batch_size=batch_size,
+        )
+
+    def get_stats(
+        self,
+        start: float,
+        end: float,
+        bucket_seconds: int = 60,
+        group_by: tuple[str, ...] = ("name",),
+        name: str | None = None,
+    ) -> list[dict]:
+        """Gets aggregated task metrics from the wrapped storage"""
+        return self.storage.get_stats(start=start, end=end, bucket_seconds=bucket_seconds, group_by=group_by, name=name)
+
+    def prune(self, policy: RetentionPolicy) -> int:
+        """Deletes events from the wrapped storage"""
+        return self.storage.prune(policy=policy)
+
+    @property
+    def supports_retention(self) -> bool:
+        """Whether the wrapped storage implements `prune()`"""
+        return self.storage.supports_retention
+
+    def flush(self) -> None:
+        """Blocks until all events queued so far have been written"""
+        with self._condition:
+            target = self._flushed + self._in_flight + len(self._buffer)
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._flushed < target and self._writer.is_alive():
+                self._condition.wait()
+
+    def lag(self) -> dict:
+        """
+        Reports how far ingestion is lagging behind
+
+        Returns:
+            The number of events not yet written, the age in seconds of the oldest of them and the total number
+            of events flushed so far.
+        """
+        with self._condition:
+            pending = self._in_flight + len(self._buffer)
+            oldest = self._in_flight_since or (self._buffer[0][0] if self._buffer else None)
+            return {
+                "pending_events": pending,
+                "lag_seconds": time.monotonic() - oldest if oldest is not None else 0.0,
+                "flushed_events": self._flushed,
+            }
+
+    def close(self) -> None:
+        """Flushes all pending events, stops the writer thread and closes the wrapped storage"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        self.storage.close()
+
+
+class CachedStorage(Storage):
+    """
+    Write-through LRU cache of task documents in front of another storage backend.
+
+    Tasks looked up by ID are kept as parsed dicts, and events of cached tasks are merged into them as they are
+    stored, with the same rules as the storage backends. The keys of the newest tasks are tracked as well, so
+    the first page of recent events is served from memory; only tasks that are new since the page was last
+    read are fetched by ID. All writes must go through the cache for it to stay consistent.
+    """
+
+    def __init__(self, storage: Storage, max_size: int = 10000, recent_size: int = 100) -> None:
+        """
+        Initializes the cache
+
+        Args:
+            storage: The storage that reads and writes are delegated to.
+            max_size: Maximum number of tasks kept in the cache.
+            recent_size: Minimum number of newest tasks tracked for the first page.
+        """
+        self.storage = storage
+        self.max_size = max_size
+        self.recent_size = recent_size
+
+        self._cache: OrderedDict[str, dict] = OrderedDict()
+        # Sort keys of the newest tasks, oldest first, and the sort key of each of these tasks.
+        # None until the first page is read, and after pruning.
+        self._recent: list[tuple] | None = None
+        self._recent_keys: dict[str, tuple] = {}
+        self._recent_limit = 0
+        # Misses are read from the wrapped storage under the lock, so a write can't be merged into the cache
+        # between reading a task and caching it
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _put(self, id: str, event: dict) -> None:
+        """Caches a task document, evicting the least recently used ones if the cache is full"""
+        self._cache[id] = event
+        self._cache.move_to_end(id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def _track_recent(self, event: dict) -> None:
+        """Updates the newest tasks with the sort key of an event's task"""
+        if self._recent is None:
+            return
+        id = event["uuid"]
+        old_key = self._recent_keys.get(id)
+        # Only task-sent events carry the sent timestamp, other events keep the task's current key
+        key = _sort_key(event["sent_timestamp"], id) if "sent_timestamp" in event else old_key or _sort_key(None, id)
+
+        if old_key is not None:
+            self._recent.pop(bisect.bisect_left(self._recent, old_key))
+        elif len(self._recent) >= self._recent_limit and key < self._recent[0]:
+            return
+        bisect.insort(self._recent, key)
+        self._recent_keys[id] = key
+        if len(self._recent) > self._recent_limit:
+            del self._recent_keys[self._recent.pop(0)[-1]]
+
+    def store_event(self, event: dict) -> None:
+        """Stores event in the wrapped storage and merges it into the cached task"""
+        self.store_events([event])
+
+    def store_events(self, events: list[dict]) -> None:
+        """Stores a batch of events in the wrapped storage and merges them into the cached tasks"""
+        self.storage.store_events(events)
+        with self._lock:
+            for event in events:
+                cached = self._cache.get(event["uuid"])
+                if cached is not None:
+                    self._cache[event["uuid"]] = merge_event(cached, event)
+                self._track_recent(event)
+
+    def get_events(self) -> list[dict]:
+        """Gets events from the wrapped storage"""
+        return self.storage.get_events()
+
+    def _get_cached(self, id: str) -> dict | None:
+        """Gets a task from the cache or else from the wrapped storage, with the lock held"""
+        event = self._cache.get(id)
+        if event is not None:
+            self._hits += 1
+            self._cache.move_to_end(id)
+            return event
+        self._misses += 1
+        event = self.storage.get_event_by_id(id=id)
+        if event is not None:
+            self._put(id, event)
+        return event
+
+    def get_event_by_id(self, id: str) -> dict | None:
+        """Gets single event by its ID, from memory if cached"""
+        with self._lock:
+            event = self._get_cached(id)
+        return dict(event) if event is not None else None
+
+    def _get_recent_page(self, limit: int) -> list[dict] | None:
+        """Gets the newest tasks from memory, or None if they are not all known, with the lock held"""
+        if self._recent is None or limit > self._recent_limit:
+            self._recent_limit = max(limit, self.recent_size)
+            events = self.storage.query_events(limit=self._recent_limit)
+            self._recent = sorted(_sort_key(event.get("sent_timestamp"), event["uuid"]) for event in events)
+            self._recent_keys = {key[-1]: key for key in self._recent}
+            for event in events:
+                self._put(event["uuid"], event)
+
+        page = []
+        for key in reversed(self._recent[-limit:]):
+            cached = self._get_cached(key[-1])
+            if cached is None:
+                # Written to the cache but not readable from the wrapped storage yet, e.g. still buffered
+                self._recent = None
+                return None
+            page.append(dict(cached))
+        return page
+
+    def query_events(
+        self,
+        limit: int = 100,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+    ) -> list[dict]:
+        """Gets a page of events, from memory for the first page of all events, newest first"""
+        filters = (after, name, state, hostname, sent_after, sent_before, search)
+        if order == "desc" and all(value is None for value in filters) and limit <= self.max_size:
+            with self._lock:
+                page = self._get_recent_page(limit=limit)
+            if page is not None:
+                return page
+        return self.storage.query_events(
+            limit=limit,
+            after=after,
+            name=name,
+            state=state,
+            hostname=hostname,
+            sent_after=sent_after,
+            sent_before=sent_before,
+            search=search,
+            order=order,
+        )
+
+    def iter_events(
+        self,
+        after: tuple[float | None, str] | None = None,
+        name: str | None = None,
+        state: str | None = None,
+        hostname: str | None = None,
+        sent_after: float | None = None,
+        sent_before: float | None = None,
+        search: str | None = None,
+        order: str = "desc",
+        batch_size: int = 1000,
+    ) -> Iterator[dict]:
+        """Iterates over the events of the wrapped storage"""
+        return self.storage.iter_events(
+            after=after,
+            name=name,
+            state=state,
+            hostname=hostname,
+            sent_after=sent_after,
+            sent_before=sent_before,
+            search=search,
+            order=order,
+            batch_size=batch_size,
+        )
+
+    def get_stats(
+        self,
+        start: float,
+        end: float,
+        bucket_seconds: int = 60,
+        group_by: tuple[str, ...] = ("name",),
+        name: str | None = None,
+    ) -> list[dict]:
+        """Gets aggregated task metrics from the wrapped storage"""
+        return self.storage.get_stats(start=start, end=end, bucket_seconds=bucket_seconds, group_by=group_by, name=name)
+
+    def prune(self, policy: RetentionPolicy) -> int:
+        """Deletes events from the wrapped storage and clears the cache if any were deleted"""
+        deleted = self.storage.prune(policy=policy)
+        if deleted:
+            with self._lock:
+                self._cache.clear()
+                self._recent = None
+        return deleted
+
+    @property
+    def supports_retention(self) -> bool:
+        """Whether the wrapped storage implements `prune()`"""
+        return self.storage.supports_retention
+
+    def cache_info(self) -> dict:
+        """Returns the number of cache hits and misses and the number of cached tasks"""
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "size": len(self._cache), "max_size": self.max_size}
+
+    def close(self) -> None:
+        """Closes the wrapped storage"""
+        self.storage.close()
@@ -1,63 +1,299 @@
 """REST API"""
 
-from inspect import signature
-from typing import Any, Callable, get_type_hints
+import json
+import random
+import threading
+import time
+from typing import Any, Callable, Iterator, TypeVar, overload
 
-from celery import Celery
 from flask import Blueprint, Response, jsonify, request
 
-from ..storage import Storage
+from ..bus import EventBus
+from ..export import FORMATS
+from .service import NotIngestingError, VeggieService
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_STATS_RANGE_SECONDS = 3600
+MAX_STATS_BUCKETS = 10000
+STREAM_WINDOW_SECONDS = 0.5
+STREAM_KEEPALIVE_SECONDS = 15.0
+STREAM_MAX_SECONDS = 300.0
+STREAM_RETRY_MILLISECONDS = 1000
+# Clients turned away because too many streams are open retry after this, with some jitter
+STREAM_BUSY_RETRY_MILLISECONDS = 30000
+DEFAULT_MAX_STREAMS = 48
+NDJSON_MIMETYPE = "application/x-ndjson"
 
-def function_params_to_json(func: Callable) -> list[dict]:
+T = TypeVar("T")
+
+
+@overload
+def query_arg(name: str, type: Callable[[str], T]) -> T | None:
+    ...
+
+
+@overload
+def query_arg(name: str, type: Callable[[str], T], default: T) -> T:
+    ...
+
+
+def query_arg(name: str, type: Callable[[str], T], default: T | None = None) -> T | None:
     """
-    Extracts function arguments, their types, and default values into JSON format.
+    Parses an optional query parameter
 
-    Args:
-        func: The function to extract information from.
+    Unlike `request.args.get(type=...)`, which returns the default for a malformed value, a typo is an error.
 
-    Returns:
-        A list of dictionaries, each representing one of the function's arguments.
+    Raises:
+        ValueError: If the parameter is given but can't be parsed.
     """
-    # Get the function signature and type hints
-    sig = signature(func)
-    type_hints = get_type_hints(func)
-
-    # Prepare JSON structure
-    arguments = []
-    for name, param in sig.parameters.items():
-        param_type = type_hints.get(name, "Any")  # Use type hint if available, otherwise default to Any
-        default_value = param.default if param.default is not param.empty else None  # Handle default values
-        type_name = param_type.__name__ if hasattr(param_type, "__name__") else str(param_type)
-        arguments.append({"name": name, "type": type_name, "default": default_value})
-    return arguments
-
-
-def create_api_blueprint(storage: Storage, celery_app: Celery) -> Blueprint:
-    """Initializes Flask app"""
-    bp = Blueprint(name="api", import_name=__name__)
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return type(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a {type.__name__}, got {value!r}") from None
+
+
+def events_filters_from_request() -> dict:
+    """
+    Parses the filter and order query parameters of an events request
+
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    order = request.args.get("order", default="desc")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+
+    return {
+        "name": request.args.get("name"),
+        "state": request.args.get("state"),
+        "hostname": request.args.get("hostname"),
+        "sent_after": query_arg("sent_after", type=float),
+        "sent_before": query_arg("sent_before", type=float),
+        "search": request.args.get("q") or None,
+        "order": order,
+    }
+
+
+def events_query_from_request() -> dict:
+    """
+    Parses the query parameters of an events request into `VeggieService.get_events_page()` arguments
+
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    limit = query_arg("limit", type=int, default=DEFAULT_PAGE_SIZE)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return {"limit": limit, "cursor": request.args.get("cursor"), **events_filters_from_request()}
+
+
+def events_stream_query_from_request() -> dict:
+    """
+    Parses the query parameters of a streamed events request into `VeggieService.iter_events()` arguments
+
+    Unlike pages, streams have no limit by default.
+
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    limit = query_arg("limit", type=int)
+    if limit is not None and limit <= 0:
+        raise ValueError("limit must be positive")
+    return {"limit": limit, "cursor": request.args.get("cursor"), **events_filters_from_request()}
+
+
+def wants_ndjson() -> bool:
+    """Whether the events are requested as newline-delimited JSON, with `?stream=1` or the Accept header"""
+    if request.args.get("stream", default=False, type=lambda value: value.lower() in ("1", "true")):
+        return True
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def ndjson_lines(events: Iterator[dict]) -> Iterator[str]:
+    """Yields one JSON line per event"""
+    for event in events:
+        yield json.dumps(event) + "\n"
+
+
+def stats_query_from_request() -> dict:
+    """
+    Parses the query parameters of a stats request into `Storage.get_stats()` arguments
+
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    end = query_arg("end", type=float, default=time.time())
+    start = query_arg("start", type=float, default=end - DEFAULT_STATS_RANGE_SECONDS)
+    bucket_seconds = query_arg("bucket", type=int, default=60)
+    if bucket_seconds <= 0:
+        raise ValueError("bucket must be a positive number of seconds")
+    if not start < end:
+        raise ValueError("start must be before end")
+    if (end - start) / bucket_seconds > MAX_STATS_BUCKETS:
+        raise ValueError(f"The time range can span at most {MAX_STATS_BUCKETS} buckets")
+    group_by = request.args.get("group_by", default="name")
+
+    return {
+        "start": start,
+        "end": end,
+        "bucket_seconds": bucket_seconds,
+        "group_by": tuple(column for column in group_by.split(",") if column),
+        "name": request.args.get("name"),
+    }
+
+
+def event_stream_messages(event_bus: EventBus, max_seconds: float = STREAM_MAX_SECONDS) -> Iterator[str]:
+    """
+    Yields Server-Sent Events messages with the events published to the bus
+
+    The stream ends when the client disconnects or after `max_seconds`, so that it doesn't hold a server thread
+    forever. The client then reconnects after STREAM_RETRY_MILLISECONDS, as set in the first message.
+    """
+    subscription = event_bus.subscribe()
+    deadline = time.monotonic() + max_seconds
+    try:
+        yield f"retry: {STREAM_RETRY_MILLISECONDS}\n: connected\n\n"
+        while (remaining := deadline - time.monotonic()) > 0:
+            events, dropped = subscription.get_batch(
+                timeout=min(STREAM_KEEPALIVE_SECONDS, remaining), window=STREAM_WINDOW_SECONDS
+            )
+            if events or dropped:
+                yield f"data: {json.dumps({'events': events, 'dropped': dropped})}\n\n"
+            else:
+                yield ": keepalive\n\n"
+    finally:
+        event_bus.unsubscribe(subscription)
+
+
+def add_event_routes(bp: Blueprint, service: VeggieService) -> None:
+    """Adds the routes reading events and their aggregates"""
 
     @bp.route("/events", methods=["GET"])
-    def get_events() -> list[dict]:
-        """Gets events"""
-        return storage.get_events()
+    def get_events() -> Any:
+        """
+        Gets all events as a JSON array, newest first, or streams them
+
+        The response of the first version of the API, kept for its clients. New clients page through the events
+        with `/v2/events`. Takes the same query parameters, with `limit` optional and unbounded.
+        """
+        # Validated before the response starts, so that errors are still bad requests
+        events = service.iter_events(**events_stream_query_from_request())
+        if wants_ndjson():
+            return Response(ndjson_lines(events), mimetype=NDJSON_MIMETYPE)
+        return jsonify(list(events))
+
+    @bp.route("/v2/events", methods=["GET"])
+    def get_events_page() -> Any:
+        """
+        Gets a page of events, newest first, or streams them
+
+        Query parameters:
+            limit: Page size, up to MAX_PAGE_SIZE.
+            cursor: The `next_cursor` of the previous page.
+            name, state, hostname: Filters on task name, latest event type and hostname.
+            sent_after, sent_before: Time range of the sent timestamp, as Unix timestamps.
+            q: Words to search in the task arguments, result, exception and traceback.
+            order: "desc" for newest first (default) or "asc" for oldest first.
+            stream: If true, or with `Accept: application/x-ndjson`, streams all matching events as one JSON line
+                each instead, read from storage in batches. `limit` is then optional and unbounded.
+        """
+        if wants_ndjson():
+            events = service.iter_events(**events_stream_query_from_request())
+            return Response(ndjson_lines(events), mimetype=NDJSON_MIMETYPE)
+        return jsonify(service.get_events_page(**events_query_from_request()))
+
+    @bp.route("/events/export", methods=["GET"])
+    def export_events() -> Response:
+        """
+        Streams the tasks sent in a time range as a Parquet file or an Arrow IPC stream, for offline analysis
+
+        Query parameters:
+            format: "parquet" (default) or "arrow".
+            start, end: Time range of the sent timestamp, as Unix timestamps. Defaults to all tasks.
+        """
+        export_format = request.args.get("format", default="parquet")
+        try:
+            chunks = service.export_events(
+                format=export_format, start=query_arg("start", type=float), end=query_arg("end", type=float)
+            )
+        except ImportError as e:
+            return Response(status=501, response=str(e))
+
+        mimetype, extension = FORMATS[export_format]
+        return Response(
+            chunks,
+            mimetype=mimetype,
+            headers={"Content-Disposition": f'attachment; filename="veggie-tasks.{extension}"'},
+        )
 
     @bp.route("/events/<string:event_id>", methods=["GET"])
     def get_single_event(event_id: str) -> Any:
         """Gets events"""
-        event = storage.get_event_by_id(id=event_id)
+        event = service.get_event(id=event_id)
         if event is None:
             return Response(status=404, response="Event not found")
         return event
 
+    @bp.route("/stats", methods=["GET"])
+    def get_stats() -> Any:
+        """
+        Gets task metrics per time bucket: counts by state, failure ratio, runtime and queue wait percentiles
+
+        Query parameters:
+            start, end: Time range of the sent timestamp, as Unix timestamps. Defaults to the last hour.
+            bucket: Bucket size in seconds, 60 by default.
+            group_by: Comma-separated fields to group by within each bucket, "name" and/or "hostname".
+            name: Only aggregate tasks with this name.
+        """
+        return jsonify(service.get_stats(**stats_query_from_request()))
+
+
+def add_stream_routes(bp: Blueprint, service: VeggieService, max_streams: int) -> None:
+    """Adds the route pushing events as they are ingested"""
+    # Each open stream holds a server thread
+    open_streams = threading.BoundedSemaphore(max_streams)
+
+    @bp.route("/events/stream", methods=["GET"])
+    def stream_events() -> Response:
+        """
+        Streams ingested events as Server-Sent Events
+
+        Each message is a JSON object with the events received in the last STREAM_WINDOW_SECONDS, merged into one
+        delta per task, and the number of events dropped because the client was too slow to read them. Streams end
+        after STREAM_MAX_SECONDS. Once `max_streams` are open, the stream ends right away and tells the client to
+        reconnect after about STREAM_BUSY_RETRY_MILLISECONDS: browsers give up on an EventSource answered with an
+        error status, so the status page would never get live updates again.
+        """
+        event_bus = service.get_event_bus()
+        if not open_streams.acquire(blocking=False):
+            retry = int(STREAM_BUSY_RETRY_MILLISECONDS * random.uniform(0.5, 1.5))
+            return Response(
+                f"retry: {retry}\n: too many open event streams\n\n",
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache"},
+            )
+
+        response = Response(
+            event_stream_messages(event_bus=event_bus),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        # The server closes the response when the stream ends or the client disconnects, even before it started
+        response.call_on_close(open_streams.release)
+        return response
+
+
+def add_task_routes(bp: Blueprint, service: VeggieService) -> None:
+    """Adds the routes listing and sending Celery tasks"""
+
     @bp.route("/tasks", methods=["GET"])
     def get_tasks() -> list[dict]:
         """Gets tasks"""
-        user_defined_tasks = {name: task for name, task in celery_app.tasks.items() if not name.startswith("celery.")}
-        return [
-            {"name": name, "parameters": function_params_to_json(func=task)}
-            for name, task in user_defined_tasks.items()
-        ]
+        return service.get_tasks()
 
     @bp.route("/tasks", methods=["POST"])
     def send_task() -> Response:
@@ -71,8 +307,56 @@ def create_api_blueprint(storage: Storage, celery_app: Celery) -> Blueprint:
         if task_params is None:
             return Response(status=400, response="Missing task_params")
 
-        result = celery_app.send_task(task_name, kwargs=task_params)
+        task_id = service.send_task(task_name=task_name, task_params=task_params)
+
+        return jsonify({"task_id": task_id})
+
+
+def add_worker_routes(bp: Blueprint, service: VeggieService) -> None:
+    """Adds the routes reading the worker registry"""
+
+    @bp.route("/workers", methods=["GET"])
+    def get_workers() -> Response:
+        """Gets the workers with their online status, load and last heartbeat"""
+        return jsonify({"workers": service.get_workers()})
+
+    @bp.route("/health", methods=["GET"])
+    def get_health() -> Response:
+        """
+        Gets the health of event ingestion: connected receivers, reconnections, latest event and pending events
+
+        Responds with 503 when no receiver is connected to the broker, so it can be used as a liveness probe.
+        """
+        health = service.get_health()
+        response = jsonify(health)
+        if health["status"] == "down":
+            response.status_code = 503
+        return response
+
+
+def create_api_blueprint(service: VeggieService, max_streams: int = DEFAULT_MAX_STREAMS) -> Blueprint:
+    """
+    Initializes Flask app
+
+    Args:
+        service: Service reading the stored events.
+        max_streams: Maximum number of live event streams open at once.
+    """
+    bp = Blueprint(name="api", import_name=__name__)
+
+    @bp.errorhandler(ValueError)
+    def handle_invalid_parameter(e: ValueError) -> Response:
+        """Returns invalid request parameters as bad requests"""
+        return Response(status=400, response=str(e))
+
+    @bp.errorhandler(NotIngestingError)
+    def handle_not_ingesting(e: NotIngestingError) -> Response:
+        """Returns the routes of data held by the process ingesting events as not found in other processes"""
+        return Response(status=404, response=str(e))
 
-        return jsonify({"task_id": result.task_id})
+    add_event_routes(bp=bp, service=service)
+    add_stream_routes(bp=bp, service=service, max_streams=max_streams)
+    add_task_routes(bp=bp, service=service)
+    add_worker_routes(bp=bp, service=service)
 
     return bp
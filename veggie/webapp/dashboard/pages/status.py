@@ -1,17 +1,21 @@
 """Status page"""
 import datetime
-import os
+import json
 from typing import Any, Tuple
 
 import dash_mantine_components as dmc
 import humanize
-import requests  # type: ignore
-from dash_extensions.enrich import ALL, DashBlueprint, Input, Output, ctx, exceptions
+from dash import Patch
+from dash_extensions import EventSource
+from dash_extensions.enrich import ALL, DashBlueprint, Input, Output, State, ctx, dcc, exceptions
 from dash_iconify import DashIconify
 
-from ....webapp.dashboard import style
+from ....state import supersedes, timestamp_field
+from ....webapp.dashboard import config, style
+from ....webapp.service import encode_cursor, get_service
 
-PORT = os.getenv("VEGGIE_PORT", 5000)
+PAGE_SIZES = [25, 50, 100]
+INITIAL_CURSORS: dict = {"pages": [None], "next": None}
 
 blueprint = DashBlueprint()
 
@@ -194,56 +198,160 @@ def get_event_details_card(event: dict) -> Any:
     )
 
 
-def get_table_rows() -> list[Any]:
-    """Retrieves events and creates table body"""
-    response = requests.get(f"http://localhost:{PORT}/api/events")
-    events = response.json()
+def get_events_page(
+    cursor: str | None, page_size: int, order: str, name: str | None, state: str | None, search: str | None
+) -> dict:
+    """Retrieves one page of events"""
+    return get_service().get_events_page(
+        limit=page_size, cursor=cursor, order=order, name=name or None, state=state or None, search=search or None
+    )
 
-    rows = []
-    for event in events:
-        state_message = style.TYPE_TO_STATE.get(event.get("type"), {}).get("message", "")
-        state_color = style.TYPE_TO_STATE.get(event.get("type"), {}).get("color", "gray")
-
-        row = dmc.TableTr(
-            children=[
-                dmc.TableTd(
-                    dmc.ActionIcon(
-                        DashIconify(icon="mingcute:more-2-line", width=20),
-                        size="md",
-                        variant="transparent",
-                        id={"type": "event-details-button", "uuid": event["uuid"]},
-                    )
-                ),
-                dmc.TableTd(event["name"]),
-                dmc.TableTd(dmc.Badge(state_message, color=state_color)),
-                dmc.TableTd(
-                    humanize.naturaltime(
-                        datetime.datetime.now(tz=datetime.timezone.utc)
-                        - datetime.datetime.fromtimestamp(event["received_timestamp"], tz=datetime.timezone.utc)
-                    )
-                    if event.get("received_timestamp")
-                    else "N/A"
-                ),
-            ]
+
+def get_state_cell(event: dict) -> Any:
+    """Creates the status cell of a table row"""
+    state_message = style.TYPE_TO_STATE.get(event.get("type", ""), {}).get("message", "")
+    state_color = style.TYPE_TO_STATE.get(event.get("type", ""), {}).get("color", "gray")
+    return dmc.TableTd(dmc.Badge(state_message, color=state_color))
+
+
+def get_received_cell(event: dict) -> Any:
+    """Creates the received time cell of a table row"""
+    return dmc.TableTd(
+        humanize.naturaltime(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+            - datetime.datetime.fromtimestamp(event["received_timestamp"], tz=datetime.timezone.utc)
         )
-        rows.append(row)
+        if event.get("received_timestamp")
+        else "N/A"
+    )
+
+
+def get_table_row(event: dict) -> Any:
+    """Creates the table row of an event"""
+    return dmc.TableTr(
+        children=[
+            dmc.TableTd(
+                dmc.ActionIcon(
+                    DashIconify(icon="mingcute:more-2-line", width=20),
+                    size="md",
+                    variant="transparent",
+                    id={"type": "event-details-button", "uuid": event["uuid"]},
+                )
+            ),
+            dmc.TableTd(event.get("name")),
+            get_state_cell(event),
+            get_received_cell(event),
+        ]
+    )
+
+
+def get_table_rows(events: list[dict]) -> list[Any]:
+    """Creates table body for the given events"""
+    return [get_table_row(event) for event in events]
 
-    return rows
+
+def get_row_state(event: dict) -> dict:
+    """Returns the type of an event and its timestamp, used to ignore live updates of an earlier state"""
+    if "type" not in event:
+        return {}
+    return {"type": event["type"], timestamp_field(event["type"]): event.get(timestamp_field(event["type"]))}
+
+
+def get_row_keys(events: list[dict]) -> list[dict]:
+    """Returns the keys of the table rows, used to apply live updates to the right rows"""
+    return [
+        {"uuid": event["uuid"], "sent_timestamp": event.get("sent_timestamp"), "state": get_row_state(event)}
+        for event in events
+    ]
 
 
 def layout() -> Any:
     """Creates layout for status page"""
+    # Live updates come from the process ingesting events, other processes refresh on demand only
+    live_updates = (
+        [EventSource(id="status-event-source", url=f"{config.APP_BASE_PATH}api/events/stream")]
+        if get_service().event_bus is not None
+        else []
+    )
     return dmc.Container(
         children=[
+            dcc.Store(id="status-page-cursors", data=INITIAL_CURSORS),
+            dcc.Store(id="status-page-rows", data=[]),
+            *live_updates,
             dmc.Stack(
-                align="flex-start",
+                align="stretch",
                 gap="md",
                 mt="md",
                 children=[
-                    dmc.Button(
-                        id="status-update-button",
-                        children="Refresh",
-                        leftSection=DashIconify(icon="material-symbols:refresh", width=20),
+                    dmc.Group(
+                        justify="space-between",
+                        children=[
+                            dmc.Group(
+                                children=[
+                                    dmc.Button(
+                                        id="status-update-button",
+                                        children="Refresh",
+                                        leftSection=DashIconify(icon="material-symbols:refresh", width=20),
+                                    ),
+                                    dmc.TextInput(
+                                        id="status-name-filter",
+                                        placeholder="Task name",
+                                        debounce=500,
+                                        leftSection=DashIconify(icon="material-symbols:search", width=20),
+                                    ),
+                                    dmc.TextInput(
+                                        id="status-search",
+                                        placeholder="Search args, result, exception",
+                                        debounce=500,
+                                        w=280,
+                                        leftSection=DashIconify(icon="material-symbols:manage-search", width=20),
+                                    ),
+                                    dmc.Select(
+                                        id="status-state-filter",
+                                        placeholder="Status",
+                                        clearable=True,
+                                        data=[
+                                            {"value": event_type, "label": state["message"]}
+                                            for event_type, state in style.TYPE_TO_STATE.items()
+                                            if event_type != "default"
+                                        ],
+                                    ),
+                                    dmc.SegmentedControl(
+                                        id="status-order",
+                                        value="desc",
+                                        data=[
+                                            {"value": "desc", "label": "Newest"},
+                                            {"value": "asc", "label": "Oldest"},
+                                        ],
+                                    ),
+                                ]
+                            ),
+                            dmc.Group(
+                                children=[
+                                    dmc.Select(
+                                        id="status-page-size",
+                                        value=str(PAGE_SIZES[0]),
+                                        data=[str(page_size) for page_size in PAGE_SIZES],
+                                        allowDeselect=False,
+                                        w=80,
+                                    ),
+                                    dmc.ActionIcon(
+                                        DashIconify(icon="mingcute:left-line", width=20),
+                                        id="status-previous-page-button",
+                                        variant="default",
+                                        size="lg",
+                                        disabled=True,
+                                    ),
+                                    dmc.ActionIcon(
+                                        DashIconify(icon="mingcute:right-line", width=20),
+                                        id="status-next-page-button",
+                                        variant="default",
+                                        size="lg",
+                                        disabled=True,
+                                    ),
+                                ]
+                            ),
+                        ],
                     ),
                     dmc.Table(
                         id="task-status-table",
@@ -260,7 +368,7 @@ def layout() -> Any:
                                     ]
                                 )
                             ),
-                            dmc.TableTbody(id="task-status-table-body", children=get_table_rows()),
+                            dmc.TableTbody(id="task-status-table-body", children=[]),
                         ],
                     ),
                 ],
@@ -275,11 +383,147 @@ blueprint.layout = layout
 
 
 @blueprint.callback(
-    Output("task-status-table-body", "children"), Input("status-update-button", "n_clicks"), prevent_initial_call=True
+    Output("task-status-table-body", "children"),
+    Output("status-page-rows", "data"),
+    Output("status-page-cursors", "data"),
+    Output("status-previous-page-button", "disabled"),
+    Output("status-next-page-button", "disabled"),
+    Input("status-update-button", "n_clicks"),
+    Input("status-previous-page-button", "n_clicks"),
+    Input("status-next-page-button", "n_clicks"),
+    Input("status-name-filter", "value"),
+    Input("status-state-filter", "value"),
+    Input("status-search", "value"),
+    Input("status-order", "value"),
+    Input("status-page-size", "value"),
+    State("status-page-cursors", "data"),
+)
+def update_table(
+    refresh_clicks: int | None,
+    previous_clicks: int | None,
+    next_clicks: int | None,
+    name: str | None,
+    state: str | None,
+    search: str | None,
+    order: str,
+    page_size: str,
+    cursors: dict,
+) -> Tuple[list[Any], list[dict], dict, bool, bool]:
+    """
+    Updates status table with the current page of events
+
+    `cursors["pages"]` holds the cursor of every page up to the current one, so going back doesn't need the
+    storage to support backward keyset queries. Changing a filter, the order or the page size starts over.
+    """
+    pages = list(cursors["pages"])
+    if ctx.triggered_id == "status-next-page-button" and cursors["next"] is not None:
+        pages.append(cursors["next"])
+    elif ctx.triggered_id == "status-previous-page-button" and len(pages) > 1:
+        pages.pop()
+    elif ctx.triggered_id not in ("status-update-button", "status-previous-page-button", "status-next-page-button"):
+        pages = [None]
+
+    page = get_events_page(
+        cursor=pages[-1], page_size=int(page_size), order=order, name=name, state=state, search=search
+    )
+    cursors = {"pages": pages, "next": page["next_cursor"]}
+    rows = get_table_rows(events=page["events"])
+    return rows, get_row_keys(events=page["events"]), cursors, len(pages) == 1, page["next_cursor"] is None
+
+
+def patch_existing_rows(rows: Patch, row_keys: list[dict], events: list[dict]) -> list[dict]:
+    """
+    Patches the status and received cells of the rows whose task has new events
+
+    The status cell is only patched if the event supersedes the state shown, and the row key is updated with it.
+
+    Returns:
+        The events of tasks that are not on the page.
+    """
+    positions = {key["uuid"]: position for position, key in enumerate(row_keys)}
+    other_events = []
+    for event in events:
+        position = positions.get(event["uuid"])
+        if position is None:
+            other_events.append(event)
+            continue
+        if "type" in event and supersedes(event, row_keys[position].get("state", {})):
+            rows[position]["props"]["children"][2] = get_state_cell(event)
+            row_keys[position]["state"] = get_row_state(event)
+        if event.get("received_timestamp"):
+            rows[position]["props"]["children"][3] = get_received_cell(event)
+    return other_events
+
+
+def add_new_rows(rows: Patch, row_keys: list[dict], events: list[dict], page_size: int) -> list[dict]:
+    """
+    Adds rows for new tasks on top of the first page and drops the rows pushed past the page size
+
+    Returns:
+        The keys of the rows on the page after the update.
+    """
+    row_keys = list(row_keys)
+    newest = row_keys[0]["sent_timestamp"] if row_keys else None
+    new_events = [event for event in events if event.get("name") and event.get("sent_timestamp") is not None]
+    for event in sorted(new_events, key=lambda event: event["sent_timestamp"]):
+        if newest is None or event["sent_timestamp"] >= newest:
+            rows.prepend(get_table_row(event))
+            row_keys.insert(0, get_row_keys(events=[event])[0])
+    for position in range(len(row_keys) - 1, page_size - 1, -1):
+        del rows[position]
+        row_keys.pop()
+    return row_keys
+
+
+@blueprint.callback(
+    Output("task-status-table-body", "children", allow_duplicate=True),
+    Output("status-page-rows", "data", allow_duplicate=True),
+    Output("status-page-cursors", "data", allow_duplicate=True),
+    Input("status-event-source", "message"),
+    State("status-page-rows", "data"),
+    State("status-page-cursors", "data"),
+    State("status-name-filter", "value"),
+    State("status-state-filter", "value"),
+    State("status-search", "value"),
+    State("status-order", "value"),
+    State("status-page-size", "value"),
+    prevent_initial_call=True,
 )
-def update_table(n_clicks: int) -> list[Any]:
-    """Updates status table"""
-    return get_table_rows()
+def apply_live_updates(
+    message: str,
+    row_keys: list[dict],
+    cursors: dict,
+    name: str | None,
+    state: str | None,
+    search: str | None,
+    order: str,
+    page_size: str,
+) -> Tuple[Any, list[dict], dict]:
+    """
+    Applies the events pushed by the server to the rows on screen
+
+    Rows of tasks already on the page get their status and received cells patched. New tasks are added on top
+    when the first page of all tasks is shown, newest first. Only if the server had to drop events for this
+    client is the page queried again.
+    """
+    message_data = json.loads(message)
+    if message_data["dropped"]:
+        page = get_events_page(
+            cursor=cursors["pages"][-1], page_size=int(page_size), order=order, name=name, state=state, search=search
+        )
+        cursors = {**cursors, "next": page["next_cursor"]}
+        return get_table_rows(events=page["events"]), get_row_keys(events=page["events"]), cursors
+
+    rows = Patch()
+    new_events = patch_existing_rows(rows=rows, row_keys=row_keys, events=message_data["events"])
+
+    is_live = len(cursors["pages"]) == 1 and order == "desc" and not name and not state and not search
+    if is_live:
+        row_keys = add_new_rows(rows=rows, row_keys=row_keys, events=new_events, page_size=int(page_size))
+        if len(row_keys) == int(page_size):
+            cursors = {**cursors, "next": encode_cursor(row_keys[-1])}
+
+    return rows, row_keys, cursors
 
 
 @blueprint.callback(
@@ -296,7 +540,8 @@ def open_event_details(n_clicks: list[int | None]) -> Tuple[bool, Any]:
     triggered_id = ctx.triggered_id
     task_id = triggered_id["uuid"]
 
-    response = requests.get(f"http://localhost:{PORT}/api/events/{task_id}")
-    event = response.json()
+    event = get_service().get_event(id=task_id)
+    if event is None:
+        raise exceptions.PreventUpdate
 
     return True, get_event_details_card(event=event)
@@ -1,15 +1,13 @@
 """Task execution page"""
 
-import os
 from typing import Any
 
 import dash_mantine_components as dmc
-import requests  # type: ignore
 from dash import set_props
 from dash_extensions.enrich import ALL, MATCH, DashBlueprint, Input, Output, State, ctx, html
 from loguru import logger
 
-PORT = os.getenv("VEGGIE_PORT", 5000)
+from ....webapp.service import get_service
 
 blueprint = DashBlueprint()
 
@@ -76,7 +74,7 @@ def create_task_section(task_info: dict) -> Any:
 
 def layout() -> Any:
     """Creates layout for tasks page"""
-    tasks = requests.get(f"http://localhost:{PORT}/api/tasks").json()
+    tasks = get_service().get_tasks()
     tasks = sorted(tasks, key=lambda task: task["name"])
 
     task_layouts = []
@@ -115,18 +113,15 @@ def handle_run(n_clicks: int, param_ids: list[dict], param_values: list, param_c
     task_kwargs = {param["param"]: param["value"] for param in params}
     logger.info(task_kwargs)
 
-    response = requests.post(
-        url=f"http://localhost:{PORT}/api/tasks",
-        json={"task_name": task_name, "task_params": task_kwargs},
-        headers={"Content-Type": "application/json"},
-    )
-    if response.status_code != 200:
-        logger.error(response.text)
+    try:
+        task_id = get_service().send_task(task_name=task_name, task_params=task_kwargs)
+    except Exception as e:
+        logger.error(e)
         return None
 
     notification = dmc.Notification(
         title=f"Task {task_name} started",
-        message=f"Task ID: {response.json()['task_id']}",
+        message=f"Task ID: {task_id}",
         action="show",
         position="bottom-right",
         autoClose=3000,
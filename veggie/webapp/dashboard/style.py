@@ -11,5 +11,8 @@ TYPE_TO_STATE = {
     "task-started": {"message": "In progress", "color": "blue"},
     "task-received": {"message": "Received", "color": "yellow"},
     "task-sent": {"message": "Sent", "color": "gray"},
+    "task-retried": {"message": "Retrying", "color": "orange"},
+    "task-revoked": {"message": "Revoked", "color": "violet"},
+    "task-rejected": {"message": "Rejected", "color": "pink"},
     "default": {"message": "N/A", "color": "gray"},
 }
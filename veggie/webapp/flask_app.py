@@ -5,16 +5,35 @@ Dash app
 from typing import Any
 
 from celery import Celery
-from flask import Flask
+from flask import Flask, Response
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from ..bus import EventBus
+from ..health import IngestionHealth
+from ..metrics import TaskMetrics
 from ..storage import Storage
-from ..webapp.api import create_api_blueprint
+from ..webapp.api import DEFAULT_MAX_STREAMS, create_api_blueprint
 from ..webapp.dashboard.index import app as dash_app
+from ..webapp.service import NOT_INGESTING_MESSAGE, VeggieService
+from ..workers import WorkerRegistry
 
 
-def get_flask_app(storage: Storage, celery_app: Celery) -> Any:
-    """Creates a Flask app and initializes Dash app inside it."""
+def get_flask_app(
+    storage: Storage,
+    celery_app: Celery,
+    event_bus: EventBus | None = None,
+    metrics: TaskMetrics | None = None,
+    workers: WorkerRegistry | None = None,
+    health: IngestionHealth | None = None,
+    max_streams: int = DEFAULT_MAX_STREAMS,
+) -> Any:
+    """
+    Creates a Flask app and initializes Dash app inside it.
+
+    The event bus, metrics, workers and health are those of the monitor ingesting events in this process. When
+    another process ingests the events, they are left out: the app then serves what is in the storage, and live
+    events, `/metrics` and `/api/workers` answer 404 rather than empty data.
+    """
     app = Flask(__name__)
 
     # This section is needed for url_for("foo", _external=True) to automatically
@@ -23,10 +42,23 @@ def get_flask_app(storage: Storage, celery_app: Celery) -> Any:
     # See also https://flask.palletsprojects.com/en/2.2.x/deploying/proxy_fix/
     app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)  # type: ignore[method-assign]
 
+    # The dashboard pages get the service through `current_app`, the API blueprint gets it directly
+    service = VeggieService(storage=storage, celery_app=celery_app, event_bus=event_bus, workers=workers, health=health)
+    app.extensions["veggie"] = service
+
     # Initialize Flask plugins
     dash_app.init_app(app)
 
-    api_blueprint = create_api_blueprint(storage=storage, celery_app=celery_app)
+    api_blueprint = create_api_blueprint(service=service, max_streams=max_streams)
     app.register_blueprint(blueprint=api_blueprint, url_prefix="/api")
 
+    # Prometheus scrape endpoint, served from memory without touching the storage
+    def render_metrics() -> Response:
+        """Renders the task metrics in the Prometheus text format"""
+        if metrics is None:
+            return Response(status=404, response=NOT_INGESTING_MESSAGE)
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule("/metrics", endpoint="metrics", view_func=render_metrics)
+
     return app
@@ -0,0 +1,222 @@
+"""
+Service layer shared by the REST API and the dashboard
+"""
+
+import base64
+import itertools
+import json
+from inspect import signature
+from typing import Any, Callable, Iterator, get_type_hints
+
+from celery import Celery
+from flask import current_app
+
+from ..bus import EventBus
+from ..export import iter_export
+from ..health import IngestionHealth
+from ..storage import Storage
+from ..workers import WorkerRegistry
+
+NOT_INGESTING_MESSAGE = (
+    "This process doesn't ingest events: live events, worker states and metrics are only served by the process "
+    "running the monitor"
+)
+
+
+class NotIngestingError(LookupError):
+    """Raised when asking for data held in memory by the process ingesting events, from another process"""
+
+    def __init__(self) -> None:
+        """Initializes the error with NOT_INGESTING_MESSAGE"""
+        super().__init__(NOT_INGESTING_MESSAGE)
+
+
+def function_params_to_json(func: Callable) -> list[dict]:
+    """
+    Extracts function arguments, their types, and default values into JSON format.
+
+    Args:
+        func: The function to extract information from.
+
+    Returns:
+        A list of dictionaries, each representing one of the function's arguments.
+    """
+    # Get the function signature and type hints
+    sig = signature(func)
+    type_hints = get_type_hints(func)
+
+    # Prepare JSON structure
+    arguments = []
+    for name, param in sig.parameters.items():
+        param_type = type_hints.get(name, "Any")  # Use type hint if available, otherwise default to Any
+        default_value = param.default if param.default is not param.empty else None  # Handle default values
+        type_name = param_type.__name__ if hasattr(param_type, "__name__") else str(param_type)
+        arguments.append({"name": name, "type": type_name, "default": default_value})
+    return arguments
+
+
+def encode_cursor(event: dict) -> str:
+    """Encodes the keyset cursor pointing after the given event"""
+    key = [event.get("sent_timestamp"), event["uuid"]]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float | None, str]:
+    """
+    Decodes a keyset cursor created by `encode_cursor()`
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        sent_timestamp, uuid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(uuid, str) or not (sent_timestamp is None or isinstance(sent_timestamp, int | float)):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return sent_timestamp, uuid
+
+
+class VeggieService:
+    """
+    Reads events from storage and sends tasks to Celery
+
+    The REST API and the dashboard pages both go through this class, so the dashboard doesn't make HTTP
+    requests to the API of its own process.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        celery_app: Celery,
+        event_bus: EventBus | None = None,
+        workers: WorkerRegistry | None = None,
+        health: IngestionHealth | None = None,
+    ) -> None:
+        """
+        Initializes the service
+
+        Without `health`, the process doesn't ingest events. Without `event_bus` and `workers`, it has no live
+        events nor worker states, which only the process ingesting events holds in memory.
+        """
+        self.storage = storage
+        self.celery_app = celery_app
+        self.event_bus = event_bus
+        self.workers = workers
+        self.health = health
+
+    def get_events_page(self, limit: int, cursor: str | None = None, **filters: Any) -> dict:
+        """
+        Gets a page of events
+
+        Args:
+            limit: Page size.
+            cursor: The `next_cursor` of the previous page.
+            **filters: Filters and order passed to `Storage.query_events()`.
+
+        Returns:
+            The events of the page and the cursor of the next page, or None if this is the last page.
+
+        Raises:
+            ValueError: If the cursor is malformed.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        events = self.storage.query_events(limit=limit, after=after, **filters)
+        next_cursor = encode_cursor(events[-1]) if len(events) == limit else None
+        return {"events": events, "next_cursor": next_cursor}
+
+    def iter_events(self, cursor: str | None = None, limit: int | None = None, **filters: Any) -> Iterator[dict]:
+        """
+        Iterates over the events matching the filters, reading them from storage in batches
+
+        Args:
+            cursor: The `next_cursor` of a page, to start after it.
+            limit: Maximum number of events, None for all of them.
+            **filters: Filters and order passed to `Storage.iter_events()`.
+
+        Raises:
+            ValueError: If the cursor or a filter is invalid, e.g. a search on a storage without search.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        events = itertools.islice(self.storage.iter_events(after=after, **filters), limit)
+        # Storages validate the filters when they run the query, so the first event is read here, before a response
+        # streaming the events starts
+        first = next(events, None)
+        return itertools.chain([first], events) if first is not None else iter(())
+
+    def get_event(self, id: str) -> dict | None:
+        """Gets single event by its ID"""
+        return self.storage.get_event_by_id(id=id)
+
+    def export_events(self, format: str, start: float | None = None, end: float | None = None) -> Iterator[bytes]:
+        """
+        Exports the tasks sent in a time range, as chunks of a Parquet file or an Arrow IPC stream
+
+        Raises:
+            ValueError: If the format is unknown.
+            ImportError: If pyarrow is not installed.
+        """
+        return iter_export(self.storage, format=format, start=start, end=end)
+
+    def get_stats(self, **kwargs: Any) -> list[dict]:
+        """Gets aggregated task metrics, with the same arguments as the storage method"""
+        return self.storage.get_stats(**kwargs)
+
+    def get_workers(self) -> list[dict]:
+        """
+        Gets the latest state of the workers, from memory
+
+        Raises:
+            NotIngestingError: This process doesn't ingest events, so it doesn't know the workers.
+        """
+        if self.workers is None:
+            raise NotIngestingError
+        return self.workers.get_workers()
+
+    def get_event_bus(self) -> EventBus:
+        """
+        Gets the bus publishing the events as they are ingested
+
+        Raises:
+            NotIngestingError: This process doesn't ingest events.
+        """
+        if self.event_bus is None:
+            raise NotIngestingError
+        return self.event_bus
+
+    def get_health(self) -> dict:
+        """
+        Gets the health of event ingestion
+
+        If this process serves the web app alone, ingestion runs elsewhere and its status is "unknown". The latest
+        event is then the latest task sent in the storage, for the caller to judge its freshness.
+        """
+        if self.health is None:
+            latest = self.storage.query_events(limit=1)
+            return {
+                "status": "unknown",
+                "receivers": None,
+                "last_event_timestamp": latest[0].get("sent_timestamp") if latest else None,
+                "pending": None,
+            }
+        return self.health.to_dict()
+
+    def get_tasks(self) -> list[dict]:
+        """Gets the user-defined tasks of the Celery app and their parameters"""
+        user_defined_tasks = {
+            name: task for name, task in self.celery_app.tasks.items() if not name.startswith("celery.")
+        }
+        return [
+            {"name": name, "parameters": function_params_to_json(func=task)}
+            for name, task in user_defined_tasks.items()
+        ]
+
+    def send_task(self, task_name: str, task_params: dict) -> str:
+        """Sends a task to Celery and returns its ID"""
+        result = self.celery_app.send_task(task_name, kwargs=task_params)
+        return result.task_id
+
+
+def get_service() -> VeggieService:
+    """Returns the service of the current Flask app"""
+    return current_app.extensions["veggie"]
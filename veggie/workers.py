@@ -0,0 +1,85 @@
+"""
+In-memory registry of Celery workers
+"""
+import threading
+import time
+
+# A worker is considered offline if no heartbeat arrived for this many heartbeat intervals, as in Celery
+HEARTBEAT_EXPIRE_INTERVALS = 2.0
+DEFAULT_HEARTBEAT_INTERVAL = 2.0
+
+
+class Worker:
+    """Latest known state of a worker"""
+
+    __slots__ = ("hostname", "online", "active", "processed", "loadavg", "freq", "sw_ident", "sw_ver", "last_heartbeat")
+
+    def __init__(self, hostname: str) -> None:
+        """Initializes a worker that hasn't sent any heartbeat yet"""
+        self.hostname = hostname
+        self.online = False
+        self.active: int | None = None
+        self.processed: int | None = None
+        self.loadavg: list[float] | None = None
+        self.freq = DEFAULT_HEARTBEAT_INTERVAL
+        self.sw_ident: str | None = None
+        self.sw_ver: str | None = None
+        self.last_heartbeat: float | None = None
+
+    def is_alive(self, now: float) -> bool:
+        """Whether the worker is online and its last heartbeat is recent"""
+        if not self.online or self.last_heartbeat is None:
+            return False
+        return now < self.last_heartbeat + self.freq * HEARTBEAT_EXPIRE_INTERVALS
+
+    def to_dict(self, now: float) -> dict:
+        """Returns the worker state as a JSON-serializable dict"""
+        return {
+            "hostname": self.hostname,
+            "online": self.is_alive(now),
+            "active": self.active,
+            "processed": self.processed,
+            "loadavg": self.loadavg,
+            "freq": self.freq,
+            "sw_ident": self.sw_ident,
+            "sw_ver": self.sw_ver,
+            "last_heartbeat": self.last_heartbeat,
+        }
+
+
+class WorkerRegistry:
+    """
+    Workers seen in worker-online, worker-heartbeat and worker-offline events
+
+    Only the latest state of each worker is kept, in memory, so heartbeats cost no storage write. Events may be
+    applied from several receiver threads, so updates take a lock, and readers copy the workers before iterating
+    them.
+    """
+
+    def __init__(self) -> None:
+        """Initializes an empty registry"""
+        self._workers: dict[str, Worker] = {}
+        self._lock = threading.Lock()
+
+    def update(self, event: dict) -> None:
+        """Applies a worker event"""
+        hostname = event["hostname"]
+        with self._lock:
+            worker = self._workers.get(hostname)
+            if worker is None:
+                worker = self._workers[hostname] = Worker(hostname=hostname)
+
+            worker.online = event["type"] != "worker-offline"
+            worker.last_heartbeat = event.get("timestamp", worker.last_heartbeat)
+            worker.freq = event.get("freq") or worker.freq
+            worker.active = event.get("active", worker.active)
+            worker.processed = event.get("processed", worker.processed)
+            worker.loadavg = event.get("loadavg", worker.loadavg)
+            worker.sw_ident = event.get("sw_ident", worker.sw_ident)
+            worker.sw_ver = event.get("sw_ver", worker.sw_ver)
+
+    def get_workers(self) -> list[dict]:
+        """Gets the state of all known workers, sorted by hostname"""
+        now = time.time()
+        workers = list(self._workers.values())
+        return [worker.to_dict(now) for worker in sorted(workers, key=lambda worker: worker.hostname)]